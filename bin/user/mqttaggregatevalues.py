@@ -6,21 +6,37 @@
 
 """ Plugin to calculate aggregate values. """
 
+import collections
 import datetime
+import functools
+import threading
 import time
 import traceback
 
+import weedb
 import weewx
 import weewx.manager
 import weeutil
 
-from weeutil.weeutil import to_bool, to_int, startOfInterval, TimeSpan
+from weeutil.weeutil import to_bool, to_int, isStartOfDay, startOfDay, startOfInterval, TimeSpan
 
 class TimeSpanProvider:
     ''' Manage the timespans. '''
+    # Local midnights, hours and daylight saving time transitions are all on a quarter hour,
+    # so a timespan is the same for every timestamp between two quarter hours.
+    boundary_interval = 900
+    # The timespans that do not end at the timestamp are memoized.
+    memoized_periods = ['hour', 'day', 'yesterday', 'week', 'month', 'year']
+
     def __init__(self, db_manager, week_start):
         self.db_manager = db_manager
         self.week_start = week_start
+        # The latest timespan of each (period, offset, utc offset), with the quarter hour it was calculated for.
+        self.timespans = {}
+        # The latest start of each _last_n_days, with the quarter hour it was calculated for.
+        self.day_starts = {}
+        # The UTC offset, with the time it is good until.
+        self.utc_offset_memo = (0, None)
         # ToDo: Should calculation interval be something like 'on the archive', 'on the hour', 'on the day'
         # ToDo: Need to think hard about what the interval values should be
         self.period_timespans = {
@@ -73,7 +89,46 @@ class TimeSpanProvider:
 
     def get_timespan(self, interval, timestamp, offset):
         ''' Get a timespan for the interval and timstamp. '''
-        return self.period_timespans[interval]['function'](timestamp, offset)
+        (quarter_hour, seconds) = divmod(timestamp, self.boundary_interval)
+        # On a quarter hour, whether the timestamp is in the timespan starting or stopping there depends on the period.
+        if interval not in self.memoized_periods or seconds == 0:
+            return self.period_timespans[interval]['function'](timestamp, offset)
+
+        key = (interval, offset, self.utc_offset() if offset is not None else None)
+        memo = self.timespans.get(key)
+        if memo is not None and memo[0] == quarter_hour:
+            return memo[1]
+
+        timespan = self.period_timespans[interval]['function'](timestamp, offset)
+        self.timespans[key] = (quarter_hour, timespan)
+        return timespan
+
+    def utc_offset(self):
+        ''' The UTC offset of the local time zone in seconds, less a day.
+            It is calculated again when the next daylight saving time transition is reached. '''
+        now = time.time()
+        (expires, utc_offset) = self.utc_offset_memo
+        if now >= expires:
+            utc_offset = datetime.datetime.now().astimezone().utcoffset().seconds - 24 * 60 * 60
+            self.utc_offset_memo = (self._next_utc_offset_change(now), utc_offset)
+        return utc_offset
+
+    @staticmethod
+    def _next_utc_offset_change(timestamp):
+        seconds_in_day = 24 * 60 * 60
+        utc_offset = time.localtime(timestamp).tm_gmtoff
+        # Find the day of the transition and then its second.
+        for day in range(1, 367):
+            if time.localtime(timestamp + day * seconds_in_day).tm_gmtoff != utc_offset:
+                (low, high) = (timestamp + (day - 1) * seconds_in_day, timestamp + day * seconds_in_day)
+                while high - low > 1:
+                    middle = (low + high) // 2
+                    if time.localtime(middle).tm_gmtoff == utc_offset:
+                        low = middle
+                    else:
+                        high = middle
+                return high
+        return timestamp + 366 * seconds_in_day
 
     def get_calculation_interval(self, interval):
         ''' Get a the calculation_interval for an interval. '''
@@ -168,12 +223,19 @@ class TimeSpanProvider:
         return self._adjust_timespan(self.alltime, timestamp, timespan, offset)
 
     def _last_n_days(self, days, timestamp):
-        return TimeSpan(time.mktime((datetime.date.fromtimestamp(timestamp) - datetime.timedelta(days=days)).timetuple()), timestamp)
+        (quarter_hour, seconds) = divmod(timestamp, self.boundary_interval)
+        memo = self.day_starts.get(days)
+        if memo is not None and memo[0] == quarter_hour and seconds != 0:
+            return TimeSpan(memo[1], timestamp)
+
+        start = time.mktime((datetime.date.fromtimestamp(timestamp) - datetime.timedelta(days=days)).timetuple())
+        self.day_starts[days] = (quarter_hour, start)
+        return TimeSpan(start, timestamp)
 
     def _adjust_timespan(self, create_timespan, timestamp, timespan, offset):
         seconds_in_day = 24 * 60 * 60
         offset_seconds = offset * 3600
-        utc_offset = int((datetime.datetime.now().astimezone().utcoffset().seconds - seconds_in_day) / 3600)
+        utc_offset = int(self.utc_offset() / 3600)
         current_hour = int((timestamp % 86400) // 3600)
 
         if current_hour + utc_offset >= offset:
@@ -186,6 +248,259 @@ class TimeSpanProvider:
         # And now adjust it with the offset
         return weeutil.weeutil.TimeSpan(adjusted_timespan.start + offset_seconds, adjusted_timespan.stop + offset_seconds)
 
+class AggregateQuery:
+    ''' Calculate several aggregates over a timespan.
+        The sum, count, avg, min and max of the observations in the archive table are calculated with one query,
+        using the daily summaries when the timespan is whole days. The others, such as derived types, are calculated by WeeWX.
+        The wsum and sumtime, the sum weighted by the archive interval in seconds and the sum of the weights, seed averages. '''
+    aggregations = ['sum', 'count', 'avg', 'min', 'max', 'wsum', 'sumtime']
+
+    archive_sql = {
+        'sum': "SUM(%s)",
+        'count': "COUNT(%s)",
+        'avg': "AVG(%s)",
+        'min': "MIN(%s)",
+        'max': "MAX(%s)",
+        'wsum': "SUM(%s * `interval` * 60)",
+        'sumtime': "SUM(CASE WHEN %s IS NOT NULL THEN `interval` * 60 END)",
+    }
+
+    daily_summary_sql = "SELECT '%(observation)s', MIN(min), MAX(max), SUM(sum), SUM(count), SUM(wsum), SUM(sumtime) " \
+                        "FROM %(table_name)s_day_%(observation)s WHERE dateTime >= %(start)s AND dateTime < %(stop)s"
+
+    @staticmethod
+    def get_aggregates(aggregates, time_span, db_manager):
+        ''' Calculate the (observation, aggregation) aggregates.
+            Returns the ValueTuple of each aggregate calculated and the exception of each one that could not be. '''
+        values = {}
+        failures = {}
+
+        batched = [aggregate for aggregate in aggregates
+                   if aggregate[1] in AggregateQuery.aggregations and aggregate[0] in (db_manager.sqlkeys or [])]
+        if batched:
+            try:
+                if AggregateQuery.is_whole_days(time_span, db_manager):
+                    daily_summaries = [aggregate for aggregate in batched if aggregate[0] in (db_manager.daykeys or [])]
+                    values.update(AggregateQuery.query_daily_summaries(daily_summaries, time_span, db_manager))
+                    batched = [aggregate for aggregate in batched if aggregate not in daily_summaries]
+                values.update(AggregateQuery.query_archive(batched, time_span, db_manager))
+            except weedb.DatabaseError:
+                # WeeWX calculates them one at a time, reporting any error.
+                values = {}
+
+        for aggregate in aggregates:
+            if aggregate in values:
+                continue
+            try:
+                values[aggregate] = weewx.xtypes.get_aggregate(aggregate[0], time_span, aggregate[1], db_manager)
+            except (weewx.CannotCalculate, weewx.UnknownAggregation, weewx.UnknownType) as exception:
+                failures[aggregate] = exception
+
+        return (values, failures)
+
+    @staticmethod
+    def is_whole_days(time_span, db_manager):
+        ''' Whether the daily summaries can be used, the same check that WeeWX makes. '''
+        if db_manager.first_timestamp is None or db_manager.last_timestamp is None:
+            return False
+        return (isStartOfDay(time_span.start) or time_span.start == db_manager.first_timestamp) \
+            and (isStartOfDay(time_span.stop) or time_span.stop == db_manager.last_timestamp)
+
+    @staticmethod
+    def query_archive(aggregates, time_span, db_manager):
+        ''' Calculate the aggregates from the archive table. '''
+        if not aggregates:
+            return {}
+
+        columns = ', '.join(AggregateQuery.archive_sql[aggregation] % observation for (observation, aggregation) in aggregates)
+        row = db_manager.getSql(f"SELECT {columns} FROM {db_manager.table_name} WHERE dateTime > ? AND dateTime <= ?",
+                                (time_span.start, time_span.stop))
+        if row is None:
+            row = [None] * len(aggregates)
+
+        return {(observation, aggregation): AggregateQuery.value_tuple(observation, aggregation, value, db_manager)
+                for ((observation, aggregation), value) in zip(aggregates, row)}
+
+    @staticmethod
+    def query_daily_summaries(aggregates, time_span, db_manager):
+        ''' Calculate the aggregates from the daily summaries, one row for each observation. '''
+        if not aggregates:
+            return {}
+
+        observations = sorted({observation for (observation, _) in aggregates})
+        select_stmt = ' UNION ALL '.join(AggregateQuery.daily_summary_sql % {'observation': observation,
+                                                                             'table_name': db_manager.table_name,
+                                                                             'start': startOfDay(time_span.start),
+                                                                             'stop': time_span.stop}
+                                         for observation in observations)
+        rows = {row[0]: row[1:] for row in db_manager.genSql(select_stmt)}
+
+        values = {}
+        for (observation, aggregation) in aggregates:
+            (minimum, maximum, total, count, wsum, sumtime) = rows.get(observation, [None] * 6)
+            value = {
+                'min': minimum,
+                'max': maximum,
+                'sum': total,
+                'count': int(count) if count is not None else None,
+                'avg': wsum / sumtime if wsum is not None and sumtime else None,
+                'wsum': wsum,
+                'sumtime': sumtime,
+            }[aggregation]
+            values[(observation, aggregation)] = AggregateQuery.value_tuple(observation, aggregation, value, db_manager)
+
+        return values
+
+    @staticmethod
+    def value_tuple(observation, aggregation, value, db_manager):
+        ''' The value, with the unit and unit group of the aggregate. '''
+        (unit, unit_group) = weewx.units.getStandardUnitType(db_manager.std_unit_system, observation, aggregation)
+        return weewx.units.ValueTuple(value, unit, unit_group)
+
+class AggregateState:
+    ''' The running aggregate of an observation over a timespan.
+        It is seeded once from the database and then updated from each archive record.
+        As in WeeWX, the average of whole days is weighted by the archive interval, otherwise it is the mean of the records. '''
+    # The aggregations that can be updated one archive record at a time.
+    aggregations = ['sum', 'min', 'max', 'count', 'avg']
+    # The aggregations queried to seed each aggregation.
+    seed_aggregations = {
+        'sum': ['sum'],
+        'min': ['min'],
+        'max': ['max'],
+        'count': ['count'],
+        'avg': ['sum', 'count', 'wsum', 'sumtime'],
+    }
+
+    def __init__(self, observation, aggregation, timespan):
+        self.observation = observation
+        self.aggregation = aggregation
+        self.timespan = timespan
+        self.sum = None
+        self.min = None
+        self.max = None
+        self.count = 0
+        self.wsum = None
+        self.sumtime = 0
+        # Whether the average is weighted, WeeWX calculates it from the daily summaries.
+        self.weighted = False
+        self.unit_group = None
+        # The time of the newest archive record in the aggregate.
+        self.last_time = None
+
+    def seed(self, db_manager):
+        ''' Aggregate the archive records already in the database. '''
+        self.last_time = db_manager.lastGoodStamp()
+        self.weighted = AggregateQuery.is_whole_days(self.timespan, db_manager)
+        aggregates = [(self.observation, aggregation) for aggregation in self.seed_aggregations[self.aggregation]]
+        (values, failures) = AggregateQuery.get_aggregates(aggregates, self.timespan, db_manager)
+        if failures:
+            raise next(iter(failures.values()))
+        for (_, aggregation) in aggregates:
+            (value, _, unit_group) = values[(self.observation, aggregation)]
+            setattr(self, aggregation, value if aggregation not in ('count', 'sumtime') else to_int(value) or 0)
+            # The unit group of an average is the unit group of its sum.
+            if self.unit_group is None:
+                self.unit_group = unit_group
+
+    def add(self, time_stamp, value, interval):
+        ''' Add the value of an archive record, of interval minutes. '''
+        self.last_time = time_stamp
+        if value is None:
+            return
+        self.sum = value if self.sum is None else self.sum + value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.count += 1
+        weight = interval * 60
+        self.wsum = value * weight if self.wsum is None else self.wsum + value * weight
+        self.sumtime += weight
+
+    @property
+    def value(self):
+        ''' The aggregate value. '''
+        if self.aggregation == 'avg' and self.weighted:
+            return self.wsum / self.sumtime if self.sumtime and self.wsum is not None else None
+        if self.aggregation == 'avg':
+            return self.sum / self.count if self.count and self.sum is not None else None
+        return getattr(self, self.aggregation)
+
+class AggregateCache:
+    ''' The aggregate values calculated from the database, shared by all the topics of a plugin.
+        The key is (observation, aggregation, timespan start, timespan stop, data binding).
+        The worker thread fills it, while the publishing thread reads it. '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, now):
+        ''' The cached (value, unit, unit group), None when it is not cached or has expired. '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= now:
+                return None
+            return entry[0]
+
+    def put(self, key, aggregate_value_tuple, expires):
+        ''' Cache the (value, unit, unit group) until expires. '''
+        with self.lock:
+            self.entries[key] = (aggregate_value_tuple, expires)
+
+    def invalidate(self, data_binding, time_stamp, now):
+        ''' Remove the expired aggregates,
+            and the aggregates of the data binding whose timespan has the archive record at time_stamp. '''
+        with self.lock:
+            for key in [key for key, (_, expires) in self.entries.items()
+                        if expires <= now or (key[4] == data_binding and key[2] < time_stamp <= key[3])]:
+                del self.entries[key]
+
+class AggregateWorker(threading.Thread):
+    ''' Calculate aggregates from the database on its own thread, with its own database connection,
+        so that a slow query does not hold up publishing. '''
+    def __init__(self, logger, manager_dict):
+        super().__init__(name='MQTTAggregateValues', daemon=True)
+        self.logger = logger
+        self.manager_dict = manager_dict
+        self.condition = threading.Condition()
+        # The jobs waiting to run, by key: (time to run, job).
+        self.jobs = {}
+        self.running = True
+
+    def schedule(self, key, job, run_at=0):
+        ''' Run job(db_manager) at run_at. A job with the same key that runs earlier is kept. '''
+        with self.condition:
+            if key in self.jobs and self.jobs[key][0] <= run_at:
+                return
+            self.jobs[key] = (run_at, job)
+            self.condition.notify()
+
+    def stop(self):
+        ''' Stop the worker, once the job running has finished. '''
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.join(5)
+
+    def _next_jobs(self):
+        with self.condition:
+            while self.running:
+                now = time.time()
+                due = [key for key, (run_at, _) in self.jobs.items() if run_at <= now]
+                if due:
+                    return [self.jobs.pop(key)[1] for key in due]
+                self.condition.wait(min(run_at for (run_at, _) in self.jobs.values()) - now if self.jobs else None)
+            return []
+
+    def run(self):
+        with weewx.manager.open_manager(self.manager_dict) as db_manager:
+            while self.running:
+                for job in self._next_jobs():
+                    try:
+                        job(db_manager)
+                    except Exception as exception:  # want to catch all pylint: disable=broad-exception-caught
+                        self.logger.logerr(f"Aggregation failed: {exception}")
+                        self.logger.logerr(traceback.format_exc())
+
 class MQTTAggregateValues:
     """ Calculate aggregate values. """
     def __init__(self, logger, name, plugin_dict, _mqtt_dict, _topics, weewx_dict):
@@ -200,12 +515,33 @@ class MQTTAggregateValues:
 
         self.offset = to_int(plugin_dict.get('offset'))
         self.db_manager = weewx.manager.open_manager(weewx_dict['manager_dict'])
+        database_dict = weewx_dict['manager_dict'].get('database_dict', {})
+        self.data_binding = (database_dict.get('database_name'), weewx_dict['manager_dict'].get('table_name'))
         self.timespan_provider = TimeSpanProvider(self.db_manager,
                                                   weewx_dict['stn_info'].week_start)
 
         self.last_calculated = {}
-
-        utc_offset = datetime.datetime.now().astimezone().utcoffset().seconds - (60 * 60 * 24)
+        # The plugin is created when the publishing thread starts, so a restarted thread does not use stale aggregates.
+        self.aggregate_cache = AggregateCache()
+        # The incrementally updated aggregates, by (observation, aggregation, period), shared by the topics.
+        self.incremental = to_bool(self.plugin_dict.get('incremental', True))
+        self.aggregate_states = {}
+        # The aggregates that could not be seeded, they are queried each calculation_interval.
+        self.not_incremental = set()
+
+        # Optionally, the aggregates are calculated by a worker thread and the callbacks use the latest calculated values.
+        self.worker = None
+        if to_bool(self.plugin_dict.get('background', False)):
+            self.worker = AggregateWorker(self.logger, weewx_dict['manager_dict'])
+            self.worker.start()
+        # The aggregates being seeded by the worker, and those it has seeded, by (observation, aggregation, period).
+        self.seeding = {}
+        self.seeded = {}
+        self.seeded_lock = threading.Lock()
+        # The recent archive records, added to the aggregates seeded by the worker that do not have them.
+        self.recent_records = collections.deque(maxlen=100)
+
+        utc_offset = self.timespan_provider.utc_offset()
         for topic in self.plugin_dict['topics']:
             self.last_calculated[topic] = {}
             for (aggregate_observation, aggregate) in self.plugin_dict['topics'][topic].items():
@@ -225,6 +561,7 @@ class MQTTAggregateValues:
                 self.last_calculated[topic][aggregate_observation] = {
                     'value': None,
                     'interval_end': None,
+                    'timespan': None,
                     'adjustment': adjustment,
                 }
 
@@ -239,49 +576,250 @@ class MQTTAggregateValues:
                     'timing': 'immediate',
                     'callback': self.update_record
                 },
+                'on_weewx_data': {
+                    'timing': 'immediate',
+                    'callback': self.on_weewx_data
+                },
+                'on_shutdown': {
+                    'timing': 'immediate',
+                    'callback': self.on_shutdown
+                },
             },
         ]
 
+    def on_shutdown(self):
+        """ Stop the worker. """
+        if self.worker is not None:
+            self.worker.stop()
+
+    def is_incremental(self, aggregate):
+        """ Whether the aggregate is updated from the archive records, instead of queried each calculation_interval. """
+        return self.incremental \
+            and aggregate['aggregation'] in AggregateState.aggregations \
+            and aggregate['period'] not in ['archive_interval', 'last24hours'] \
+            and (aggregate['observation'], aggregate['aggregation'], aggregate['period']) not in self.not_incremental
+
+    def incremental_value(self, aggregate_observation, aggregate, time_span):
+        """ The aggregate value, seeding it when its period starts. """
+        key = (aggregate['observation'], aggregate['aggregation'], aggregate['period'])
+        state = self.aggregate_states.get(key)
+        if state is None or state.timespan.start != time_span.start:
+            state = AggregateState(aggregate['observation'], aggregate['aggregation'], time_span)
+            if self.worker is not None:
+                # Until the worker has seeded it, the aggregate of the new period has no value.
+                if key not in self.seeding or self.seeding[key].timespan.start != time_span.start:
+                    self.seeding[key] = state
+                    self.worker.schedule(('seed', *key), functools.partial(self.seed, key, state))
+                self.aggregate_states.pop(key, None)
+                return None
+            try:
+                state.seed(self.db_manager)
+            except (weewx.CannotCalculate, weewx.UnknownAggregation, weewx.UnknownType) as exception:
+                self.logger.logerr(f"Aggregation failed: {exception}")
+                self.logger.logerr(traceback.format_exc())
+                self.not_incremental.add(key)
+                self.aggregate_states.pop(key, None)
+                return None
+            self.aggregate_states[key] = state
+
+        weewx.units.obs_group_dict[aggregate_observation] = state.unit_group
+        return state.value
+
+    def seed(self, key, state, db_manager):
+        """ Seed the aggregate, this runs on the worker. """
+        try:
+            state.seed(db_manager)
+        except (weewx.CannotCalculate, weewx.UnknownAggregation, weewx.UnknownType) as exception:
+            self.logger.logerr(f"Aggregation failed: {exception}")
+            self.logger.logerr(traceback.format_exc())
+            state = None
+        with self.seeded_lock:
+            self.seeded[key] = state
+
+    def collect_seeded(self):
+        """ Use the aggregates the worker has seeded, with the archive records published while it was seeding. """
+        with self.seeded_lock:
+            (seeded, self.seeded) = (self.seeded, {})
+        for key, state in seeded.items():
+            if self.seeding.get(key) is not state and state is not None:
+                # A newer period is being seeded.
+                continue
+            self.seeding.pop(key, None)
+            if state is None:
+                self.not_incremental.add(key)
+                continue
+            for record in self.recent_records:
+                self.add_record(key, state, record)
+            self.aggregate_states[key] = state
+
+    def calculate(self, aggregates, time_span, db_manager):
+        """ Calculate the aggregates, {key: (aggregate, expires)}, over the timespan and cache each one until it expires.
+            On the worker, the aggregates of the next calculation_interval are scheduled to be calculated at its start. """
+        (values, failures) = AggregateQuery.get_aggregates(list({(aggregate['observation'], aggregate['aggregation'])
+                                                                 for (aggregate, _) in aggregates.values()}),
+                                                           time_span,
+                                                           db_manager)
+        for exception in failures.values():
+            self.logger.logerr(f"Aggregation failed: {exception}")
+            self.logger.logerr(''.join(traceback.format_exception(type(exception), exception, exception.__traceback__)))
+
+        ahead = {}
+        for key, (aggregate, expires) in aggregates.items():
+            aggregate_value_tuple = values.get((aggregate['observation'], aggregate['aggregation']))
+            if self.worker is None:
+                # Without the worker, an aggregate that could not be calculated is queried again with the next record.
+                if aggregate_value_tuple is not None:
+                    self.aggregate_cache.put(key, aggregate_value_tuple, expires)
+                continue
+
+            self.aggregate_cache.put(key, aggregate_value_tuple or (None, None, None), expires)
+            # Only a timespan that ends in the future, such as the day, is the same when the next interval starts.
+            if time_span.stop > expires:
+                ahead.setdefault(expires, []).append(aggregate)
+
+        for expires, ahead_aggregates in ahead.items():
+            self.worker.schedule(('ahead', expires, *(key for key in aggregates)),
+                                 functools.partial(self.calculate_ahead, ahead_aggregates, expires),
+                                 expires)
+
+    def calculate_ahead(self, aggregates, start, db_manager):
+        """ Calculate the aggregates of the calculation_interval that starts at start, this runs on the worker. """
+        time_span_aggregates = {}
+        for aggregate in aggregates:
+            time_span = self.timespan_provider.get_timespan(aggregate['period'], start, self.offset)
+            key = (aggregate['observation'], aggregate['aggregation'], time_span.start, time_span.stop, self.data_binding)
+            time_span_aggregates.setdefault(time_span, {})[key] = (aggregate, start + aggregate['calculation_interval'])
+
+        for time_span, time_span_aggregate in time_span_aggregates.items():
+            self.calculate(time_span_aggregate, time_span, db_manager)
+
+    def add_record(self, key, state, record):
+        """ Add the archive record to the aggregate, when it is in the aggregate's timespan and not already added. """
+        time_stamp = record['dateTime']
+        if state.last_time is not None and time_stamp <= state.last_time:
+            return
+
+        (_, _, period) = key
+        record_span = self.timespan_provider.get_timespan(period, time_stamp, self.offset)
+        if record_span.start != state.timespan.start or not record_span.start < time_stamp <= record_span.stop:
+            return
+
+        state.add(time_stamp, self.to_std_unit_system(record, state.observation), record['interval'])
+
+    def on_weewx_data(self, data):
+        """ Add each archive record to the aggregates whose timespan it is in,
+            and recalculate the aggregates queried from the database whose timespan it is in. """
+        if data['type'] != 'archive':
+            return
+
+        record = data['data']
+        time_stamp = record['dateTime']
+        self.aggregate_cache.invalidate(self.data_binding, time_stamp, round(time.time()))
+        for topic_calculated in self.last_calculated.values():
+            for calculated in topic_calculated.values():
+                if calculated['timespan'] is not None and calculated['timespan'].start < time_stamp <= calculated['timespan'].stop:
+                    calculated['interval_end'] = None
+
+        if self.worker is not None:
+            self.recent_records.append(record)
+            self.collect_seeded()
+
+        for key, state in self.aggregate_states.items():
+            self.add_record(key, state, record)
+
+    def to_std_unit_system(self, record, observation):
+        """ The value of the observation in the unit system of the database.
+            A derived observation, that is not in the record, is calculated from it like WeeWX does when aggregating it. """
+        if observation not in record:
+            return self.derived_value(record, observation)
+
+        value = record[observation]
+        std_unit_system = self.db_manager.std_unit_system
+        if value is None or record.get('usUnits', std_unit_system) == std_unit_system:
+            return value
+
+        (to_unit, _) = weewx.units.getStandardUnitType(std_unit_system, observation)
+        (from_unit, from_group) = weewx.units.getStandardUnitType(record['usUnits'], observation)
+        return weewx.units.convert((value, from_unit, from_group), to_unit)[0]
+
+    def derived_value(self, record, observation):
+        """ The value of the derived observation in the unit system of the database, None when it cannot be calculated. """
+        try:
+            value_tuple = weewx.xtypes.get_scalar(observation, record, self.db_manager)
+        except (weewx.CannotCalculate, weewx.NoCalculate, weewx.UnknownType):
+            return None
+        if value_tuple[0] is None or value_tuple[2] is None:
+            return value_tuple[0]
+
+        return weewx.units.convertStd(value_tuple, self.db_manager.std_unit_system)[0]
+
     def update_record(self, _mqtt_client, topic, data, _units, _qos, _retain):
         """ Run code when MQTT record is updated. """
         now = round(time.time())
         aggregates = {}
+        # The aggregates that are due to be calculated, and those that are not cached by timespan.
+        due = []
+        queries = {}
 
         if topic not in self.plugin_dict['topics']:
             return
         aggregate_dict = self.plugin_dict['topics'][topic]
 
+        if self.worker is not None:
+            self.collect_seeded()
+
         for aggregate_observation in aggregate_dict:
             if not to_bool(aggregate_dict[aggregate_observation].get('enable', True)):
                 continue
 
-            now_adjusted = now + self.last_calculated[topic][aggregate_observation]['adjustment']
-
             time_span = self.timespan_provider.get_timespan(aggregate_dict[aggregate_observation]['period'],
                                                             data.get('dateTime', now),
                                                             self.offset)
+
+            if self.is_incremental(aggregate_dict[aggregate_observation]):
+                aggregates[aggregate_observation] = self.incremental_value(aggregate_observation,
+                                                                           aggregate_dict[aggregate_observation],
+                                                                           time_span)
+                continue
+
+            now_adjusted = now + self.last_calculated[topic][aggregate_observation]['adjustment']
             interval_end = startOfInterval(now_adjusted, aggregate_dict[aggregate_observation]['calculation_interval']) + \
                 aggregate_dict[aggregate_observation]['calculation_interval']
 
             if self.last_calculated[topic][aggregate_observation]['interval_end'] is None or \
                 interval_end > self.last_calculated[topic][aggregate_observation]['interval_end']:
-                try:
-                    aggregate_value_tuple = \
-                        weewx.xtypes.get_aggregate(aggregate_dict[aggregate_observation]['observation'],
-                                                   time_span, aggregate_dict[aggregate_observation]['aggregation'],
-                                                   self.db_manager)
-                    # ToDo: only do once?
-                    #  unit_type, group = weewx.units.getStandardUnitType(db_manager.std_unit_system, obs_type, aggregate_type)
-                    weewx.units.obs_group_dict[aggregate_observation] = aggregate_value_tuple[2]
+                # The topics with the same aggregate share the value, it is queried once per calculation_interval.
+                key = (aggregate_dict[aggregate_observation]['observation'],
+                       aggregate_dict[aggregate_observation]['aggregation'],
+                       time_span.start,
+                       time_span.stop,
+                       self.data_binding)
+                due.append((aggregate_observation, key, interval_end, time_span))
+                if self.aggregate_cache.get(key, now) is None:
+                    # The aggregates with the same timespan are calculated together.
+                    expires = interval_end - self.last_calculated[topic][aggregate_observation]['adjustment']
+                    queries.setdefault(time_span, {})[key] = (aggregate_dict[aggregate_observation], expires)
 
-                    aggregates[aggregate_observation] = aggregate_value_tuple[0]
+            aggregates[aggregate_observation] = self.last_calculated[topic][aggregate_observation]['value']
 
-                    self.last_calculated[topic][aggregate_observation]['value'] = aggregates[aggregate_observation]
-                    self.last_calculated[topic][aggregate_observation]['interval_end'] = interval_end
+        for time_span, query in queries.items():
+            if self.worker is not None:
+                # Until the worker has calculated them, the previous values are used.
+                self.worker.schedule(('query', *query), functools.partial(self.calculate, query, time_span))
+            else:
+                self.calculate(query, time_span, self.db_manager)
+
+        for (aggregate_observation, key, interval_end, time_span) in due:
+            aggregate_value_tuple = self.aggregate_cache.get(key, now)
+            if aggregate_value_tuple is not None:
+                # ToDo: only do once?
+                #  unit_type, group = weewx.units.getStandardUnitType(db_manager.std_unit_system, obs_type, aggregate_type)
+                if aggregate_value_tuple[2] is not None:
+                    weewx.units.obs_group_dict[aggregate_observation] = aggregate_value_tuple[2]
 
-                except (weewx.CannotCalculate, weewx.UnknownAggregation, weewx.UnknownType) as exception:
-                    self.logger.logerr(f"Aggregation failed: {exception}")
-                    self.logger.logerr(traceback.format_exc())
+                self.last_calculated[topic][aggregate_observation]['value'] = aggregate_value_tuple[0]
+                self.last_calculated[topic][aggregate_observation]['interval_end'] = interval_end
+                self.last_calculated[topic][aggregate_observation]['timespan'] = time_span
 
             aggregates[aggregate_observation] = self.last_calculated[topic][aggregate_observation]['value']
 
@@ -463,7 +463,7 @@ class MQTTConfigHA:
 
     def on_mqtt_message(self, client, userdata, msg):
         """ Handle the MQTT on_message callback. """
-        self.logger.logdbg(f"Received: {userdata} {msg}")
+        self.logger.logdbg("Received: %s %s", userdata, msg)
         if msg.topic == self.birth_topic and msg.payload == self.birth_payload:
             self.logger.loginf(f"Received 'birth message' {msg.payload} on topic: {msg.topic}.")
             for device_id in self.configuration['devices']:
@@ -547,4 +547,4 @@ class MQTTConfigHA:
                                                 payload,
                                                 qos=self.mqtt_config[device_id]['qos'],
                                                 retain=self.mqtt_config[device_id]['retain'])
-        self.logger.logdbg(f"publishing: {mqtt_message_info.mid} {topic} {payload}")
+        self.logger.logdbg("publishing: %s %s %s", mqtt_message_info.mid, topic, payload)
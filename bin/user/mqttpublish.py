@@ -10,19 +10,41 @@ Publish to MQTT on loop or archive creation.
 import queue as Queue
 
 import abc
-import copy
+import asyncio
+import bisect
+import collections
 import json
 import logging
 import os
 import random
+import sqlite3
 import ssl
 import sys
 import threading
 import time
+import zlib
 
 import configobj
 import paho.mqtt.client as mqtt
 
+# Optional libraries, used for faster or more compact payloads when they are installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
 # When running 'standalone' in a package install or git 'install', need to know where thw WeeWX modules are
 bin_root = os.getenv('BIN_ROOT')
 if bin_root is not None:
@@ -56,21 +78,38 @@ def setup_logging(logging_level, config_dict):
     weeutil.logger.setup('wee_MQTTSS', config_dict)
 
 class Logger:
-    ''' Manage the logging '''
+    ''' Manage the logging.
+        The optional args are only formatted into msg, %-style, when the level is enabled. '''
     def __init__(self):
         self.log = logging.getLogger(__name__)
+        self.thread_data = threading.local()
+
+    def _thread_id(self):
+        try:
+            return self.thread_data.thread_id
+        except AttributeError:
+            self.thread_data.thread_id = threading.get_native_id()
+            return self.thread_data.thread_id
+
+    def _log(self, level, msg, args):
+        if self.log.isEnabledFor(level):
+            if args:
+                self.log.log(level, "%s " + msg, self._thread_id(), *args)
+            else:
+                # Without args, msg is not a format string and may contain a '%'.
+                self.log.log(level, "%s %s", self._thread_id(), msg)
 
-    def logdbg(self, msg):
+    def logdbg(self, msg, *args):
         """ log debug messages """
-        self.log.debug("%s %s", threading.get_native_id(), msg)
+        self._log(logging.DEBUG, msg, args)
 
-    def loginf(self, msg):
+    def loginf(self, msg, *args):
         """ log informational messages """
-        self.log.info("%s %s", threading.get_native_id(), msg)
+        self._log(logging.INFO, msg, args)
 
-    def logerr(self, msg):
+    def logerr(self, msg, *args):
         """ log error messages """
-        self.log.error("%s %s", threading.get_native_id(), msg)
+        self._log(logging.ERROR, msg, args)
 
 class PluginManager():
     """ Manage the plugin callbacks. """
@@ -94,6 +133,10 @@ class PluginManager():
                 'immediate': {},
                 'delay': {}
             },
+            'on_shutdown': {
+                'immediate': {},
+                'delay': {}
+            },
         }
 
     def create_plugin(self, plugin_name, plugin_dict, mqtt_dict, topics, weewx_dict):
@@ -108,12 +151,610 @@ class PluginManager():
                 timing = callback[callback_name]['timing']
                 self.callbacks[callback_name][timing][plugin_name] = callback[callback_name]['callback']
 
+class DataQueue(Queue.Queue):
+    """ The queue of WeeWX data waiting to be published.
+        When max_size is set, the overflow_policy determines what is shed when the queue is full. """
+    overflow_policies = ['drop_oldest', 'drop_newest', 'coalesce', 'block']
+
+    def __init__(self, logger, max_size=0, overflow_policy='drop_oldest', block_timeout=1.0):
+        # The bound is enforced by 'put', so that the overflow policy can be applied.
+        super().__init__()
+        if overflow_policy not in self.overflow_policies:
+            raise ValueError(f"Invalid 'queue_overflow_policy', {overflow_policy}")
+
+        self.logger = logger
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        # The number of elements shed, by data type.
+        self.shed = {
+            'loop': 0,
+            'archive': 0,
+        }
+
+    def put(self, item, block=True, timeout=None):  # need to match pylint: disable=unused-argument
+        """ Put WeeWX data on the queue, applying the overflow policy if the queue is full. """
+        with self.not_full:
+            if 0 < self.max_size <= self._qsize():
+                if not self._overflow(item):
+                    return
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _overflow(self, item):
+        """ Apply the overflow policy. Returns True if the item should still be queued.
+            Must be called with the queue's mutex held. """
+        if self.overflow_policy == 'drop_oldest':
+            self._shed(self.queue.popleft())
+            return True
+
+        if self.overflow_policy == 'coalesce':
+            # Only the newest loop packet is kept, archive records are never dropped.
+            # The item is the newest loop packet, unless it is an archive record.
+            queued = list(self.queue)
+            newest_loop = None
+            if item['type'] != 'loop':
+                newest_loop = next((element for element in reversed(queued) if element is not None and element['type'] == 'loop'),
+                                   None)
+            self.queue.clear()
+            for element in queued:
+                if element is not None and element['type'] == 'loop' and element is not newest_loop:
+                    self._shed(element)
+                else:
+                    self.queue.append(element)
+            return True
+
+        if self.overflow_policy == 'block':
+            if self.not_full.wait_for(lambda: self._qsize() < self.max_size, self.block_timeout):
+                return True
+
+        self._shed(item)
+        return False
+
+    def get_all(self):
+        """ Remove and return all the queued elements, in one step. """
+        with self.mutex:
+            elements = list(self.queue)
+            self.queue.clear()
+            self.not_full.notify_all()
+        return elements
+
+    def wakeup(self):
+        """ Wake up the consumer blocked on 'get', regardless of the bound. """
+        with self.not_full:
+            self._put(None)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _shed(self, element):
+        if element is None:
+            return
+        self.shed[element['type']] = self.shed.get(element['type'], 0) + 1
+        self.logger.logdbg("Queue is full, %s shed %s data %s.", self.overflow_policy, element['type'], element['time_stamp'])
+
+def dumps_json(data):
+    """ Serialize the data to JSON bytes, using orjson or ujson when it is installed.
+        Their JSON is compact, and orjson does not escape non-ASCII characters and serializes NaN and infinity as null. """
+    try:
+        if orjson is not None:
+            return orjson.dumps(data)
+        if ujson is not None:
+            return ujson.dumps(data, escape_forward_slashes=False).encode('utf-8')
+    except (TypeError, OverflowError):
+        # Fall back to the standard library for what the faster libraries cannot handle.
+        pass
+    return json.dumps(data).encode('utf-8')
+
+def payload_size(payload):
+    """ The number of bytes of the payload, as it is sent. """
+    if payload is None:
+        return 0
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    return len(str(payload).encode('utf-8'))
+
+class Serializer():
+    """ Serialize the data of a topic into MQTT messages. """
+    # The optional module the serializer needs, None if it only uses the standard library.
+    requires = None
+
+    def is_available(self):
+        """ True if the module needed by the serializer is installed. """
+        return True
+
+    def serialize(self, topic, record):
+        """ Return a list of (topic, payload) tuples. """
+        raise NotImplementedError("Method 'serialize' is not implemented")
+
+class JSONSerializer(Serializer):
+    """ Serialize the data as a single JSON object. """
+    def serialize(self, topic, record):
+        return [(topic, dumps_json(record))]
+
+class KeywordSerializer(Serializer):
+    """ Serialize the data as a single message of key=value pairs. """
+    def serialize(self, topic, record):
+        return [(topic, ', '.join([f"{key}={value}" for (key, value) in record.items()]).encode('utf-8'))]
+
+class IndividualSerializer(Serializer):
+    """ Serialize each field of the data as its own message, published to topic/field. """
+    def serialize(self, topic, record):
+        messages = []
+        for key, value in record.items():
+            if isinstance(value, str):
+                payload = value.encode('utf-8')
+            elif isinstance(value, (int, float)):
+                # The same payload paho sends for a number.
+                payload = str(value).encode('utf-8')
+            elif value is None or isinstance(value, (bytes, bytearray)):
+                payload = value
+            else:
+                payload = dumps_json(value)
+            messages.append((topic + '/' + key, payload))
+        return messages
+
+class MessagePackSerializer(Serializer):
+    """ Serialize the data as a single MessagePack map. """
+    requires = 'msgpack'
+
+    def is_available(self):
+        return msgpack is not None
+
+    def serialize(self, topic, record):
+        return [(topic, msgpack.packb(record))]
+
+class CBORSerializer(Serializer):
+    """ Serialize the data as a single CBOR map. """
+    requires = 'cbor2'
+
+    def is_available(self):
+        return cbor2 is not None
+
+    def serialize(self, topic, record):
+        return [(topic, cbor2.dumps(record))]
+
+# The serializers, by the topic 'type' option.
+SERIALIZERS = {
+    'json': JSONSerializer(),
+    'keyword': KeywordSerializer(),
+    'individual': IndividualSerializer(),
+    'msgpack': MessagePackSerializer(),
+    'cbor': CBORSerializer(),
+}
+
+class Profiler():
+    """ Time the stages of publishing and keep a histogram of each stage's latency. """
+    # The upper bounds, in milliseconds, of the histogram buckets.
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf'))
+
+    def __init__(self, logger, interval):
+        self.logger = logger
+        self.interval = interval
+        self.next_summary = time.time() + interval
+        self.stages = {}
+
+    @staticmethod
+    def start():
+        """ Start timing a stage. """
+        return time.perf_counter()
+
+    def stop(self, start, stage, detail=None, end=None):
+        """ Stop timing a stage that was started at start, and ended now or at end.
+            The detail, such as the plugin name, is kept separate so that nothing is formatted while timing. """
+        elapsed = ((time.perf_counter() if end is None else end) - start) * 1000
+        key = (stage, detail)
+        stats = self.stages.get(key)
+        if stats is None:
+            stats = self.stages[key] = {'count': 0, 'total': 0.0, 'maximum': 0.0, 'histogram': [0] * len(self.buckets)}
+        stats['count'] += 1
+        stats['total'] += elapsed
+        if elapsed > stats['maximum']:
+            stats['maximum'] = elapsed
+        stats['histogram'][bisect.bisect_left(self.buckets, elapsed)] += 1
+
+    def percentile(self, stats, fraction):
+        """ The upper bound of the bucket that holds the percentile. """
+        target = stats['count'] * fraction
+        running = 0
+        for bucket, count in zip(self.buckets, stats['histogram']):
+            running += count
+            if running >= target:
+                return min(bucket, stats['maximum'])
+        return stats['maximum']
+
+    def dump(self):
+        """ The statistics of each stage, in milliseconds. """
+        summary = {}
+        for (stage, detail), stats in self.stages.items():
+            name = stage if detail is None else f"{stage} {detail}"
+            summary[name] = {
+                'count': stats['count'],
+                'mean': stats['total'] / stats['count'],
+                'p50': self.percentile(stats, 0.5),
+                'p95': self.percentile(stats, 0.95),
+                'maximum': stats['maximum'],
+            }
+        return summary
+
+    def log_summary(self):
+        """ Log a summary line per stage. """
+        for name, stats in self.dump().items():
+            self.logger.loginf((f"profile: {name} count {stats['count']} mean {stats['mean']:.2f} ms "
+                                f"p50 {stats['p50']:.2f} ms p95 {stats['p95']:.2f} ms maximum {stats['maximum']:.2f} ms"))
+
+    def log_if_due(self):
+        """ Log the summary every 'interval' seconds. """
+        if self.interval and time.time() >= self.next_summary:
+            self.next_summary = time.time() + self.interval
+            self.log_summary()
+
+class NullProfiler(Profiler):
+    """ The profiler used when profiling is not enabled, it does nothing. """
+    def __init__(self):  # pylint: disable=super-init-not-called
+        self.stages = {}
+
+    @staticmethod
+    def start():
+        return 0
+
+    def stop(self, start, stage, detail=None, end=None):
+        return
+
+    def log_summary(self):
+        return
+
+    def log_if_due(self):
+        return
+
+class Metrics():
+    """ Counters of the publishing health and throughput.
+        They are kept by the service, so that they survive a restart of the publishing thread. """
+    def __init__(self, logger, metrics_dict):
+        self.logger = logger
+        self.started = time.time()
+
+        self.records = collections.Counter()
+        self.topic_messages = collections.Counter()
+        self.messages = 0
+        self.bytes = 0
+        self.suppressed_fields = 0
+        self.interval_skips = 0
+        self.thread_restarts = 0
+
+        self.enable = metrics_dict is not None and to_bool(metrics_dict.get('enable', True))
+        metrics_dict = metrics_dict or {}
+        self.topic = metrics_dict.get('topic', 'mqttpublish/metrics')
+        self.interval = to_int(metrics_dict.get('interval', 60))
+        self.qos = to_int(metrics_dict.get('qos', 0))
+        self.retain = to_bool(metrics_dict.get('retain', False))
+        self.prometheus_file = metrics_dict.get('prometheus_file')
+        self.next_publish = time.time() + self.interval
+        self.last_snapshot = (self.started, 0)
+
+    def due(self):
+        """ True when it is time to publish the metrics. """
+        if not self.enable or time.time() < self.next_publish:
+            return False
+        self.next_publish = time.time() + self.interval
+        return True
+
+    def records_per_second(self, now):
+        """ The records published per second since the previous call. """
+        (last_time, last_count) = self.last_snapshot
+        count = sum(self.records.values())
+        self.last_snapshot = (now, count)
+        if now <= last_time:
+            return 0.0
+        return (count - last_count) / (now - last_time)
+
+    @staticmethod
+    def to_prometheus(snapshot):
+        """ Format the snapshot in the Prometheus text exposition format. """
+        lines = []
+
+        def escape(label):
+            # The label value escapes of the text format.
+            return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def add(name, metric_type, value, labels=None):
+            label_text = ''
+            if labels:
+                label_text = '{' + ','.join(f'{key}="{escape(label)}"' for key, label in labels.items()) + '}'
+            if not lines or lines[-1].split('{')[0].split(' ')[0] != f'mqttpublish_{name}':
+                lines.append(f'# TYPE mqttpublish_{name} {metric_type}')
+            lines.append(f'mqttpublish_{name}{label_text} {value}')
+
+        add('uptime_seconds', 'gauge', snapshot['uptime'])
+        add('queue_depth', 'gauge', snapshot['queue_depth'])
+        for data_type, count in snapshot['queue_shed'].items():
+            add('queue_shed_total', 'counter', count, {'type': data_type})
+        for data_type, count in snapshot['records'].items():
+            add('records_total', 'counter', count, {'type': data_type})
+        add('records_per_second', 'gauge', snapshot['records_per_second'])
+        add('messages_total', 'counter', snapshot['messages'])
+        add('bytes_total', 'counter', snapshot['bytes'])
+        for topic, count in snapshot['topics'].items():
+            add('topic_messages_total', 'counter', count, {'topic': topic})
+        add('publish_latency_average_ms', 'gauge', snapshot['publish_latency']['average'])
+        add('publish_latency_maximum_ms', 'gauge', snapshot['publish_latency']['maximum'])
+        add('connects_total', 'counter', snapshot['connects'])
+        add('connections_connected', 'gauge', sum(snapshot['connections']))
+        add('inflight_messages', 'gauge', snapshot['inflight'])
+        add('inflight_timeouts_total', 'counter', snapshot['inflight_timeouts'])
+        for name, stats in snapshot['ack_latency'].items():
+            add('ack_latency_p95_ms', 'gauge', stats['p95'], {'qos': name.split(' ')[-1]})
+        for broker, stats in snapshot['brokers'].items():
+            add('broker_connected', 'gauge', int(stats['connected']), {'broker': broker})
+            add('broker_queue_depth', 'gauge', stats['queue_depth'], {'broker': broker})
+            add('broker_messages_total', 'counter', stats['messages'], {'broker': broker})
+        add('thread_restarts_total', 'counter', snapshot['thread_restarts'])
+        add('suppressed_fields_total', 'counter', snapshot['suppressed_fields'])
+        add('interval_skips_total', 'counter', snapshot['interval_skips'])
+        if snapshot['spool'] is not None:
+            add('spool_messages', 'gauge', snapshot['spool'])
+        if snapshot['rate_limit'] is not None:
+            add('rate_limit_pending', 'gauge', snapshot['rate_limit']['pending'])
+            add('rate_limit_replaced_total', 'counter', snapshot['rate_limit']['replaced'])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, snapshot):
+        """ Write the Prometheus file, atomically so that a reader never sees a partial file. """
+        temporary_file = f'{self.prometheus_file}.tmp'
+        try:
+            with open(temporary_file, 'w', encoding='utf-8') as file:
+                file.write(self.to_prometheus(snapshot))
+            os.replace(temporary_file, self.prometheus_file)
+        except OSError as exception:
+            self.logger.logerr(f"Writing {self.prometheus_file} failed with {type(exception)} and reason {exception}.")
+
+class Spool():
+    """ A SQLite store of serialized messages, used while the broker is unreachable.
+        The messages are replayed in the order they were spooled. """
+    def __init__(self, logger, path, max_messages):
+        self.logger = logger
+        self.max_messages = max_messages
+        # The spool is compacted to 90% of 'max_messages', so that it is not compacted on every append once it is full.
+        self.low_water = max_messages - max_messages // 10
+        # The number of messages dropped to keep the spool within 'max_messages'.
+        self.dropped = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS messages ("
+                                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                "time_stamp REAL, data_type TEXT, topic TEXT, payload BLOB, qos INTEGER, retain INTEGER, "
+                                "options TEXT)")
+        self.connection.commit()
+        self.count = self.connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        self.logger.loginf(f"Spool {path} has {self.count} messages.")
+
+    def append(self, time_stamp, data_type, messages):
+        """ Spool the messages, a list of (topic, payload, qos, retain, options), of a record. """
+        with self.connection:
+            self.connection.executemany("INSERT INTO messages (time_stamp, data_type, topic, payload, qos, retain, options) "
+                                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [(time_stamp, data_type, topic, payload, qos, retain,
+                                          json.dumps(options) if options else None)
+                                         for (topic, payload, qos, retain, options) in messages])
+        self.count += len(messages)
+        if self.count > self.max_messages:
+            self.compact()
+
+    def compact(self):
+        """ Bring the spool back to 90% of 'max_messages'.
+            First retained loop messages that a newer retained loop message on the same topic replaces are removed.
+            Then the oldest loop messages, and only then the oldest archive messages, are dropped. """
+        with self.connection:
+            self.connection.execute("DELETE FROM messages WHERE data_type = 'loop' AND retain AND id NOT IN "
+                                    "(SELECT MAX(id) FROM messages WHERE data_type = 'loop' AND retain GROUP BY topic)")
+            count = self.connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            for data_type in ('loop', 'archive'):
+                if count <= self.low_water:
+                    break
+                cursor = self.connection.execute("DELETE FROM messages WHERE id IN "
+                                                 "(SELECT id FROM messages WHERE data_type = ? ORDER BY id LIMIT ?)",
+                                                 (data_type, count - self.low_water))
+                count -= cursor.rowcount
+                self.dropped += cursor.rowcount
+                self.logger.logerr(f"Spool is full, dropped {cursor.rowcount} {data_type} messages.")
+        self.logger.logdbg("Compacted spool from %s to %s messages.", self.count, count)
+        self.count = count
+
+    def peek(self, limit, after_id=0):
+        """ The oldest messages after after_id, as a list of (id, time_stamp, topic, payload, qos, retain, options). """
+        rows = self.connection.execute("SELECT id, time_stamp, topic, payload, qos, retain, options FROM messages "
+                                       "WHERE id > ? ORDER BY id LIMIT ?",
+                                       (after_id, limit)).fetchall()
+        return [(*row[:6], json.loads(row[6]) if row[6] else None) for row in rows]
+
+    def remove(self, last_id):
+        """ Remove the messages up to and including last_id, once they have been acknowledged. """
+        with self.connection:
+            cursor = self.connection.execute("DELETE FROM messages WHERE id <= ?", (last_id,))
+        self.count -= cursor.rowcount
+
+    def close(self):
+        """ Close the spool. """
+        self.connection.close()
+
+class TopicRing():
+    """ Assign topics to connections by consistent hashing.
+        A topic is always published on the same connection, so its messages stay in order. """
+    def __init__(self, connections, replicas=100):
+        self.connections = connections
+        # Each connection has many points on the ring, so that the topics are spread evenly.
+        ring = sorted((zlib.crc32(f'{connection}-{replica}'.encode('utf-8')), connection)
+                      for connection in range(connections)
+                      for replica in range(replicas))
+        self.hashes = [point for (point, _) in ring]
+        self.ring = [connection for (_, connection) in ring]
+        self.assigned = {}
+
+    def get(self, topic):
+        """ The index of the connection that publishes the topic. """
+        connection = self.assigned.get(topic)
+        if connection is None:
+            index = bisect.bisect(self.hashes, zlib.crc32(topic.encode('utf-8'))) % len(self.hashes)
+            connection = self.assigned[topic] = self.ring[index]
+        return connection
+
+class TokenBucket():
+    """ A token bucket, filled at rate tokens per second up to one second's worth. """
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait(self, amount, now):
+        """ The seconds until amount can be taken.
+            An amount larger than the bucket can be taken once it is full, leaving the bucket in debt. """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount):
+        """ Take amount from the bucket. """
+        self.tokens -= amount
+
+class RateLimiter():
+    """ Shape the messages of a connection to its 'connection_message_rate' and 'connection_byte_rate',
+        and the messages of each topic to the topic's 'message_rate' and 'byte_rate'.
+        A message that cannot be published yet waits, by its MQTT topic.
+        The message of a loop packet is replaced by a newer loop packet's message to the same MQTT topic,
+        the message of an archive record is never replaced. """
+    def __init__(self, publisher, message_rate, byte_rate, topic_buckets):
+        self.publisher = publisher
+        self.buckets = self.create_buckets(message_rate, byte_rate)
+        # The buckets of the topics, shared by the connections to a broker.
+        self.topic_buckets = topic_buckets
+        # The messages waiting to be published, by (MQTT topic, None for a loop packet or the archive record's time stamp),
+        # in the order they were first queued.
+        self.pending = {}
+        self.replaced = 0
+
+    @classmethod
+    def create(cls, publisher, mqtt_config, topic_buckets):
+        """ The rate limiter of the publisher's connection, None when there are no limits. """
+        message_rate = mqtt_config.get('connection_message_rate', 0)
+        byte_rate = mqtt_config.get('connection_byte_rate', 0)
+        if not message_rate and not byte_rate and not topic_buckets:
+            return None
+        return cls(publisher, message_rate, byte_rate, topic_buckets)
+
+    @staticmethod
+    def create_buckets(message_rate, byte_rate):
+        """ The message and the byte bucket, None when that rate is not limited. """
+        return (TokenBucket(message_rate) if message_rate else None, TokenBucket(byte_rate) if byte_rate else None)
+
+    @classmethod
+    def create_topic_buckets(cls, topic_rates):
+        """ The buckets of each topic with a 'message_rate' or 'byte_rate'. """
+        return {topic: cls.create_buckets(message_rate, byte_rate) for topic, (message_rate, byte_rate) in topic_rates.items()}
+
+    @staticmethod
+    def _wait(buckets, size, now):
+        (message_bucket, byte_bucket) = buckets
+        wait = 0
+        if message_bucket is not None:
+            wait = message_bucket.wait(1, now)
+        if byte_bucket is not None:
+            wait = max(wait, byte_bucket.wait(size, now))
+        return wait
+
+    @staticmethod
+    def _take(buckets, size):
+        (message_bucket, byte_bucket) = buckets
+        if message_bucket is not None:
+            message_bucket.take(1)
+        if byte_bucket is not None:
+            byte_bucket.take(size)
+
+    def submit(self, topic, data_type, time_stamp, qos, retain, message_topic, payload, options):
+        """ Queue the message of topic, a loop packet's message replaces the queued loop packet's message to the same MQTT topic. """
+        key = (message_topic, None if data_type == 'loop' else time_stamp)
+        if key in self.pending:
+            self.replaced += 1
+        self.pending[key] = (topic, time_stamp, qos, retain, payload, options)
+
+    def flush(self):
+        """ Publish the queued messages that are within the rates.
+            Returns the message infos and the seconds until the next message can be published, None when none are queued. """
+        message_infos = []
+        wait = None
+        now = time.monotonic()
+        for key in list(self.pending):
+            # The messages wait for the connection, rather than publishing waiting for it to reconnect.
+            if not self.publisher.connected:
+                break
+            (topic, time_stamp, qos, retain, payload, options) = self.pending[key]
+            (message_topic, _) = key
+            size = payload_size(payload)
+
+            # When the connection is out of tokens, no more messages can be published.
+            connection_wait = self._wait(self.buckets, size, now)
+            if connection_wait:
+                wait = connection_wait if wait is None else min(wait, connection_wait)
+                break
+
+            # A topic out of tokens does not hold up the other topics.
+            topic_buckets = self.topic_buckets.get(topic)
+            if topic_buckets is not None:
+                topic_wait = self._wait(topic_buckets, size, now)
+                if topic_wait:
+                    wait = topic_wait if wait is None else min(wait, topic_wait)
+                    continue
+                self._take(topic_buckets, size)
+            self._take(self.buckets, size)
+
+            del self.pending[key]
+            message_infos.append(self.publisher.publish_message(time_stamp, qos, retain, message_topic, payload, options))
+
+        return message_infos, wait
+
+    def log_summary(self):
+        """ Log the messages that were replaced and that were not published. """
+        if self.replaced:
+            self.publisher.logger.loginf(f"Replaced {self.replaced} rate limited messages with newer ones.")
+        if self.pending:
+            self.publisher.logger.logerr(f"{len(self.pending)} rate limited messages were not published.")
+
 class AbstractPublisher(abc.ABC):
     """ Managing publishing to MQTT. """
     def __init__(self, logger, plugin_manager, publisher, mqtt_config):
         self.logger = logger
         self.plugin_manager = plugin_manager
-        self.connected = False
+        self.connection_condition = threading.Condition()
+        self.connection_state = 'disconnected'
+        self.connection_attempts = 0
+        self.connection_thread = None
+        # The number of successful connections.
+        self.connects = 0
+
+        # The messages waiting for on_publish, by mid: (topic, time published, qos, time_stamp).
+        # on_publish can run before publish returns the mid, those acknowledgements wait in early_acks.
+        # Both are in time order, and are pruned of the entries older than 'inflight_timeout' on every publish and acknowledgement.
+        self.inflight = {}
+        self.early_acks = {}
+        # The number of publish_message calls waiting for client.publish to return.
+        self.publishing = 0
+        # The number of qos 1 and 2 messages in flight, limited by 'max_inflight'.
+        self.inflight_pending = 0
+        self.inflight_timeouts = 0
+        self.inflight_condition = threading.Condition()
+        self.ack_latency = Profiler(logger, 0)
+        spool_dict = mqtt_config.get('spool')
+        self.spooling = spool_dict is not None and to_bool(spool_dict.get('enable', True))
+        # When spooling, the data is safe on disk, so keep trying to connect.
+        # The owner also sets it when the messages wait in a queue of their own, without holding up the WeeWX data.
+        self.keep_connecting = self.spooling
         self.mqtt_logger = {
             mqtt.MQTT_LOG_INFO: self.logger.loginf,
             mqtt.MQTT_LOG_NOTICE: self.logger.loginf,
@@ -144,77 +785,134 @@ class AbstractPublisher(abc.ABC):
             self.logger.loginf(f"Enabling LWT: topic: {topic}, payload: {payload}, qos: {qos}, retain: {retain}")
             self.client.will_set(topic=topic, payload=payload, qos=qos, retain=retain)
 
-        self._connect()
+    @property
+    def connected(self):
+        """ True when connected to the broker. """
+        return self.connection_state == 'connected'
+
+    @connected.setter
+    def connected(self, value):
+        if value:
+            self.connection_attempts = 0
+            self.connects += 1
+        self._set_connection_state('connected' if value else 'disconnected')
+
+    def _set_connection_state(self, state):
+        with self.connection_condition:
+            # Once stopped, the callbacks from the final disconnect must not restart the connection processing.
+            if self.connection_state != 'stopped':
+                self.connection_state = state
+            self.connection_condition.notify_all()
 
     @classmethod
     def get_publisher(cls, logger, plugin_manager, publisher, mqtt_config):
-        ''' Factory method to get appropriate MQTTPublish for paho mqtt version. '''
+        ''' Factory method to get appropriate MQTTPublish for paho mqtt version and network loop. '''
+        use_asyncio = mqtt_config.get('network_loop', 'thread') == 'asyncio'
         if hasattr(mqtt, 'CallbackAPIVersion'):
             protocol = mqtt_config['protocol']
             if protocol in [mqtt.MQTTv31, mqtt.MQTTv311]:
+                if use_asyncio:
+                    return AsyncioPublisherV2MQTT3(logger, plugin_manager, publisher, mqtt_config)
                 return PublisherV2MQTT3(logger, plugin_manager, publisher, mqtt_config)
 
+            if use_asyncio:
+                return AsyncioPublisherV2(logger, plugin_manager, publisher, mqtt_config)
             return PublisherV2(logger, plugin_manager, publisher, mqtt_config)
 
+        if use_asyncio:
+            return AsyncioPublisherV1(logger, plugin_manager, publisher, mqtt_config)
         return PublisherV1(logger, plugin_manager, publisher, mqtt_config)
 
+    def retry_delay(self, attempt):
+        """ The seconds to wait before a connection attempt.
+            The delay doubles with each attempt, up to 'wait_between_retries'.
+            It is randomized so that many clients do not reconnect in lockstep. """
+        delay = min(self.mqtt_config['wait_between_retries'], 2 ** min(attempt - 1, 16))
+        return random.uniform(delay / 2, delay)
+
+    def _manage_connection(self):
+        """ Connect and reconnect to the broker, this runs on its own thread.
+            The states are: connecting -> connected -> disconnected -> connecting ...
+            Until it is stopped or 'max_retries' attempts in a row have failed. """
+        while True:
+            with self.connection_condition:
+                self.connection_condition.wait_for(lambda: self.connection_state in ('disconnected', 'stopped'))
+                if self.connection_state == 'stopped':
+                    return
+                attempt = self.connection_attempts
+                self.connection_attempts += 1
+
+            if attempt > self.mqtt_config['max_retries'] and not self.keep_connecting:
+                self.logger.logerr(f"Unable to connect after {attempt} attempts.")
+                self._set_connection_state('failed')
+                return
+
+            if attempt:
+                delay = self.retry_delay(attempt)
+                self.logger.loginf(f"Waiting {delay:.1f} seconds to connect.")
+                with self.connection_condition:
+                    if self.connection_condition.wait_for(lambda: self.connection_state == 'stopped', delay):
+                        return
+
+            self._connect()
+
     def _connect(self):
+        """ Make one attempt to connect.
+            The outcome is reported by the on_connect and on_disconnect callbacks. """
         self.logger.loginf(f"Connecting to host: {self.mqtt_config['host']} port: {self.mqtt_config['port']}.")
+        # The network thread of a lost connection exits, but it still needs to be joined.
+        self.client.loop_stop()
+        self._set_connection_state('connecting')
         try:
             self.connect(self.mqtt_config['host'], self.mqtt_config['port'], self.mqtt_config['keepalive'])
         except Exception as exception:  # want to catch all pylint: disable=broad-exception-caught
             self.logger.logerr(f"MQTT connect failed with {type(exception)} and reason {exception}.")
-        retries = 0
-        # Give the connection logic some time to execute
-        time.sleep(self.mqtt_config['wait_for_connection'])
-        # Allow the MQTT processing to happen, after allowing the connection processing to complete.
-        self.client.loop(timeout=0.1)
-        while not self.connected and self.publisher.process:
-            self.logger.loginf(f"Waiting {self.mqtt_config['wait_between_retries']} seconds to connect.")
-            # loop seems to break before connect, perhaps due to logging
-            self.client.loop(timeout=0.1)
-            time.sleep(self.mqtt_config['wait_between_retries'])
-
-            retries += 1
-            if retries > self.mqtt_config['max_retries']:
-                # Shut thread down, a bit of a hack
-                self.publisher.process = False
-                return
+            self._set_connection_state('disconnected')
+            return
 
-            try:
-                self.connect(self.mqtt_config['host'], self.mqtt_config['port'], self.mqtt_config['keepalive'])
-                time.sleep(self.mqtt_config['wait_for_connection'])
-                self.client.loop(timeout=.1)
-                self.logger.logdbg("After retrying connect call.")
-            except Exception as exception:  # want to catch all pylint: disable=broad-exception-caught
-                self.logger.logerr(f"MQTT connect retry {retries} failed with {type(exception)} and reason {exception}.")
+        # The paho network thread handles keepalive, inbound messages, and outbound messages.
+        self.client.loop_start()
 
-    def _reconnect(self):
-        self.logger.loginf(f"Attempting to reconnect to host: {self.mqtt_config['host']} port: {self.mqtt_config['port']}.")
-        try:
-            self.client.reconnect()
-        except Exception as exception:  # want to catch all pylint: disable=broad-exception-caught
-            self.logger.logerr(f"MQTT reconnect failed with {type(exception)} and reason {exception}.")
-        self.logger.logdbg("After reconnect call.")
-        retries = 0
-        time.sleep(self.mqtt_config['wait_for_connection'])
-        self.client.loop(timeout=0.1)
-        while not self.connected and self.publisher.process:
-            self.logger.loginf(f"Waiting {self.mqtt_config['wait_between_retries']} seconds to (re)connect.")
-            self.client.loop(timeout=0.1)
-            time.sleep(self.mqtt_config['wait_between_retries'])
-
-            retries += 1
-            if retries > self.mqtt_config['max_retries']:
+    def wait_for_connection(self, timeout):
+        """ Wait for the connection to the broker.
+            Returns True if connected within the timeout, raises CannotConnectError when connecting has been given up. """
+        with self.connection_condition:
+            self.connection_condition.wait_for(lambda: self.connection_state in ('connected', 'failed', 'stopped'), timeout)
+            if self.connection_state == 'failed':
                 raise CannotConnectError
+            return self.connection_state == 'connected'
 
-            try:
-                self.client.reconnect()
-                time.sleep(self.mqtt_config['wait_for_connection'])
-                self.client.loop(timeout=.1)
-                self.logger.logdbg("After retrying reconnect call.")
-            except Exception as exception:  # want to catch all pylint: disable=broad-exception-caught
-                self.logger.logerr(f"MQTT reconnect {retries} failed with {type(exception)} and reason {exception}.")
+    def _reconnect(self):
+        # The connection is managed on its own thread, so wait for it to reconnect or to give up.
+        self.logger.loginf(f"Waiting to reconnect to host: {self.mqtt_config['host']} port: {self.mqtt_config['port']}.")
+        while not self.wait_for_connection(self.mqtt_config['wait_between_retries']) and self.publisher.process:
+            self.logger.logdbg("Still waiting to reconnect.")
+
+    def start_network_loop(self):
+        """ Start the thread that connects, and reconnects, to the broker. """
+        if self.mqtt_config.get('max_inflight', 0):
+            self.client.max_inflight_messages_set(self.mqtt_config['max_inflight'])
+        self.connection_thread = threading.Thread(target=self._manage_connection,
+                                                  name=f"{threading.current_thread().name}-connection",
+                                                  daemon=True)
+        self.connection_thread.start()
+
+    def stop_network_loop(self):
+        """ Stop the connection processing, disconnect and stop the paho network thread. """
+        self._set_connection_state('stopped')
+        if self.connection_thread:
+            self.connection_thread.join()
+        self.client.disconnect()
+        self.client.loop_stop()
+        self._log_acknowledgements()
+
+    def _log_acknowledgements(self):
+        if self.inflight_pending:
+            self.logger.logerr(f"{self.inflight_pending} qos 1 and 2 messages were not acknowledged.")
+        for (_, detail), stats in self.ack_latency.stages.items():
+            self.logger.loginf((f"Acknowledged {stats['count']} {detail} messages, "
+                                f"average latency {stats['total'] / stats['count']:.1f} ms, "
+                                f"maximum latency {stats['maximum']:.1f} ms."))
 
     def _config_tls(self, tls_dict):
         """ Configure TLS."""
@@ -286,20 +984,139 @@ class AbstractPublisher(abc.ABC):
                             tls_version=tls_version,
                             ciphers=ciphers)
 
-    def publish_message(self, time_stamp, qos, retain, topic, data):
-        """ Publish the message. """
+    def publish_message(self, time_stamp, qos, retain, topic, data, options=None):
+        """ Publish the message.
+            The options are the MQTTv5 'topic_alias', 'content_type' and 'message_expiry_interval' of its topic. """
         if not self.connected:
             self._reconnect()
 
         payload = data
         data_type = type(data)
-        if data is not None and data_type not in (str, bytearray, int, float):
-            payload = json.dumps(data)
+        if data is not None and data_type not in (str, bytes, bytearray, int, float):
+            payload = dumps_json(data)
+
+        with self.inflight_condition:
+            if qos and self.mqtt_config.get('max_inflight', 0):
+                self._wait_for_inflight_window()
+            else:
+                self._prune_inflight()
+            self.publishing += 1
+
+        # The lock cannot be held while publishing, paho calls on_publish with its own lock held.
+        published = time.perf_counter()
+        (publish_topic, properties) = (topic, None)
+        if options:
+            (publish_topic, properties) = self.publish_properties(topic, qos, options)
+        try:
+            if properties is None:
+                mqtt_message_info = self.client.publish(topic, payload, qos=qos, retain=retain)
+            else:
+                mqtt_message_info = self.client.publish(publish_topic, payload, qos=qos, retain=retain, properties=properties)
+        finally:
+            with self.inflight_condition:
+                self.publishing -= 1
+        self.logger.logdbg("At %d publishing: %d %s %s %s", time.time(), time_stamp, mqtt_message_info.mid, qos, topic)
+
+        # A qos 0 message that could not be sent will never be acknowledged.
+        if qos or mqtt_message_info.rc == mqtt.MQTT_ERR_SUCCESS:
+            with self.inflight_condition:
+                acknowledged = self.early_acks.pop(mqtt_message_info.mid, None)
+                # An acknowledgement from before this publish is of an earlier use of the mid.
+                if acknowledged is None or acknowledged < published:
+                    # Keep the time order, when a reused mid is still in flight.
+                    self.inflight.pop(mqtt_message_info.mid, None)
+                    self.inflight[mqtt_message_info.mid] = (topic, published, qos, time_stamp)
+                    if qos:
+                        self.inflight_pending += 1
+                else:
+                    self.ack_latency.stop(published, 'ack', f'qos{qos}', acknowledged)
+
+        return mqtt_message_info
+
+    def publish_offline(self):
+        """ MQTT's LWT is sent from the broker on an unexpected disconnect.
+            So we need to send an offline message on an 'expected' disconnect. """
+        if self.lwt_dict is not None and to_bool(self.lwt_dict.get('enable', True)):
+            self.client.publish(topic=self.lwt_dict.get('topic', 'status'),
+                                payload=self.lwt_dict.get('offline_payload', 'offline'),
+                                qos=to_int(self.lwt_dict.get('qos', 0)),
+                                retain=to_bool(self.lwt_dict.get('retain', True)))
 
-        mqtt_message_info = self.client.publish(topic, payload, qos=qos, retain=retain)
-        self.logger.logdbg(f"At {int(time.time())} publishing: {int(time_stamp)} {mqtt_message_info.mid} {qos} {topic}")
+    def publish_properties(self, topic, qos, options):  # pylint: disable=unused-argument
+        """ The topic to publish to and the publish properties. Only MQTTv5 has properties. """
+        return topic, None
+
+    def _wait_for_inflight_window(self):
+        """ Apply backpressure, wait until there are fewer than 'max_inflight' qos 1 and 2 messages in flight.
+            The inflight_condition must be held. """
+        max_inflight = self.mqtt_config['max_inflight']
+        self._prune_inflight()
+        if self.inflight_condition.wait_for(lambda: self.inflight_pending < max_inflight,
+                                            self.mqtt_config.get('inflight_timeout', 30)):
+            return
+        self._prune_inflight()
+
+    def _prune_inflight(self, now=None):
+        """ Give up on, and report, the messages not acknowledged within 'inflight_timeout'.
+            The maps are in time order, so only their oldest entries are checked. The inflight_condition must be held. """
+        timeout = self.mqtt_config.get('inflight_timeout', 30)
+        if now is None:
+            now = time.perf_counter()
+        expired = 0
+        while self.inflight:
+            mid = next(iter(self.inflight))
+            (topic, published, qos, time_stamp) = self.inflight[mid]
+            if now - published <= timeout:
+                break
+            del self.inflight[mid]
+            expired += 1
+            if qos:
+                self.inflight_pending -= 1
+            self.logger.logerr(f"Message {mid} of {int(time_stamp)} qos {qos} on {topic} "
+                               f"not acknowledged within {timeout} seconds.")
+        # Acknowledgements of mids that publish never returned.
+        while self.early_acks:
+            mid = next(iter(self.early_acks))
+            if now - self.early_acks[mid] <= timeout:
+                break
+            del self.early_acks[mid]
+        if expired:
+            self.inflight_timeouts += expired
+            self.inflight_condition.notify_all()
+
+    def _acknowledge(self, mid):
+        """ Called by on_publish, when the message has been sent (qos 0) or acknowledged (qos 1 and 2). """
+        acknowledged = time.perf_counter()
+        with self.inflight_condition:
+            self._prune_inflight(acknowledged)
+            message = self.inflight.pop(mid, None)
+            if message is None:
+                # Only a publish_message waiting for client.publish to return can be missing the mid.
+                # Messages published directly by the client, like the availability and metrics messages, are not tracked.
+                if self.publishing:
+                    self.early_acks.pop(mid, None)
+                    self.early_acks[mid] = acknowledged
+                return
+            (topic, published, qos, time_stamp) = message
+            if qos:
+                self.inflight_pending -= 1
+                self.inflight_condition.notify_all()
+            self.ack_latency.stop(published, 'ack', f'qos{qos}', acknowledged)
+
+        self.logger.logdbg("At %d published: %d %s %s %s", time.time(), time_stamp, mid, qos, topic)
+
+    def wait_for_publish(self, message_infos, timeout):
+        """ Wait for the messages to be sent (qos 0) or acknowledged (qos 1 and 2).
+            Returns True if all the messages were published within the timeout. """
+        deadline = time.time() + timeout
+        for message_info in message_infos:
+            try:
+                message_info.wait_for_publish(max(0, deadline - time.time()))
+            except (RuntimeError, ValueError) as exception:
+                self.logger.logerr(f"Waiting for mid {message_info.mid} failed with {type(exception)} and reason {exception}.")
+                return False
 
-        self.client.loop(timeout=0.1)
+        return all(message_info.is_published() for message_info in message_infos)
 
     def get_client(self, client_id, protocol):
         ''' Get the MQTT client. '''
@@ -337,7 +1154,7 @@ class AbstractPublisher(abc.ABC):
 
     def on_message(self, client, userdata, msg):
         """ The on_message callback. """
-        self.logger.logdbg(f"Received: {userdata} {msg}")
+        self.logger.logdbg("Received: %s %s", userdata, msg)
         for plugin_name in self.plugin_manager.callbacks['on_mqtt_message']['immediate']:
             self.plugin_manager.callbacks['on_mqtt_message']['immediate'][plugin_name](client, userdata, msg)
 
@@ -371,7 +1188,7 @@ class PublisherV1(AbstractPublisher):
         self.client.connect(host, port, keepalive)
 
     def on_log(self, _client, _userdata, level, msg):
-        self.mqtt_logger[level](f"MQTT log: {msg}")
+        self.mqtt_logger[level]("MQTT log: %s", msg)
 
     def on_connect(self, client, userdata, flags, reason_code, properties=None):
         # https://pypi.org/project/paho-mqtt/#on-connect
@@ -402,7 +1219,9 @@ class PublisherV1(AbstractPublisher):
         for plugin_name in self.plugin_manager.callbacks['on_mqtt_connect']['delay']:
             self.plugin_manager.callbacks['on_mqtt_connect']['delay'][plugin_name](client, userdata, flags, reason_code, properties)
 
-        self.connected = True
+        # A refused connection is followed by on_disconnect, which restarts the connection processing.
+        if int(reason_code) == 0:
+            self.connected = True
 
     def on_disconnect(self, _client, _userdata, flags_rc, reason_code=None, properties=None):
         # https://pypi.org/project/paho-mqtt/#on-discconnect
@@ -422,12 +1241,17 @@ class PublisherV1(AbstractPublisher):
         self.connected = False
 
     def on_publish(self, _client, _userdata, mid, reason_codes=None, properties=None):
-        time_stamp = "          "
-        qos = ""
-        self.logger.logdbg(f"At {int(time.time())} published: {time_stamp} {mid} {qos}")
+        self._acknowledge(mid)
 
 class PublisherV2(AbstractPublisher):
     ''' MQTTPublish that communicates with paho mqtt v2. '''
+    def __init__(self, logger, plugin_manager, publisher, mqtt_config):
+        # The topic aliases are per connection, the broker's CONNACK sets how many can be used.
+        self.topic_alias_maximum = 0
+        self.topic_aliases = {}
+
+        super().__init__(logger, plugin_manager, publisher, mqtt_config)
+
     def get_client(self, client_id, protocol):
         return mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
                            protocol=protocol,
@@ -446,7 +1270,7 @@ class PublisherV2(AbstractPublisher):
         self.client.connect(host=host, port=port, keepalive=keepalive, clean_start=True)
 
     def on_log(self, _client, _userdata, level, msg):
-        self.mqtt_logger[level](f"MQTT log: {msg}")
+        self.mqtt_logger[level]("MQTT log: %s", msg)
 
     def on_connect(self, client, userdata, flags, reason_code, properties):
         self.logger.loginf(f"Connected with result code {int(int(reason_code.value))}")
@@ -468,7 +1292,11 @@ class PublisherV2(AbstractPublisher):
         for plugin_name in self.plugin_manager.callbacks['on_mqtt_connect']['delay']:
             self.plugin_manager.callbacks['on_mqtt_connect']['delay'][plugin_name](client, userdata, flags, reason_code, properties)
 
-        self.connected = True
+        # A refused connection is followed by on_disconnect, which restarts the connection processing.
+        if int(reason_code.value) == 0:
+            self.topic_aliases = {}
+            self.topic_alias_maximum = getattr(properties, 'TopicAliasMaximum', 0) if properties is not None else 0
+            self.connected = True
 
     def on_disconnect(self, _client, _userdata, _flags, reason_code, _properties):
         # https://pypi.org/project/paho-mqtt/#on-discconnect
@@ -488,9 +1316,29 @@ class PublisherV2(AbstractPublisher):
         self.connected = False
 
     def on_publish(self, _client, _userdata, mid, _reason_codes, _properties):
-        time_stamp = "          "
-        qos = ""
-        self.logger.logdbg(f"At {int(time.time())} published: {time_stamp} {mid} {qos}")
+        self._acknowledge(mid)
+
+    def publish_properties(self, topic, qos, options):
+        """ Once a topic has an alias, qos 0 messages are published with only the alias.
+            qos 1 and 2 messages keep the topic, paho resends them on the next connection, where the alias is unknown. """
+        properties = mqtt.Properties(mqtt.PacketTypes.PUBLISH)
+        if options.get('content_type'):
+            properties.ContentType = options['content_type']
+        if options.get('message_expiry_interval'):
+            properties.MessageExpiryInterval = options['message_expiry_interval']
+
+        if options.get('topic_alias'):
+            topic_aliases = self.topic_aliases
+            alias = topic_aliases.get(topic)
+            if alias is not None:
+                properties.TopicAlias = alias
+                if not qos:
+                    return '', properties
+            elif len(topic_aliases) < self.topic_alias_maximum:
+                topic_aliases[topic] = len(topic_aliases) + 1
+                properties.TopicAlias = topic_aliases[topic]
+
+        return topic, properties
 
 class PublisherV2MQTT3(PublisherV2):
     ''' MQTTPublish that communicates with paho mqtt v2. '''
@@ -504,6 +1352,214 @@ class PublisherV2MQTT3(PublisherV2):
     def connect(self, host, port, keepalive):
         self.client.connect(host=host, port=port, keepalive=keepalive)
 
+    def publish_properties(self, topic, qos, options):
+        return topic, None
+
+class EventLoop():
+    """ The asyncio event loop shared by the publishers with 'network_loop = asyncio'.
+        It runs on its own thread, so that all of the connections are multiplexed on one thread. """
+    lock = threading.Lock()
+    loop = None
+    thread = None
+
+    @classmethod
+    def get_loop(cls):
+        """ The event loop, started on first use. """
+        with cls.lock:
+            if cls.loop is None:
+                cls.loop = asyncio.new_event_loop()
+                cls.thread = threading.Thread(target=cls.loop.run_forever, name='MQTTPublish-asyncio', daemon=True)
+                cls.thread.start()
+            return cls.loop
+
+class AsyncioNetworkLoop(AbstractPublisher):  # the paho version is mixed in pylint: disable=abstract-method
+    """ Run the network I/O and the connection management of a publisher as coroutines on the shared EventLoop.
+        paho's external event loop support is used, the socket is watched by the event loop and
+        loop_read, loop_write and loop_misc are called when it is ready, instead of the paho network thread. """
+    def __init__(self, logger, plugin_manager, publisher, mqtt_config):
+        self.event_loop = None
+        self.connection_future = None
+        # Set, on the event loop, when the connection state changes.
+        self.state_changed = None
+        self.socket_closed = threading.Event()
+
+        super().__init__(logger, plugin_manager, publisher, mqtt_config)
+
+    def _set_connection_state(self, state):
+        super()._set_connection_state(state)
+        if self.state_changed is not None:
+            self.event_loop.call_soon_threadsafe(self.state_changed.set)
+
+    def _call_in_loop(self, callback, *args):
+        """ paho calls the socket callbacks from the event loop and from the threads publishing. """
+        if threading.current_thread() is EventLoop.thread:
+            callback(*args)
+        else:
+            self.event_loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, _client, _userdata, sock):
+        """ The on_socket_open callback. """
+        self.socket_closed.clear()
+        self._call_in_loop(self._watch_read, sock)
+
+    def on_socket_close(self, _client, _userdata, sock):
+        """ The on_socket_close callback. """
+        self._call_in_loop(self._unwatch, sock)
+        self.socket_closed.set()
+
+    def on_socket_register_write(self, _client, _userdata, sock):
+        """ The on_socket_register_write callback. """
+        self._call_in_loop(self._watch_write, sock)
+
+    def on_socket_unregister_write(self, _client, _userdata, sock):
+        """ The on_socket_unregister_write callback. """
+        self._call_in_loop(self.event_loop.remove_writer, sock)
+
+    def _watch_read(self, sock):
+        # A socket closed before this ran is no longer the client's.
+        if self.client.socket() is sock:
+            self.event_loop.add_reader(sock, self.client.loop_read)
+
+    def _watch_write(self, sock):
+        if self.client.socket() is sock and self.client.want_write():
+            self.event_loop.add_writer(sock, self._loop_write, sock)
+
+    def _unwatch(self, sock):
+        self.event_loop.remove_reader(sock)
+        self.event_loop.remove_writer(sock)
+
+    def _loop_write(self, sock):
+        self.client.loop_write()
+        # Stop watching once everything is written, a registration can arrive after paho's unregister.
+        # When the write closed the socket, it is no longer watched.
+        if self.client.socket() is sock and not self.client.want_write():
+            self.event_loop.remove_writer(sock)
+
+    async def _wait_for_state(self, states, timeout=None):
+        """ Wait for the connection state to be one of states. Returns False if it is not within the timeout. """
+        deadline = None if timeout is None else self.event_loop.time() + timeout
+        while self.connection_state not in states:
+            # The state is set on other threads, but the event is only set on the event loop, after this clear.
+            self.state_changed.clear()
+            try:
+                await asyncio.wait_for(self.state_changed.wait(), None if deadline is None else deadline - self.event_loop.time())
+            except asyncio.TimeoutError:
+                return self.connection_state in states
+        return True
+
+    async def _keepalive(self):
+        """ paho's keepalive and timeout processing. """
+        while True:
+            await asyncio.sleep(1)
+            self.client.loop_misc()
+
+    async def _manage_connection_async(self):
+        """ Connect and reconnect to the broker, as _manage_connection does on its own thread. """
+        self.state_changed = asyncio.Event()
+        keepalive = self.event_loop.create_task(self._keepalive())
+        try:
+            while True:
+                await self._wait_for_state(('disconnected', 'stopped'))
+                if self.connection_state == 'stopped':
+                    return
+                attempt = self.connection_attempts
+                self.connection_attempts += 1
+
+                if attempt > self.mqtt_config['max_retries'] and not self.keep_connecting:
+                    self.logger.logerr(f"Unable to connect after {attempt} attempts.")
+                    self._set_connection_state('failed')
+                    return
+
+                if attempt:
+                    delay = self.retry_delay(attempt)
+                    self.logger.loginf(f"Waiting {delay:.1f} seconds to connect.")
+                    if await self._wait_for_state(('stopped',), delay):
+                        return
+
+                await self._connect_async()
+        finally:
+            keepalive.cancel()
+
+    async def _connect_async(self):
+        """ Make one attempt to connect.
+            The outcome is reported by the on_connect and on_disconnect callbacks. """
+        self.logger.loginf(f"Connecting to host: {self.mqtt_config['host']} port: {self.mqtt_config['port']}.")
+        self._set_connection_state('connecting')
+        try:
+            # The TCP and TLS handshakes block, so they are run in the default executor.
+            await self.event_loop.run_in_executor(None,
+                                                  self.connect,
+                                                  self.mqtt_config['host'],
+                                                  self.mqtt_config['port'],
+                                                  self.mqtt_config['keepalive'])
+        except Exception as exception:  # want to catch all pylint: disable=broad-exception-caught
+            self.logger.logerr(f"MQTT connect failed with {type(exception)} and reason {exception}.")
+            self._set_connection_state('disconnected')
+
+    def start_network_loop(self):
+        """ Start connecting, and reconnecting, to the broker on the event loop. """
+        if self.mqtt_config.get('max_inflight', 0):
+            self.client.max_inflight_messages_set(self.mqtt_config['max_inflight'])
+        self.event_loop = EventLoop.get_loop()
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.connection_future = asyncio.run_coroutine_threadsafe(self._manage_connection_async(), self.event_loop)
+
+    def stop_network_loop(self):
+        """ Stop the connection processing and disconnect, once the queued messages are written. """
+        self._set_connection_state('stopped')
+        if self.connection_future is not None:
+            self.connection_future.result()
+        if self.client.socket() is not None:
+            self.client.disconnect()
+            self.socket_closed.wait(self.mqtt_config['keepalive'])
+        self._log_acknowledgements()
+
+class AsyncioPublisherV1(AsyncioNetworkLoop, PublisherV1):
+    ''' MQTTPublish that communicates with paho mqtt v1, on the asyncio event loop. '''
+
+class AsyncioPublisherV2(AsyncioNetworkLoop, PublisherV2):
+    ''' MQTTPublish that communicates with paho mqtt v2, on the asyncio event loop. '''
+
+class AsyncioPublisherV2MQTT3(AsyncioNetworkLoop, PublisherV2MQTT3):
+    ''' MQTTPublish that communicates with paho mqtt v2 using MQTT 3, on the asyncio event loop. '''
+
+class FieldPlan():
+    """ The precomputed steps to publish a field of a topic. """
+    __slots__ = ('name', 'ignore', 'publish_none_value', 'threshold', 'converter', 'caster', 'round_amount', 'format_string',
+                 'unresolved_observation')
+
+    def __init__(self, name, ignore, publish_none_value, threshold, converter, caster, round_amount, format_string,
+                 unresolved_observation=None):
+        self.name = name
+        self.ignore = ignore
+        self.publish_none_value = publish_none_value
+        self.threshold = threshold
+        self.converter = converter
+        self.caster = caster
+        self.round_amount = round_amount
+        self.format_string = format_string
+        # The observation whose unit group was not known when the plan was compiled.
+        self.unresolved_observation = unresolved_observation
+
+    def is_stale(self):
+        """ Whether the unit group that was missing when the plan was compiled has been registered since. """
+        return self.unresolved_observation is not None and self.unresolved_observation in weewx.units.obs_group_dict
+
+    def transform(self, value):
+        """ Convert, round and format the value. """
+        if self.converter is not None:
+            value = self.converter(value)
+        if self.caster is not None:
+            value = self.caster(value)
+        if self.round_amount and isinstance(value, float):
+            value = round(value, self.round_amount)
+        if self.format_string is not None:
+            value = self.format_string % value
+        return value
+
 class PublishWeeWX():
     """ Backwards compatibility class."""
     def __init__(self, engine, config_dict):
@@ -538,8 +1594,8 @@ class MQTTPublish(StdService):
 
         exclude_keys = ['password']
         sanitized_service_dict = {k: service_dict[k] for k in set(list(service_dict.keys())) - set(exclude_keys)}
-        self.logger.logdbg(f"sanitized configuration removed {exclude_keys}")
-        self.logger.logdbg(f"sanitized_service_dict is {sanitized_service_dict}")
+        self.logger.logdbg("sanitized configuration removed %s", exclude_keys)
+        self.logger.logdbg("sanitized_service_dict is %s", sanitized_service_dict)
 
         #  backwards compatability
         if 'PublishWeeWX' in service_dict.sections:
@@ -566,14 +1622,34 @@ class MQTTPublish(StdService):
             weeutil.config.merge_config(self.weewx_dict['defaults'], config_dict['StdReport']['Defaults'])
 
         self.topics_loop, self.topics_archive, binding = self.configure_topics(service_dict)
-        self.logger.logdbg(f"archive topic configuration is: {self.topics_archive}")
-        self.logger.logdbg(f"loop topic configuration is: {self.topics_loop}")
+        self.logger.logdbg("archive topic configuration is: %s", self.topics_archive)
+        self.logger.logdbg("loop topic configuration is: %s", self.topics_loop)
 
         self.mqtt_config = {}
         self.mqtt_config['keepalive'] = to_int(service_dict.get('keepalive', 60))
         self.mqtt_config['wait_for_queue_element'] = to_int(service_dict.get('wait_for_queue_element', 5))
+        self.mqtt_config['wait_for_publish'] = to_float(service_dict.get('wait_for_publish', 0))
+        self.mqtt_config['max_inflight'] = to_int(service_dict.get('max_inflight', 0))
+        self.mqtt_config['connections'] = to_int(service_dict.get('connections', 1))
+        self.mqtt_config['connection_message_rate'] = to_float(service_dict.get('connection_message_rate', 0))
+        self.mqtt_config['connection_byte_rate'] = to_float(service_dict.get('connection_byte_rate', 0))
+        self.mqtt_config['network_loop'] = service_dict.get('network_loop', 'thread')
+        if self.mqtt_config['network_loop'] not in ['thread', 'asyncio']:
+            raise ValueError(f"Invalid 'network_loop', {self.mqtt_config['network_loop']}")
+        if self.mqtt_config['connections'] < 1:
+            raise ValueError(f"Invalid 'connections', {self.mqtt_config['connections']}")
+        self.mqtt_config['inflight_timeout'] = to_float(service_dict.get('inflight_timeout', 30))
+        self.mqtt_config['replay_backlog'] = to_bool(service_dict.get('replay_backlog', False))
+        self.mqtt_config['backlog_rate'] = to_float(service_dict.get('backlog_rate', 10))
+        if self.mqtt_config['backlog_rate'] <= 0:
+            raise ValueError(f"Invalid 'backlog_rate', {self.mqtt_config['backlog_rate']}")
+        self.mqtt_config['catch_up_threshold'] = to_int(service_dict.get('catch_up_threshold', 0))
+        self.mqtt_config['max_queue_size'] = to_int(service_dict.get('max_queue_size', 0))
+        self.mqtt_config['queue_overflow_policy'] = service_dict.get('queue_overflow_policy', 'drop_oldest')
+        self.mqtt_config['queue_block_timeout'] = to_float(service_dict.get('queue_block_timeout', 1))
+        self.mqtt_config['profile'] = to_bool(service_dict.get('profile', False))
+        self.mqtt_config['profile_interval'] = to_int(service_dict.get('profile_interval', 300))
         self.mqtt_config['max_retries'] = to_int(service_dict.get('max_retries', 5))
-        self.mqtt_config['wait_for_connection'] = to_int(service_dict.get('wait_for_connection', 1))
 
         self.mqtt_config['wait_between_retries'] = to_int(service_dict.get('wait_between_retries', 5))
         self.mqtt_config['log_mqtt'] = to_bool(service_dict.get('mqtt_log', False))
@@ -585,8 +1661,14 @@ class MQTTPublish(StdService):
 
         protocol_string = service_dict.get('protocol', 'MQTTv311')
         self.mqtt_config['protocol'] = getattr(mqtt, protocol_string, 0)
+        if self.mqtt_config['protocol'] != getattr(mqtt, 'MQTTv5', None) and \
+           any(topic_dict['publish_options'] for topic_dict in [*self.topics_loop.values(), *self.topics_archive.values()]):
+            self.logger.logerr("'topic_alias', 'content_type' and 'message_expiry_interval' require MQTTv5 and are ignored.")
 
         self.mqtt_config['tls'] = service_dict.get('tls')
+        self.mqtt_config['spool'] = service_dict.get('spool')
+        if self.mqtt_config['spool'] is not None and to_float(self.mqtt_config['spool'].get('replay_rate', 100)) <= 0:
+            raise ValueError(f"Invalid 'replay_rate', {self.mqtt_config['spool']['replay_rate']}")
         self.mqtt_config['lwt'] = service_dict.get('lwt')
         if self.mqtt_config['lwt'] is not None:
             self.logger.logerr("'[[lwt]]' is deprecated.  use [[availablity_topic]].")
@@ -594,8 +1676,14 @@ class MQTTPublish(StdService):
             self.mqtt_config['lwt'] = service_dict.get('availability_topic', {})
 
         sanitized_mqtt_config = {k: self.mqtt_config[k] for k in set(list(self.mqtt_config.keys())) - set(exclude_keys)}
-        self.logger.logdbg(f"sanitized mqtt_config removed {exclude_keys}")
-        self.logger.logdbg(f"sanitized_mqtt_config is {sanitized_mqtt_config}")
+        self.logger.logdbg("sanitized mqtt_config removed %s", exclude_keys)
+        self.logger.logdbg("sanitized_mqtt_config is %s", sanitized_mqtt_config)
+
+        self.mqtt_config['brokers'] = self.configure_brokers(service_dict)
+        for topic, topic_dict in {**self.topics_loop, **self.topics_archive}.items():
+            for broker in topic_dict['brokers']:
+                if broker != 'default' and broker not in self.mqtt_config['brokers']:
+                    raise ValueError(f"Invalid 'brokers', {broker} of topic {topic} is not in [[brokers]].")
 
         self.max_thread_restarts = to_int(service_dict.get('max_thread_restarts', 2))
         self.thread_restarts = 0
@@ -603,7 +1691,15 @@ class MQTTPublish(StdService):
         if 'binding' in service_dict:
             self.logger.loginf("'binding' is deprecated and no longer used.")
 
-        self.data_queue = Queue.Queue()
+        if 'wait_for_connection' in service_dict:
+            self.logger.loginf("'wait_for_connection' is deprecated and no longer used.")
+
+        self.metrics = Metrics(self.logger, service_dict.get('metrics'))
+
+        self.data_queue = DataQueue(self.logger,
+                                    self.mqtt_config['max_queue_size'],
+                                    self.mqtt_config['queue_overflow_policy'],
+                                    self.mqtt_config['queue_block_timeout'])
 
         if 'loop' in binding:
             self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
@@ -618,9 +1714,47 @@ class MQTTPublish(StdService):
                                           self.mqtt_config,
                                           self.topics_loop,
                                           self.topics_archive,
-                                          self.data_queue)
+                                          self.data_queue,
+                                          self.metrics)
         self.thread_start()
 
+    def configure_brokers(self, service_dict):
+        """ Configure the additional brokers, each one inherits the connection options of [MQTTPublish]. """
+        brokers = {}
+        if 'brokers' not in service_dict:
+            return brokers
+
+        for broker in service_dict['brokers'].sections:
+            if broker == 'default':
+                raise ValueError("'default' is the broker configured in [MQTTPublish], it cannot be in [[brokers]].")
+            broker_dict = service_dict['brokers'][broker]
+
+            mqtt_config = dict(self.mqtt_config)
+            for option in ['host', 'username', 'password']:
+                mqtt_config[option] = broker_dict.get(option, self.mqtt_config[option])
+            for option in ['port', 'keepalive', 'max_retries', 'wait_between_retries', 'max_inflight']:
+                mqtt_config[option] = to_int(broker_dict.get(option, self.mqtt_config[option]))
+            for option in ['inflight_timeout', 'connection_message_rate', 'connection_byte_rate']:
+                mqtt_config[option] = to_float(broker_dict.get(option, self.mqtt_config[option]))
+            mqtt_config['clientid'] = broker_dict.get('clientid', f"{self.mqtt_config['clientid']}-{broker}")
+            if 'protocol' in broker_dict:
+                mqtt_config['protocol'] = getattr(mqtt, broker_dict['protocol'], 0)
+            mqtt_config['tls'] = broker_dict.get('tls', self.mqtt_config['tls'])
+            mqtt_config['lwt'] = broker_dict.get('availability_topic', self.mqtt_config['lwt'])
+            mqtt_config['spool'] = None
+
+            # Each broker has its own queue of messages waiting to be published.
+            mqtt_config['max_queue_size'] = to_int(broker_dict.get('max_queue_size', service_dict.get('max_queue_size', 0)))
+            mqtt_config['queue_overflow_policy'] = broker_dict.get('queue_overflow_policy',
+                                                                   service_dict.get('queue_overflow_policy', 'drop_oldest'))
+            mqtt_config['queue_block_timeout'] = to_float(broker_dict.get('queue_block_timeout',
+                                                                          service_dict.get('queue_block_timeout', 1)))
+
+            self.logger.loginf(f"Publishing to broker {broker}, host: {mqtt_config['host']} port: {mqtt_config['port']}.")
+            brokers[broker] = mqtt_config
+
+        return brokers
+
     def configure_fields(self,
                          fields_dict,
                          ignore,
@@ -665,6 +1799,11 @@ class MQTTPublish(StdService):
         default_suppression_threshold = to_float(service_dict.get('suppression_threshold', 0))
         default_retain = to_bool(service_dict.get('retain', False))
         default_type = service_dict.get('type', 'json')
+        default_topic_alias = to_bool(service_dict.get('topic_alias', False))
+        default_content_type = service_dict.get('content_type', None)
+        default_message_expiry_interval = to_int(service_dict.get('message_expiry_interval', 0))
+        default_message_rate = to_float(service_dict.get('message_rate', 0))
+        default_byte_rate = to_float(service_dict.get('byte_rate', 0))
 
         topics_loop = {}
         topics_archive = {}
@@ -687,9 +1826,30 @@ class MQTTPublish(StdService):
             suppression_threshold = to_float(topic_dict.get('suppression_threshold', default_suppression_threshold))
             retain = to_bool(topic_dict.get('retain', default_retain))
             data_type = topic_dict.get('type', default_type)
+            if data_type not in SERIALIZERS:
+                raise ValueError(f"Invalid 'type', {data_type}")
+            if not SERIALIZERS[data_type].is_available():
+                raise ValueError(f"'type' {data_type} requires the {SERIALIZERS[data_type].requires} module.")
+
+            # The MQTTv5 publish options
+            publish_options = None
+            topic_alias = to_bool(topic_dict.get('topic_alias', default_topic_alias))
+            content_type = topic_dict.get('content_type', default_content_type)
+            message_expiry_interval = to_int(topic_dict.get('message_expiry_interval', default_message_expiry_interval))
+            if topic_alias or content_type or message_expiry_interval:
+                publish_options = {
+                    'topic_alias': topic_alias,
+                    'content_type': content_type,
+                    'message_expiry_interval': message_expiry_interval,
+                }
+
+            # The rate limits
+            message_rate = to_float(topic_dict.get('message_rate', default_message_rate))
+            byte_rate = to_float(topic_dict.get('byte_rate', default_byte_rate))
 
             # And finally the topic options
             publish = to_bool(topic_dict.get('publish', True))
+            brokers = to_list(topic_dict.get('brokers', ['default']))
             binding = weeutil.weeutil.option_as_list(topic_dict.get('binding', ['archive', 'loop']))
             unit_system_name = topic_dict.get('unit_system', service_dict.get('unit_system', 'US'))
             unit_system = weewx.units.unit_constants[unit_system_name]
@@ -743,6 +1903,10 @@ class MQTTPublish(StdService):
                 topics_loop[topic]['suppression_threshold'] = suppression_threshold
                 topics_loop[topic]['retain'] = retain
                 topics_loop[topic]['type'] = data_type
+                topics_loop[topic]['publish_options'] = publish_options
+                topics_loop[topic]['brokers'] = brokers
+                topics_loop[topic]['message_rate'] = message_rate
+                topics_loop[topic]['byte_rate'] = byte_rate
                 topics_loop[topic]['unit_system'] = unit_system
                 topics_loop[topic]['ignore'] = ignore
                 topics_loop[topic]['append_unit_label'] = append_unit_label
@@ -751,6 +1915,7 @@ class MQTTPublish(StdService):
                 topics_loop[topic]['format_string'] = format_string
                 topics_loop[topic]['fields'] = dict(fields)
                 topics_loop[topic]['data_last_published'] = {}
+                topics_loop[topic]['field_plans'] = {}
                 event_binding['loop'] = True
 
             if 'archive' in binding:
@@ -763,6 +1928,10 @@ class MQTTPublish(StdService):
                 topics_archive[topic]['suppression_threshold'] = suppression_threshold
                 topics_archive[topic]['retain'] = retain
                 topics_archive[topic]['type'] = data_type
+                topics_archive[topic]['publish_options'] = publish_options
+                topics_archive[topic]['brokers'] = brokers
+                topics_archive[topic]['message_rate'] = message_rate
+                topics_archive[topic]['byte_rate'] = byte_rate
                 topics_archive[topic]['unit_system'] = unit_system
                 topics_archive[topic]['ignore'] = ignore
                 topics_archive[topic]['append_unit_label'] = append_unit_label
@@ -771,10 +1940,11 @@ class MQTTPublish(StdService):
                 topics_archive[topic]['format_string'] = format_string
                 topics_archive[topic]['fields'] = dict(fields)
                 topics_archive[topic]['data_last_published'] = {}
+                topics_archive[topic]['field_plans'] = {}
                 event_binding['archive'] = True
 
-        self.logger.logdbg(f"Loop topics: {topics_loop}")
-        self.logger.logdbg(f"Archive topics: {topics_archive}")
+        self.logger.logdbg("Loop topics: %s", topics_loop)
+        self.logger.logdbg("Archive topics: %s", topics_archive)
         return topics_loop, topics_archive, event_binding.keys()
 
     def thread_start(self):
@@ -792,16 +1962,24 @@ class MQTTPublish(StdService):
 
     def new_loop_packet(self, event):
         """ Handle loop packets. """
-        self._handle_record('loop', copy.deepcopy(event.packet))
+        self._handle_record('loop', self.snapshot(event.packet))
 
     def new_archive_record(self, event):
         """ Handle archive records. """
-        self._handle_record('archive', copy.deepcopy(event.record))
+        self._handle_record('archive', self.snapshot(event.record))
+
+    @staticmethod
+    def snapshot(data):
+        """ Take a snapshot of the WeeWX data, so that later changes by other services are not published.
+            The data is a flat dictionary of scalars, so a shallow copy is sufficient.
+            The topics share the snapshot, plugins updating the record get a copy, see PublishWeeWXThread.publish_row. """
+        return dict(data)
 
     def _handle_record(self, data_type, data):
         if not self._thread.is_alive():
             if self.thread_restarts < self.max_thread_restarts:
                 self.thread_restarts += 1
+                self.metrics.thread_restarts += 1
                 self._thread = \
                     PublishWeeWXThread(self.logger,
                                        self.plugins,
@@ -810,16 +1988,15 @@ class MQTTPublish(StdService):
                                        self.mqtt_config,
                                        self.topics_loop,
                                        self.topics_archive,
-                                       self.data_queue)
+                                       self.data_queue,
+                                       self.metrics)
                 self.thread_start()
 
                 self.data_queue.put({'time_stamp': data['dateTime'], 'type': data_type, 'data': data})
-                self._thread.threading_event.set()
             else:
                 raise weewx.StopNow("MQTT publishing thread has stopped.")
         else:
             self.data_queue.put({'time_stamp': data.get('dateTime', time.time()), 'type': data_type, 'data': data})
-            self._thread.threading_event.set()
             # A bit of a hack. The thread is running and the MQTT client is connexted.
             # So, we will reset the restart count.
             if self._thread.publisher and self._thread.publisher.connected:
@@ -829,15 +2006,105 @@ class MQTTPublish(StdService):
         """Run when an engine shutdown is requested."""
         self.logger.loginf("Shutdown initiatead")
         if self._thread:
+            self.logger.loginf(f"Queue shed loop: {self.data_queue.shed['loop']} archive: {self.data_queue.shed['archive']}")
             self.logger.loginf("Shutdown of thread initiated")
             self._thread.process = False
-            self._thread.threading_event.set()
+            self.data_queue.wakeup()
             self._thread.join(20.0)
             if self._thread.is_alive():
                 self.logger.logerr(f"Unable to shut down {self._thread.name} thread")
 
             self._thread = None
 
+class BrokerThread(threading.Thread):
+    """ Publish the messages of the topics that target one of the [[brokers]].
+        Each broker has its own connection and queue, so a slow or unreachable broker does not hold up the others. """
+    def __init__(self, logger, broker, mqtt_config, topic_rates=None):
+        threading.Thread.__init__(self)
+        self.logger = logger
+        self.broker = broker
+        self.mqtt_config = mqtt_config
+        # The queued elements are the messages of a record, the overflow policy applies to them as it does to the WeeWX data.
+        self.data_queue = DataQueue(logger,
+                                    mqtt_config['max_queue_size'],
+                                    mqtt_config['queue_overflow_policy'],
+                                    mqtt_config['queue_block_timeout'])
+        self.publisher = AbstractPublisher.get_publisher(logger, PluginManager(logger), self, mqtt_config)
+        # The messages wait in the broker's queue, so it keeps trying to connect.
+        self.publisher.keep_connecting = True
+        # The topics are rate limited per broker.
+        self.rate_limiter = RateLimiter.create(self.publisher, mqtt_config, RateLimiter.create_topic_buckets(topic_rates or {}))
+        self.process = True
+        # The number of messages published.
+        self.messages = 0
+
+    def put(self, time_stamp, data_type, messages):
+        """ Queue the messages of a record to be published, messages is the list of messages of each topic. """
+        if not self.is_alive():
+            return
+        self.data_queue.put({'time_stamp': time_stamp, 'type': data_type, 'data': messages})
+
+    def statistics(self):
+        """ The broker's metrics. """
+        return {
+            'connected': self.publisher.connected,
+            'connects': self.publisher.connects,
+            'queue_depth': self.data_queue.qsize(),
+            'queue_shed': dict(self.data_queue.shed),
+            'messages': self.messages,
+        }
+
+    def stop(self):
+        """ Stop publishing, and wait for the thread to exit. """
+        self.process = False
+        self.data_queue.wakeup()
+        self.join(self.mqtt_config['wait_for_queue_element'])
+
+    def run(self):
+        threading.current_thread().name = f"MQTTPublish-{self.broker}-{threading.get_native_id()}"
+        self.logger.loginf(f"Starting publishing loop for broker {self.broker}.")
+        self.publisher.start_network_loop()
+
+        while self.process:
+            if not self.publisher.connected:
+                # While disconnected the messages stay queued, where the 'queue_overflow_policy' applies.
+                self.publisher.wait_for_connection(self.mqtt_config['wait_for_queue_element'])
+                continue
+
+            timeout = self.mqtt_config['wait_for_queue_element']
+            if self.rate_limiter is not None:
+                (published, wait) = self.rate_limiter.flush()
+                self.messages += len(published)
+                if wait is not None:
+                    timeout = min(timeout, wait)
+
+            try:
+                element = self.data_queue.get(timeout=timeout)
+            except Queue.Empty:
+                continue
+            # Woken up to check if processing should continue.
+            if element is None:
+                continue
+
+            for topic, messages in element['data'].items():
+                for (message_topic, payload, qos, retain, options) in messages:
+                    if self.rate_limiter is None:
+                        self.publisher.publish_message(element['time_stamp'], qos, retain, message_topic, payload, options)
+                        self.messages += 1
+                    else:
+                        self.rate_limiter.submit(topic, element['type'], element['time_stamp'],
+                                                 qos, retain, message_topic, payload, options)
+            if self.rate_limiter is not None:
+                # A message replaced while it waits is not counted.
+                self.messages += len(self.rate_limiter.flush()[0])
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.log_summary()
+        self.publisher.publish_offline()
+        self.publisher.stop_network_loop()
+        self.logger.loginf((f"Exited publishing loop for broker {self.broker}, published {self.messages} messages, "
+                            f"shed loop: {self.data_queue.shed['loop']} archive: {self.data_queue.shed['archive']}."))
+
 class PublishWeeWXThread(threading.Thread):
     """Publish WeeWX data to MQTT. """
     UNIT_REDUCTIONS = {
@@ -867,7 +2134,8 @@ class PublishWeeWXThread(threading.Thread):
                  mqtt_config,
                  topics_loop,
                  topics_archive,
-                 data_queue):
+                 data_queue,
+                 metrics=None):
         threading.Thread.__init__(self)
         self.logger = logger
 
@@ -877,26 +2145,62 @@ class PublishWeeWXThread(threading.Thread):
         self.weewx_dict = weewx_dict
         self.manager_dict = manager_dict
         self.publisher = None
+        self.spool = None
+        self.replay_rate = None
+        # When the next batch of spooled messages can be replayed.
+        self.next_replay = 0
+        # The spooled messages replayed and not yet acknowledged, in order: (id, message info).
+        # The connects when they were replayed, after a reconnect they are replayed again.
+        self.spool_replayed = collections.deque()
+        self.spool_connects = 0
+        # The WeeWX data that was queued before the thread started, and when the next element can be published.
+        self.backlog = collections.deque()
+        self.next_backlog = 0
 
         self.db_manager = None
         self.plugin_manager = None
+        # The connections to the default broker, the first one is self.publisher. Topics are assigned to them by topic_ring.
+        self.connections = []
+        self.topic_ring = None
+        # The rate limiters of the connections, when 'message_rate', 'byte_rate' or the connection rates are set.
+        self.rate_limiters = {}
+        # The threads publishing to the [[brokers]], by name.
+        self.brokers = {}
+        # The messages for the 'default' broker, of each record, waiting while it is disconnected and [[brokers]] are published.
+        # The publishing thread is the only consumer, so it cannot 'block' waiting for room.
+        self.held_messages = DataQueue(logger,
+                                       mqtt_config.get('max_queue_size', 0),
+                                       'drop_newest' if mqtt_config.get('queue_overflow_policy') == 'block'
+                                       else mqtt_config.get('queue_overflow_policy', 'drop_oldest'))
 
         self.mqtt_config = mqtt_config
         self.topics_loop = topics_loop
         self.topics_archive = topics_archive
         self.all_topics = {**self.topics_loop, **self.topics_archive}
+        self.topic_rates = {topic: (topic_dict['message_rate'], topic_dict['byte_rate'])
+                            for topic, topic_dict in self.all_topics.items()
+                            if topic_dict.get('message_rate') or topic_dict.get('byte_rate')}
         self.lwt_dict = mqtt_config.get('lwt')
 
         self.data_queue = data_queue
-        self.threading_event = threading.Event()
+        self.metrics = metrics if metrics is not None else Metrics(logger, None)
+
+        # The time taken to publish a record, from the first topic until all its messages are handed off.
+        self.publish_latency = {
+            'count': 0,
+            'total': 0.0,
+            'maximum': 0.0,
+        }
+
+        if mqtt_config.get('profile', False):
+            self.profiler = Profiler(self.logger, mqtt_config.get('profile_interval', 300))
+        else:
+            self.profiler = NullProfiler()
 
         # Flag to control thread running.
         # Setting to False will stop the thread.
         self.process = True
 
-    def profile(self, msg):
-        self.logger.loginf(msg)
-
     def update_record(self, topic_dict, _time_stamp, record):
         """ Update the record. """
         final_record = {}
@@ -904,23 +2208,27 @@ class PublishWeeWXThread(threading.Thread):
         if topic_dict['minimum_interval']:
             interval_end = startOfInterval(time.time(), topic_dict['minimum_interval']) + topic_dict['minimum_interval']
         updated_record = weewx.units.to_std_system(record, topic_dict['unit_system'])
+        unit_system = updated_record['usUnits']
+        field_plans = topic_dict['field_plans']
+        suppressed_fields = 0
+
+        for field, field_value in updated_record.items():
+            field_plan = field_plans.get((field, unit_system))
+            if field_plan is None or field_plan.is_stale():
+                fieldinfo = topic_dict['fields'].get(field, {})
+                if field_value is None and not fieldinfo.get('publish_none_value', topic_dict.get('publish_none_value')):
+                    continue
+                field_plan = self.compile_field(topic_dict, fieldinfo, field, unit_system)
+                field_plans[(field, unit_system)] = field_plan
 
-        for field in updated_record:
-            fieldinfo = topic_dict['fields'].get(field, {})
-            ignore = fieldinfo.get('ignore', topic_dict.get('ignore'))
-            publish_none_value = fieldinfo.get('publish_none_value', topic_dict.get('publish_none_value'))
-            threshold = fieldinfo.get('suppression_threshold', topic_dict.get('suppression_threshold'))
-
-            if ignore:
+            if field_plan.ignore:
                 continue
-            if updated_record[field] is None and not publish_none_value:
+            if field_value is None and not field_plan.publish_none_value:
                 continue
 
-            (name, value) = self.update_field(topic_dict,
-                                              fieldinfo,
-                                              field,
-                                              updated_record[field],
-                                              updated_record['usUnits'])
+            name = field_plan.name
+            value = field_plan.transform(field_value)
+            threshold = field_plan.threshold
 
             last_published = topic_dict['data_last_published'].get(name, {})
             last_published_timestamp = last_published.get('interval_end')
@@ -933,6 +2241,8 @@ class PublishWeeWXThread(threading.Thread):
                     'value': value,
                     'interval_end': interval_end,
                 }
+            else:
+                suppressed_fields += 1
 
             if (interval_end is None or last_published_timestamp is None or interval_end > last_published_timestamp) and \
                 (name not in final_record):
@@ -940,101 +2250,445 @@ class PublishWeeWXThread(threading.Thread):
 
         if (interval_end is None or last_published_timestamp is None or interval_end > last_published_timestamp):
             final_record['interval_end_ts'] = interval_end
+        else:
+            self.metrics.interval_skips += 1
+        self.metrics.suppressed_fields += suppressed_fields
 
         return final_record
 
     @staticmethod
-    def update_field(topic_dict, fieldinfo, field, value, unit_system):
-        """ Update field. """
+    def compile_field(topic_dict, fieldinfo, field, unit_system):
+        """ Resolve the field's configuration into a FieldPlan.
+            The result depends on the configuration, the unit system, the field name and the field's unit group.
+            So it is cached by the caller, and compiled again if the unit group was missing and is registered later,
+            like the aggregate observations of MQTTAggregateValues. """
         name = fieldinfo.get('name', field)
         unit = fieldinfo.get('unit', None)
         append_unit_label = fieldinfo.get('append_unit_label', topic_dict.get('append_unit_label'))
+        unresolved_observation = None
 
         if append_unit_label:
             if unit is None:
                 (unit_type, _) = weewx.units.getStandardUnitType(unit_system, name)
+                if name not in weewx.units.obs_group_dict:
+                    unresolved_observation = name
             else:
                 unit_type = unit
             unit_type = PublishWeeWXThread.UNIT_REDUCTIONS.get(unit_type, unit_type)
             if unit_type is not None:
                 name = f"{name}_{unit_type}"
 
-        unit = fieldinfo.get('unit', None)
+        converter = None
         if unit is not None:
             (from_unit, from_group) = weewx.units.getStandardUnitType(unit_system, field)
-            from_tuple = (value, from_unit, from_group)
-            converted_value = weewx.units.convert(from_tuple, unit)[0]
-        else:
-            converted_value = value
+            if field not in weewx.units.obs_group_dict:
+                unresolved_observation = field
+
+            def convert_unit(value):
+                return weewx.units.convert((value, from_unit, from_group), unit)[0]
+            converter = convert_unit
 
         conversion_type = fieldinfo.get('conversion_type', topic_dict.get('conversion_type'))
-        round_amount = fieldinfo.get('round', topic_dict.get('round'))
-        format_string = fieldinfo.get('format_string', topic_dict.get('format_string'))
+        caster = None
         if conversion_type == 'integer':
-            converted_value = to_int(converted_value)
+            caster = to_int
         elif conversion_type == 'float':
-            converted_value = to_float(converted_value)
-
-        if round_amount and isinstance(converted_value, float):
-            converted_value = round(converted_value, round_amount)
+            caster = to_float
+
+        return FieldPlan(name,
+                         fieldinfo.get('ignore', topic_dict.get('ignore')),
+                         fieldinfo.get('publish_none_value', topic_dict.get('publish_none_value')),
+                         fieldinfo.get('suppression_threshold', topic_dict.get('suppression_threshold')),
+                         converter,
+                         caster,
+                         fieldinfo.get('round', topic_dict.get('round')),
+                         fieldinfo.get('format_string', topic_dict.get('format_string')),
+                         unresolved_observation)
 
-        if format_string is not None:
-            formatted_value = format_string % converted_value
-        else:
-            formatted_value = converted_value
-
-        return name, formatted_value
+    @staticmethod
+    def update_field(topic_dict, fieldinfo, field, value, unit_system):
+        """ Update field. """
+        field_plan = PublishWeeWXThread.compile_field(topic_dict, fieldinfo, field, unit_system)
+        return field_plan.name, field_plan.transform(value)
 
-    def publish_row(self, time_stamp, data, topics):
+    @staticmethod
+    def convert_record(record, data, unit_system, converted_records):
+        """ Convert the topic's record, data or the copy of it updated by plugins, to the unit system.
+            The shared data is converted once per unit system, only the fields changed by plugins are converted per topic. """
+        if record is not data and record.get('usUnits') != data['usUnits']:
+            # A plugin changed the unit system of the record, so all of it needs converting.
+            return weewx.units.to_std_system(record, unit_system)
+
+        if unit_system not in converted_records:
+            converted_records[unit_system] = weewx.units.to_std_system(data, unit_system)
+
+        if record is data:
+            return converted_records[unit_system]
+
+        # The values are scalars, so an unchanged field is still the same object as in the data.
+        updates = {field: value for field, value in record.items() if field not in data or data[field] is not value}
+        deleted = len(record) - len(updates) < len(data)
+        if not updates and not deleted:
+            return converted_records[unit_system]
+
+        converted_record = dict(converted_records[unit_system])
+        if updates:
+            # The conversion is field by field, so the updates can be converted on their own.
+            converted_record.update(weewx.units.to_std_system({**updates, 'usUnits': data['usUnits']}, unit_system))
+        if deleted:
+            for field in data.keys() - record.keys():
+                del converted_record[field]
+        return converted_record
+
+    def publish_row(self, time_stamp, data, topics, data_type):
         """ Publish the data. """
+        publish_start = time.time()
+        messages = []
+        # The topic of each message, the rate limits are per topic.
+        message_sources = []
+        # The data converted to each unit system, shared by the topics publishing in that unit system.
+        converted_records = {}
+        profiler = self.profiler
+        # The messages for each of the [[brokers]].
+        fanout = {}
+        # The data is shared by the topics, so plugins update a copy of it.
+        plugins_update = bool(self.publisher.plugin_manager.callbacks['update_record']['immediate'])
         for topic in topics:
-            record = copy.deepcopy(data)
+            record = dict(data) if plugins_update else data
             for plugin_name in self.publisher.plugin_manager.callbacks['update_record']['immediate']:
-                self.profile(f"  profile: before immed update_record {time.time() - self.start_time} {topic} {plugin_name}")
-
+                start = profiler.start()
                 self.publisher.plugin_manager.callbacks['update_record']['immediate'][plugin_name](self.publisher.client,
                                                                                                    topic,
                                                                                                    record,
                                                                                                    data['usUnits'],
                                                                                                    topics[topic]['qos'],
                                                                                                    topics[topic]['retain'])
-                self.profile(f"  profile: after immed update_record {time.time() - self.start_time} {topic} {plugin_name}")
+                profiler.stop(start, 'plugin', plugin_name)
+
+            start = profiler.start()
+            record = self.convert_record(record, data, topics[topic]['unit_system'], converted_records)
+            profiler.stop(start, 'convert_record')
 
+            start = profiler.start()
             updated_record = self.update_record(topics[topic], time_stamp, record)
+            profiler.stop(start, 'update_record')
+
             for plugin_name in self.publisher.plugin_manager.callbacks['update_record']['delay']:
                 # Note, this is called with the unit_system from the configuration because:
                 # 1. The record has been converted to this unit_system
                 # 2. The record may not be publishing the field usUnits.
-                self.profile(f"  profile: before delay update_record {time.time() - self.start_time} {topic} {plugin_name}")
+                start = profiler.start()
                 self.publisher.plugin_manager.callbacks['update_record']['delay'][plugin_name](self.publisher.client,
                                                                                                topic,
                                                                                                updated_record,
                                                                                                topics[topic]['unit_system'],
                                                                                                topics[topic]['qos'],
                                                                                                topics[topic]['retain'])
-                self.profile(f"  profile: after delay update_record {time.time() - self.start_time} {topic} {plugin_name}")
+                profiler.stop(start, 'plugin', plugin_name)
 
             if updated_record:
-                if topics[topic]['type'] == 'json':
-                    self.publisher.publish_message(time_stamp,
-                                                   topics[topic]['qos'],
-                                                   topics[topic]['retain'],
-                                                   topic,
-                                                   json.dumps(updated_record))
-                if topics[topic]['type'] == 'keyword':
-                    data_keyword = ', '.join(f"{key}={val}" for (key, val) in updated_record.items())
-                    self.publisher.publish_message(time_stamp,
-                                                   topics[topic]['qos'],
-                                                   topics[topic]['retain'],
-                                                   topic,
-                                                   data_keyword)
-                if topics[topic]['type'] == 'individual':
-                    for key, value in updated_record.items():
-                        self.publisher.publish_message(time_stamp,
-                                                       topics[topic]['qos'],
-                                                       topics[topic]['retain'],
-                                                       topic + '/' + key,
-                                                       value)
+                start = profiler.start()
+                serializer = SERIALIZERS[topics[topic]['type']]
+                topic_messages = [(message_topic,
+                                   payload,
+                                   topics[topic]['qos'],
+                                   topics[topic]['retain'],
+                                   topics[topic]['publish_options'])
+                                  for (message_topic, payload) in serializer.serialize(topic, updated_record)]
+                self.metrics.topic_messages[topic] += len(topic_messages)
+                self.metrics.messages += len(topic_messages)
+                self.metrics.bytes += sum(payload_size(message[1]) for message in topic_messages)
+                # The record is processed once, and the messages are shared by the brokers of the topic.
+                for broker in topics[topic]['brokers']:
+                    if broker == 'default':
+                        messages.extend(topic_messages)
+                        message_sources.extend([topic] * len(topic_messages))
+                    elif broker in self.brokers:
+                        fanout.setdefault(broker, {})[topic] = topic_messages
+                profiler.stop(start, 'serialize')
+
+        for broker, broker_messages in fanout.items():
+            self.brokers[broker].put(time_stamp, data_type, broker_messages)
+
+        # Until the spool has been replayed, new messages are also spooled, so that they are published in order.
+        start = profiler.start()
+        message_infos = []
+        if self.spool is not None and (self.spool.count or not self.publisher.connected):
+            self.spool.append(time_stamp, data_type, messages)
+        elif self.brokers and (self.held_messages.qsize() or not self.publisher.connected):
+            # The [[brokers]] are not held up waiting for this connection, its messages wait until it reconnects.
+            self.held_messages.put({'time_stamp': time_stamp, 'type': data_type, 'data': list(zip(message_sources, messages))})
+        else:
+            message_infos = self.publish_messages(time_stamp, data_type, zip(message_sources, messages))
+        profiler.stop(start, 'publish')
+
+        # The messages are written by the paho network thread, optionally wait once per record for them to go out.
+        wait_for_publish = self.mqtt_config.get('wait_for_publish', 0)
+        if wait_for_publish and message_infos:
+            if not self.publisher.wait_for_publish(message_infos, wait_for_publish):
+                self.logger.logerr((f"Not all {len(message_infos)} messages of {int(time_stamp)} "
+                                    f"published within {wait_for_publish} seconds."))
+
+        self.update_publish_latency(time_stamp, len(messages), time.time() - publish_start)
+
+    def publish_messages(self, time_stamp, data_type, messages):
+        """ Publish the (topic, message) messages of the data_type to the default broker, returns their message infos.
+            With the spool, when the connection is lost partway through, the rest of the messages are spooled
+            instead of waiting for it to reconnect. """
+        message_infos = []
+        messages = list(messages)
+        for index, (topic, (message_topic, payload, qos, retain, options)) in enumerate(messages):
+            connection = self.connection(message_topic)
+            if self.spool is not None and not connection.connected:
+                self.spool_remaining(time_stamp, data_type, messages[index:])
+                break
+            rate_limiter = self.rate_limiters.get(connection)
+            if rate_limiter is None:
+                message_info = connection.publish_message(time_stamp, qos, retain, message_topic, payload, options)
+                message_infos.append(message_info)
+                if self.spool is not None and message_info.rc == mqtt.MQTT_ERR_NO_CONN:
+                    # paho sends a qos 1 or 2 message once reconnected, a qos 0 message is lost.
+                    self.spool_remaining(time_stamp, data_type, messages[index if not qos else index + 1:])
+                    break
+            else:
+                rate_limiter.submit(topic, data_type, time_stamp, qos, retain, message_topic, payload, options)
+        if self.rate_limiters:
+            message_infos.extend(self.flush_rate_limiters()[0])
+        return message_infos
+
+    def spool_remaining(self, time_stamp, data_type, messages):
+        """ Spool the (topic, message) messages of a record that could not be published. """
+        if messages:
+            self.logger.logerr(f"Connection lost publishing {int(time_stamp)}, spooling {len(messages)} messages.")
+            self.spool.append(time_stamp, data_type, [message for (_, message) in messages])
+
+    def publish_held_messages(self):
+        """ Publish the messages held while the default broker was disconnected, in order. """
+        while self.publisher.connected:
+            try:
+                element = self.held_messages.get_nowait()
+            except Queue.Empty:
+                return
+            self.publish_messages(element['time_stamp'], element['type'], element['data'])
+
+    @staticmethod
+    def coalesce(elements, merge=False):
+        """ Reduce the WeeWX data to the archive records, in order, and the newest loop packet.
+            The newest loop packet keeps its position relative to the archive records.
+            With merge, the fields of the older loop packets that the newest does not have are merged into it. """
+        newest_loop = None
+        merged = {}
+        for element in elements:
+            if element is not None and element['type'] == 'loop':
+                # The values of loop packets in a different unit system cannot be mixed.
+                if merged and element['data'].get('usUnits') != merged.get('usUnits'):
+                    merged = {}
+                merged.update(element['data'])
+                newest_loop = element
+
+        coalesced = []
+        for element in elements:
+            if element is None or (element['type'] == 'loop' and element is not newest_loop):
+                continue
+            if merge and element is newest_loop:
+                element = {**element, 'data': merged}
+            coalesced.append(element)
+
+        return coalesced
+
+    def catch_up(self, element):
+        """ Drain the queue in one step and coalesce it, merging the loop packets. """
+        elements = [element] + self.data_queue.get_all()
+        caught_up = self.coalesce(elements, merge=True)
+        self.logger.loginf(f"Catching up, reduced {len(elements)} queued elements to {len(caught_up)}.")
+        return caught_up
+
+    def next_element(self, timeout):
+        """ Get the next WeeWX data to publish.
+            The backlog from before the thread started is published first, at no more than 'backlog_rate' per second. """
+        if self.backlog:
+            wait = self.next_backlog - time.time()
+            while wait > 0:
+                # Wait on the queue, so that shutting down is not held up by the backlog.
+                try:
+                    element = self.data_queue.get(timeout=wait)
+                except Queue.Empty:
+                    break
+                if element is None:
+                    return None
+                # It is newer than the backlog, so it is published after it.
+                self.backlog.append(element)
+                wait = self.next_backlog - time.time()
+            self.next_backlog = time.time() + 1 / self.mqtt_config.get('backlog_rate', 10)
+            return self.backlog.popleft()
+
+        # Block until there is data, the paho network thread handles the MQTT traffic in the meantime.
+        return self.data_queue.get(timeout=timeout)
+
+    def next_elements(self, timeout):
+        """ Get the next WeeWX data to publish, caught up when the queue has reached the 'catch_up_threshold'.
+            The queue is only caught up once the backlog has been replayed, so that the data stays in order. """
+        element = self.next_element(timeout)
+        # Woken up to check if processing should continue.
+        if element is None:
+            return []
+
+        catch_up_threshold = self.mqtt_config.get('catch_up_threshold', 0)
+        if catch_up_threshold and not self.backlog and self.data_queue.qsize() >= catch_up_threshold:
+            return self.catch_up(element)
+        return [element]
+
+    def open_connections(self):
+        """ Open the 'connections' to the default broker.
+            Only the first connection has the availability topic and the plugins. """
+        self.connections = [self.publisher]
+        for index in range(1, self.mqtt_config.get('connections', 1)):
+            connection_config = {**self.mqtt_config, 'clientid': f"{self.mqtt_config['clientid']}-{index}", 'lwt': None}
+            connection = AbstractPublisher.get_publisher(self.logger, PluginManager(self.logger), self, connection_config)
+            self.connections.append(connection)
+        self.topic_ring = TopicRing(len(self.connections))
+
+        # A topic is published on one connection, but the connections share the topic rates.
+        topic_buckets = RateLimiter.create_topic_buckets(self.topic_rates)
+        for connection in self.connections:
+            rate_limiter = RateLimiter.create(connection, self.mqtt_config, topic_buckets)
+            if rate_limiter is not None:
+                self.rate_limiters[connection] = rate_limiter
+
+        for connection in self.connections:
+            if self.mqtt_config.get('brokers'):
+                # Its messages wait while it is disconnected, see publish_row, so it keeps trying to connect.
+                connection.keep_connecting = True
+            connection.start_network_loop()
+
+    def flush_rate_limiters(self):
+        """ Publish the rate limited messages of the connected connections.
+            Returns the message infos and the seconds until the next message can be published, None when none are queued. """
+        message_infos = []
+        wait = None
+        for connection, rate_limiter in self.rate_limiters.items():
+            if not connection.connected:
+                continue
+            (published, limiter_wait) = rate_limiter.flush()
+            message_infos.extend(published)
+            if limiter_wait is not None:
+                wait = limiter_wait if wait is None else min(wait, limiter_wait)
+        return message_infos, wait
+
+    def connection(self, topic):
+        """ The connection that publishes the topic. """
+        if len(self.connections) < 2:
+            return self.publisher
+        return self.connections[self.topic_ring.get(topic)]
+
+    def open_spool(self):
+        """ Open the spool, when it is enabled. """
+        spool_dict = self.mqtt_config.get('spool')
+        if spool_dict is None or not to_bool(spool_dict.get('enable', True)):
+            return
+
+        path = spool_dict.get('path', 'mqttpublish-spool.sdb')
+        if not os.path.isabs(path):
+            # By default, the spool is kept with the WeeWX SQLite databases.
+            config_dict = self.weewx_dict['config_dict']
+            sqlite_root = config_dict.get('DatabaseTypes', {}).get('SQLite', {}).get('SQLITE_ROOT', 'archive')
+            path = os.path.join(config_dict.get('WEEWX_ROOT', ''), sqlite_root, path)
+
+        self.replay_rate = to_float(spool_dict.get('replay_rate', 100))
+        self.spool = Spool(self.logger, path, to_int(spool_dict.get('max_messages', 100000)))
+
+    def replay_spool(self):
+        """ Publish the next batch of spooled messages.
+            A message stays spooled until it is sent (qos 0) or acknowledged (qos 1 and 2).
+            Returns the number of seconds until the next batch, to stay within 'replay_rate'. """
+        connects = sum(connection.connects for connection in self.connections)
+        if connects != self.spool_connects:
+            # The messages not acknowledged before the connection was lost are replayed again.
+            self.spool_replayed.clear()
+            self.spool_connects = connects
+        self.remove_replayed()
+
+        after_id = self.spool_replayed[-1][0] if self.spool_replayed else 0
+        # About ten batches a second, below 10 messages a second a batch is a message.
+        rows = self.spool.peek(max(1, int(self.replay_rate / 10)), after_id)
+        for (row_id, time_stamp, topic, payload, qos, retain, options) in rows:
+            if not self.publisher.connected:
+                break
+            if options and options.get('message_expiry_interval'):
+                # The message expires the same time it would have, had it been published when spooled.
+                remaining = int(options['message_expiry_interval'] - (time.time() - time_stamp))
+                if remaining <= 0:
+                    self.spool_replayed.append((row_id, None))
+                    continue
+                options = {**options, 'message_expiry_interval': remaining}
+            message_info = self.connection(topic).publish_message(time_stamp, qos, bool(retain), topic, payload, options)
+            if message_info.rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            self.spool_replayed.append((row_id, message_info))
+        self.remove_replayed()
+
+        if not rows:
+            # Waiting for the replayed messages to be acknowledged.
+            return 0.1
+        return len(rows) / self.replay_rate
+
+    def remove_replayed(self):
+        """ Remove the replayed messages from the spool, up to the first one not yet acknowledged. """
+        last_id = None
+        while self.spool_replayed and (self.spool_replayed[0][1] is None or self.spool_replayed[0][1].is_published()):
+            (last_id, _) = self.spool_replayed.popleft()
+
+        if last_id is not None:
+            self.spool.remove(last_id)
+            if not self.spool.count:
+                self.logger.loginf("Replayed the spool, publishing live data.")
+
+    def publish_metrics(self):
+        """ Publish the metrics as a JSON message and, optionally, write them to a Prometheus file. """
+        now = time.time()
+        snapshot = {
+            'time_stamp': int(now),
+            'uptime': int(now - self.metrics.started),
+            'queue_depth': self.data_queue.qsize(),
+            'queue_shed': dict(self.data_queue.shed),
+            'records': dict(self.metrics.records),
+            'records_per_second': round(self.metrics.records_per_second(now), 3),
+            'messages': self.metrics.messages,
+            'bytes': self.metrics.bytes,
+            'topics': dict(self.metrics.topic_messages),
+            'publish_latency': {
+                'count': self.publish_latency['count'],
+                'average': round(self.publish_latency['total'] / max(1, self.publish_latency['count']) * 1000, 3),
+                'maximum': round(self.publish_latency['maximum'] * 1000, 3),
+            },
+            'connected': self.publisher.connected,
+            'connects': self.publisher.connects,
+            'connections': [connection.connected for connection in self.connections],
+            'inflight': sum(len(connection.inflight) for connection in self.connections),
+            'inflight_timeouts': sum(connection.inflight_timeouts for connection in self.connections),
+            'ack_latency': self.publisher.ack_latency.dump(),
+            'brokers': {broker: broker_thread.statistics() for broker, broker_thread in self.brokers.items()},
+            'thread_restarts': self.metrics.thread_restarts,
+            'suppressed_fields': self.metrics.suppressed_fields,
+            'interval_skips': self.metrics.interval_skips,
+            'spool': self.spool.count if self.spool is not None else None,
+            'rate_limit': {
+                'pending': sum(len(rate_limiter.pending) for rate_limiter in self.rate_limiters.values()),
+                'replaced': sum(rate_limiter.replaced for rate_limiter in self.rate_limiters.values()),
+            } if self.rate_limiters else None,
+        }
+
+        if self.publisher.connected:
+            self.publisher.client.publish(self.metrics.topic, dumps_json(snapshot), qos=self.metrics.qos, retain=self.metrics.retain)
+        if self.metrics.prometheus_file:
+            self.metrics.write_prometheus(snapshot)
+
+    def update_publish_latency(self, time_stamp, message_count, latency):
+        """ Track how long it takes to publish a record. """
+        self.publish_latency['count'] += 1
+        self.publish_latency['total'] += latency
+        self.publish_latency['maximum'] = max(self.publish_latency['maximum'], latency)
+        self.logger.logdbg("Published %s messages of %d in %.1f ms.", message_count, time_stamp, latency * 1000)
 
     def run(self):
         threading.current_thread().name = f"MQTTPublish-{threading.get_native_id()}"
@@ -1049,58 +2703,128 @@ class PublishWeeWXThread(threading.Thread):
             self.plugin_manager.create_plugin(plugin_name, self.plugins[plugin], self.mqtt_config, self.all_topics, self.weewx_dict)
 
         # need to instantiate inside thread
+        self.open_spool()
         self.publisher = AbstractPublisher.get_publisher(self.logger, self.plugin_manager, self, self.mqtt_config)
+        self.open_connections()
+        for broker, broker_config in self.mqtt_config.get('brokers', {}).items():
+            self.brokers[broker] = BrokerThread(self.logger, broker, broker_config, self.topic_rates)
+            self.brokers[broker].start()
 
         with weewx.manager.open_manager(self.manager_dict) as db_manager:
             self.db_manager = db_manager
 
             queue_size = self.data_queue.qsize()
             self.logger.loginf(f"Before emptying, queue size is {queue_size}")
+            backlog = []
             for _ in range(queue_size):
                 try:
-                    self.data_queue.get_nowait()
-                except queue.Empty:
+                    backlog.append(self.data_queue.get_nowait())
+                except Queue.Empty:
                     break
             self.logger.loginf(f"After emptying, queue size is {self.data_queue.qsize()}")
+            if self.mqtt_config.get('replay_backlog', False):
+                self.backlog.extend(self.coalesce(backlog))
+                self.logger.loginf(f"Replaying {len(self.backlog)} of the {len(backlog)} elements emptied from the queue.")
 
             while self.process:
-                try:
-                    data2 = self.data_queue.get_nowait()
-
-                    self.start_time = time.time()
-                    self.profile(f"profile: queue size {self.data_queue.qsize()} at {self.start_time}")
-
-                    for plugin_name in self.plugin_manager.callbacks['on_weewx_data']['immediate']:
-                        self.plugin_manager.callbacks['on_weewx_data']['immediate'][plugin_name](data2)
-
-                    time_stamp = data2['time_stamp']
-                    data_type = data2['type']
-                    data = data2['data']
-                    if data_type == 'loop':
-                        self.publish_row(time_stamp, data, self.topics_loop)
-                    elif data_type == 'archive':
-                        self.publish_row(time_stamp, data, self.topics_archive)
+                timeout = self.mqtt_config['wait_for_queue_element']
+                if self.spool is not None:
+                    # While disconnected the data is spooled, once connected the spool is replayed.
+                    if self.spool.count and self.publisher.connected:
+                        now = time.time()
+                        if now >= self.next_replay:
+                            self.next_replay = now + self.replay_spool()
+                        timeout = max(0, min(timeout, self.next_replay - now))
+                    elif self.spool.count:
+                        # Check for the connection at least every second, so that the replay starts promptly.
+                        timeout = min(timeout, 1)
+                elif not self.publisher.connected and not self.brokers:
+                    # While disconnected the data stays queued, where the 'queue_overflow_policy' applies.
+                    try:
+                        self.publisher.wait_for_connection(self.mqtt_config['wait_for_queue_element'])
+                    except CannotConnectError:
+                        self.process = False
+                    continue
+                elif self.held_messages.qsize():
+                    if self.publisher.connected:
+                        self.publish_held_messages()
                     else:
-                        self.logger.logerr(f"Unknown data type, {data_type}")
-
-                    for plugin_name in self.plugin_manager.callbacks['on_weewx_data']['delay']:
-                        self.plugin_manager.callbacks['on_weewx_data']['delay'][plugin_name](data2)
+                        # Check for the connection at least every second, so that the held messages are published promptly.
+                        timeout = min(timeout, 1)
+
+                if self.rate_limiters:
+                    # Wake up when the next rate limited message can be published.
+                    try:
+                        (_, wait) = self.flush_rate_limiters()
+                    except CannotConnectError:
+                        self.process = False
+                        continue
+                    if wait is not None:
+                        timeout = min(timeout, wait)
+
+                start = self.profiler.start()
+                try:
+                    elements = self.next_elements(timeout)
                 except Queue.Empty:
-                    self.publisher.client.loop(timeout=0.1)
-                    self.threading_event.wait(self.mqtt_config['wait_for_queue_element'])
-                    self.threading_event.clear()
-                except CannotConnectError:
-                    self.process = False
-
-        # MQTT's LWT is sent from the broker on an unexpected disconnect.
-        # So we need to send an offline message on an 'expected' disconnect.
-        if self.lwt_dict is not None and to_bool(self.lwt_dict.get('enable', True)):
-            self.publisher.client.publish(topic=self.lwt_dict.get('topic', 'status'),
-                                          payload=self.lwt_dict.get('offline_payload', 'offline'),
-                                          qos=to_int(self.lwt_dict.get('qos', 0)),
-                                          retain=to_bool(self.lwt_dict.get('retain', True)))
-
-        self.publisher.client.disconnect()
+                    self.profiler.log_if_due()
+                    if self.metrics.due():
+                        self.publish_metrics()
+                    continue
+                self.profiler.stop(start, 'dequeue_wait')
+
+                for element in elements:
+                    try:
+                        for plugin_name in self.plugin_manager.callbacks['on_weewx_data']['immediate']:
+                            self.plugin_manager.callbacks['on_weewx_data']['immediate'][plugin_name](element)
+
+                        time_stamp = element['time_stamp']
+                        data_type = element['type']
+                        data = element['data']
+                        if data_type == 'loop':
+                            self.publish_row(time_stamp, data, self.topics_loop, data_type)
+                        elif data_type == 'archive':
+                            self.publish_row(time_stamp, data, self.topics_archive, data_type)
+                        else:
+                            self.logger.logerr(f"Unknown data type, {data_type}")
+                        self.metrics.records[data_type] += 1
+
+                        for plugin_name in self.plugin_manager.callbacks['on_weewx_data']['delay']:
+                            self.plugin_manager.callbacks['on_weewx_data']['delay'][plugin_name](element)
+                    except CannotConnectError:
+                        self.process = False
+                        break
+
+                self.profiler.log_if_due()
+                if self.metrics.due():
+                    self.publish_metrics()
+
+        if self.spool is not None:
+            self.logger.loginf(f"Spool has {self.spool.count} messages, dropped {self.spool.dropped} messages.")
+            self.spool.close()
+
+        for broker in self.brokers.values():
+            broker.stop()
+        if self.brokers:
+            self.logger.loginf((f"Held messages of the default broker shed loop: {self.held_messages.shed['loop']} "
+                                f"archive: {self.held_messages.shed['archive']}."))
+            if self.held_messages.qsize():
+                self.logger.logerr(f"Messages of {self.held_messages.qsize()} records were not published to the default broker.")
+
+        for rate_limiter in self.rate_limiters.values():
+            rate_limiter.log_summary()
+
+        for timing in ['immediate', 'delay']:
+            for plugin_name in self.plugin_manager.callbacks['on_shutdown'][timing]:
+                self.plugin_manager.callbacks['on_shutdown'][timing][plugin_name]()
+
+        self.publisher.publish_offline()
+        for connection in self.connections:
+            connection.stop_network_loop()
+        self.profiler.log_summary()
+        if self.publish_latency['count']:
+            self.logger.loginf((f"Published {self.publish_latency['count']} records, "
+                                f"average latency {self.publish_latency['total'] / self.publish_latency['count'] * 1000:.1f} ms, "
+                                f"maximum latency {self.publish_latency['maximum'] * 1000:.1f} ms."))
         self.logger.loginf(f"Exited publishing loop {self.name}.")
 
 if __name__ == "__main__":
@@ -1158,7 +2882,7 @@ if __name__ == "__main__":
             engine.dispatchEvent(new_loop_packet_event)
 
         loop_count = 0
-        while mqtt_publish._thread.threading_event.is_set() and loop_count < max_loops:  # pylint: disable=protected-access
+        while not mqtt_publish.data_queue.empty() and loop_count < max_loops:
             print("sleepting")
             time.sleep(1)
             loop_count += 1
@@ -0,0 +1,68 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=invalid-name
+""" Time PublishWeeWXThread.update_record with the cached field plans and with the plans compiled for every record.
+
+    PYTHONPATH=bin python bin/user/tests/benchmark_field_plans.py [--topics 10] [--fields 100] [--runs 200]
+"""
+import argparse
+import timeit
+
+import mock
+
+import user.mqttpublish
+
+def create_topic_dict(fields):
+    """ A topic converting to float, rounding, and converting the unit of outTemp. """
+    return {
+        'unit_system': 1,
+        'minimum_interval': None,
+        'suppression_threshold': 0,
+        'ignore': False,
+        'publish_none_value': False,
+        'append_unit_label': True,
+        'conversion_type': 'float',
+        'round': 2,
+        'format_string': None,
+        'fields': {
+            'outTemp': {'unit': 'degree_C'},
+            **{field: {} for field in fields},
+        },
+        'data_last_published': {},
+        'field_plans': {},
+    }
+
+def main():
+    """ Run the benchmark. """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--topics', type=int, default=10)
+    parser.add_argument('--fields', type=int, default=100)
+    parser.add_argument('--runs', type=int, default=200)
+    options = parser.parse_args()
+
+    fields = [f'field{index}' for index in range(options.fields - 3)]
+    record = {'dateTime': 1700000000, 'usUnits': 1, 'outTemp': 68.123,
+              **{field: index * 1.2345 for index, field in enumerate(fields)}}
+    topics = [create_topic_dict(fields) for _ in range(options.topics)]
+    publish_thread = user.mqttpublish.PublishWeeWXThread(mock.Mock(), {}, None, None, {}, {}, {}, None)
+
+    def cached():
+        for topic_dict in topics:
+            publish_thread.update_record(topic_dict, record['dateTime'], record)
+
+    def uncached():
+        for topic_dict in topics:
+            topic_dict['field_plans'].clear()
+            publish_thread.update_record(topic_dict, record['dateTime'], record)
+
+    for name, function in (('compiled every record', uncached), ('cached plans', cached)):
+        function()
+        seconds = timeit.timeit(function, number=options.runs)
+        print(f"{name}: {seconds / options.runs * 1000:.2f} ms per record, "
+              f"{options.topics} topics of {len(record)} fields")
+
+if __name__ == '__main__':
+    main()
@@ -100,6 +100,9 @@ class ClientStub:
     def reconnect_delay_set(self, min_delay=None, max_delay=None):  # need to match pylint: disable=unused-argument
         return
 
+    def max_inflight_messages_set(self, inflight):  # need to match pylint: disable=unused-argument
+        return
+
     def connect(self, host, port, keepalive, clean_start=None):  # need to match pylint: disable=unused-argument
         # default is for connection to be sucessful (call on_connect)
         self.connect_with_connection(host, port, keepalive, clean_start)
@@ -111,6 +114,21 @@ class ClientStub:
     def loop(self, timeout=0):  # need to match pylint: disable=unused-argument
         return
 
+    def loop_start(self):
+        return
+
+    def loop_stop(self):
+        return
+
+    def disconnect(self):
+        return
+
+    def socket(self):
+        return None
+
+    def loop_misc(self):
+        return
+
     # The following routines are used for testing only
 
     # used to 'override' the connect method and not 'perform' the connection (call on_connect)
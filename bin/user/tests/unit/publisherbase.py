@@ -11,6 +11,7 @@ import configobj
 import paho.mqtt
 import random
 import ssl
+import time
 
 import unittest
 import mock
@@ -187,20 +188,24 @@ class PublisherBase(unittest.TestCase):
             'port': random.randint(1, 65535),
             'keepalive': random.randint(1, 30),
             'max_retries': random.choice([0, 2]),
-            'wait_for_connection': random.randint(0, 10),
+            'wait_between_retries': random.randint(0, 10),
         }
         config = configobj.ConfigObj(config_dict)
 
-        with mock.patch('user.mqttpublish.time'):
-            with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
-                with mock.patch.object(user.mqttpublish.mqtt.Client,
-                                       'connect',
-                                       side_effect=mqttstubs.ClientStub.connect_with_connection,
-                                       autospec=True) as mock_connect:
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            with mock.patch.object(user.mqttpublish.mqtt.Client,
+                                   'connect',
+                                   side_effect=mqttstubs.ClientStub.connect_with_connection,
+                                   autospec=True) as mock_connect:
 
-                    self.class_under_test(mock_logger, mock_plugin_manager, mock_publisher, config)
+                SUT = self.class_under_test(mock_logger, mock_plugin_manager, mock_publisher, config)
+                SUT.start_network_loop()
 
-                    self.assertEqual(mock_connect.call_count, 1)
+                self.assertTrue(SUT.wait_for_connection(5))
+                SUT.stop_network_loop()
+
+                self.assertEqual(mock_connect.call_count, 1)
+                self.assertEqual(SUT.connection_state, 'stopped')
 
     def test_connect_no_connection(self):
         mock_logger = mock.Mock()
@@ -217,25 +222,40 @@ class PublisherBase(unittest.TestCase):
             'keepalive': random.randint(1, 30),
             'max_retries': random.choice([0, 2]),
             'wait_between_retries': random.randint(0, 10),
-            'wait_for_connection': random.randint(0, 10),
         }
         config = configobj.ConfigObj(config_dict)
 
-        with mock.patch('user.mqttpublish.time'):
-            with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
-                with mock.patch.object(user.mqttpublish.mqtt.Client,
-                                       'connect',
-                                       side_effect=mqttstubs.ClientStub.connect_without_connection,
-                                       autospec=True) as mock_connect:
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            with mock.patch.object(user.mqttpublish.mqtt.Client,
+                                   'connect',
+                                   side_effect=mqttstubs.ConnetExceptionTest,
+                                   autospec=True) as mock_connect:
+                with mock.patch.object(user.mqttpublish.AbstractPublisher, 'retry_delay', return_value=0) as mock_retry_delay:
+
+                    SUT = self.class_under_test(mock_logger, None, mock_publisher, config)
+                    SUT.start_network_loop()
+                    SUT.connection_thread.join(5)
 
-                    self.class_under_test(mock_logger, None, mock_publisher, config)
+                    with self.assertRaises(user.mqttpublish.CannotConnectError):
+                        SUT.wait_for_connection(0)
 
                     self.assertEqual(mock_connect.call_count, config_dict['max_retries'] + 1)
+                    self.assertEqual(mock_retry_delay.call_args_list,
+                                     [mock.call(attempt) for attempt in range(1, config_dict['max_retries'] + 1)])
+                    self.assertEqual(mock_logger.logerr.call_count, config_dict['max_retries'] + 2)
 
     def test_connect_first_call_exception(self):
         mock_logger = mock.Mock()
+        mock_plugin_manager = mock.Mock()
         mock_publisher = mock.Mock()
 
+        mock_plugin_manager.callbacks = {
+            'on_mqtt_connect': {
+                'immediate': {},
+                'delay': {}
+            },
+        }
+
         config_dict = {
             'protocol': getattr(paho.mqtt.client, self.protocol_string, 0),
             'clientid': helpers.random_string(),
@@ -245,25 +265,33 @@ class PublisherBase(unittest.TestCase):
             'host': helpers.random_string(),
             'port': random.randint(1, 65535),
             'keepalive': random.randint(1, 30),
-            'max_retries': random.choice([0, 2]),
+            'max_retries': random.choice([1, 2]),
             'wait_between_retries': random.randint(0, 10),
-            'wait_for_connection': random.randint(0, 10),
         }
         config = configobj.ConfigObj(config_dict)
 
-        with mock.patch('user.mqttpublish.time'):
-            with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
-                with mock.patch.object(user.mqttpublish.mqtt.Client,
-                                       'connect',
-                                       side_effect=mqttstubs.ClientStub.connect_exception_first_call,
-                                       autospec=True) as mock_connect:
+        def connect_exception_first_call(client, host, port, keepalive, clean_start=None):
+            client.connect_exception_first_call(host, port, keepalive, clean_start)
+            client.connect_with_connection(host, port, keepalive, clean_start)
 
-                    self.class_under_test(mock_logger, None, mock_publisher, config)
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            with mock.patch.object(user.mqttpublish.mqtt.Client,
+                                   'connect',
+                                   side_effect=connect_exception_first_call,
+                                   autospec=True) as mock_connect:
+                with mock.patch.object(user.mqttpublish.AbstractPublisher, 'retry_delay', return_value=0):
 
-                    self.assertEqual(mock_connect.call_count, config_dict['max_retries'] + 1)
+                    SUT = self.class_under_test(mock_logger, mock_plugin_manager, mock_publisher, config)
+                    SUT.start_network_loop()
+
+                    self.assertTrue(SUT.wait_for_connection(5))
+                    SUT.stop_network_loop()
+
+                    self.assertEqual(mock_connect.call_count, 2)
                     self.assertEqual(mock_logger.logerr.call_count, 1)
+                    self.assertEqual(SUT.connection_attempts, 0)
 
-    def test_connect_subsequent_call_exception(self):
+    def test_retry_delay(self):
         mock_logger = mock.Mock()
         mock_publisher = mock.Mock()
 
@@ -276,23 +304,133 @@ class PublisherBase(unittest.TestCase):
             'host': helpers.random_string(),
             'port': random.randint(1, 65535),
             'keepalive': random.randint(1, 30),
-            'max_retries': random.choice([1, 2]),
+            'max_retries': random.choice([0, 2]),
             'wait_between_retries': random.randint(0, 10),
-            'wait_for_connection': random.randint(0, 10),
         }
         config = configobj.ConfigObj(config_dict)
 
-        with mock.patch('user.mqttpublish.time'):
-            with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
-                with mock.patch.object(user.mqttpublish.mqtt.Client,
-                                       'connect',
-                                       side_effect=mqttstubs.ClientStub.connect_exception_subsequent_calls,
-                                       autospec=True) as mock_connect:
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            SUT = self.class_under_test(mock_logger, None, mock_publisher, config)
 
-                    self.class_under_test(mock_logger, None, mock_publisher, config)
+            for attempt in range(1, 10):
+                maximum = min(config_dict['wait_between_retries'], 2 ** (attempt - 1))
+                delay = SUT.retry_delay(attempt)
+                self.assertGreaterEqual(delay, maximum / 2)
+                self.assertLessEqual(delay, maximum)
 
-                    self.assertEqual(mock_connect.call_count, config_dict['max_retries'] + 1)
-                    self.assertEqual(mock_logger.logerr.call_count, config_dict['max_retries'])
+    def create_publisher(self, mock_logger, max_inflight=0, inflight_timeout=30):
+        config_dict = {
+            'protocol': getattr(paho.mqtt.client, self.protocol_string, 0),
+            'clientid': helpers.random_string(),
+            'log_mqtt': False,
+            'username': None,
+            'password': None,
+            'host': helpers.random_string(),
+            'port': random.randint(1, 65535),
+            'keepalive': random.randint(1, 30),
+            'max_retries': random.randint(0, 10),
+            'max_inflight': max_inflight,
+            'inflight_timeout': inflight_timeout,
+        }
+        config = configobj.ConfigObj(config_dict)
+
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            SUT = self.class_under_test(mock_logger, None, mock.Mock(), config)
+        SUT.connected = True
+        SUT.client = mock.Mock()
+        return SUT
+
+    def test_acknowledge(self):
+        mock_logger = mock.Mock()
+        mid = random.randint(1, 65535)
+        qos = random.randint(1, 2)
+
+        SUT = self.create_publisher(mock_logger)
+        SUT.client.publish.return_value = mock.Mock(mid=mid, rc=paho.mqtt.client.MQTT_ERR_SUCCESS)
+
+        SUT.publish_message(random.randint(1, 100), qos, False, helpers.random_string(), helpers.random_string())
+
+        self.assertIn(mid, SUT.inflight)
+        self.assertEqual(SUT.inflight_pending, 1)
+
+        SUT.on_publish(None, None, mid, None, None)
+
+        self.assertDictEqual(SUT.inflight, {})
+        self.assertEqual(SUT.inflight_pending, 0)
+        self.assertEqual(SUT.ack_latency.stages[('ack', f'qos{qos}')]['count'], 1)
+
+    def test_acknowledge_before_publish_returns(self):
+        mock_logger = mock.Mock()
+        mid = random.randint(1, 65535)
+
+        SUT = self.create_publisher(mock_logger)
+
+        def publish(*_args, **_kwargs):
+            SUT.on_publish(None, None, mid, None, None)
+            return mock.Mock(mid=mid, rc=paho.mqtt.client.MQTT_ERR_SUCCESS)
+        SUT.client.publish.side_effect = publish
+
+        SUT.publish_message(random.randint(1, 100), 1, False, helpers.random_string(), helpers.random_string())
+
+        self.assertDictEqual(SUT.inflight, {})
+        self.assertDictEqual(SUT.early_acks, {})
+        self.assertEqual(SUT.inflight_pending, 0)
+        self.assertEqual(SUT.ack_latency.stages[('ack', 'qos1')]['count'], 1)
+
+    def test_acknowledge_of_untracked_message(self):
+        mock_logger = mock.Mock()
+
+        SUT = self.create_publisher(mock_logger)
+
+        SUT.on_publish(None, None, random.randint(1, 65535), None, None)
+
+        self.assertDictEqual(SUT.early_acks, {})
+
+    def test_stale_acknowledge_is_ignored(self):
+        mock_logger = mock.Mock()
+        mid = random.randint(1, 65535)
+
+        SUT = self.create_publisher(mock_logger)
+        SUT.early_acks[mid] = time.perf_counter() - 1
+        SUT.client.publish.return_value = mock.Mock(mid=mid, rc=paho.mqtt.client.MQTT_ERR_SUCCESS)
+
+        SUT.publish_message(random.randint(1, 100), 1, False, helpers.random_string(), helpers.random_string())
+
+        self.assertIn(mid, SUT.inflight)
+        self.assertEqual(SUT.inflight_pending, 1)
+
+    def test_unacknowledged_messages_are_pruned(self):
+        mock_logger = mock.Mock()
+
+        SUT = self.create_publisher(mock_logger, inflight_timeout=0)
+        SUT.client.publish.side_effect = [mock.Mock(mid=1, rc=paho.mqtt.client.MQTT_ERR_SUCCESS),
+                                          mock.Mock(mid=2, rc=paho.mqtt.client.MQTT_ERR_SUCCESS)]
+
+        SUT.publish_message(random.randint(1, 100), 0, False, helpers.random_string(), helpers.random_string())
+        SUT.publish_message(random.randint(1, 100), 0, False, helpers.random_string(), helpers.random_string())
+
+        self.assertEqual(list(SUT.inflight), [2])
+        self.assertEqual(SUT.inflight_timeouts, 1)
+
+        SUT.on_publish(None, None, random.randint(3, 65535), None, None)
+
+        self.assertDictEqual(SUT.inflight, {})
+        self.assertEqual(SUT.inflight_timeouts, 2)
+
+    def test_inflight_window_full(self):
+        mock_logger = mock.Mock()
+
+        SUT = self.create_publisher(mock_logger, max_inflight=1, inflight_timeout=0)
+        SUT.client.publish.side_effect = [mock.Mock(mid=1, rc=paho.mqtt.client.MQTT_ERR_SUCCESS),
+                                          mock.Mock(mid=2, rc=paho.mqtt.client.MQTT_ERR_SUCCESS)]
+
+        SUT.publish_message(random.randint(1, 100), 1, False, helpers.random_string(), helpers.random_string())
+        SUT.publish_message(random.randint(1, 100), 1, False, helpers.random_string(), helpers.random_string())
+
+        self.assertEqual(list(SUT.inflight), [2])
+        self.assertEqual(SUT.inflight_pending, 1)
+        self.assertEqual(SUT.inflight_timeouts, 1)
+        mock_logger.logerr.assert_called_once()
 
     def test_will_set_with_defaults(self):
         mock_logger = mock.Mock()
@@ -431,17 +569,62 @@ class PublisherBase(unittest.TestCase):
                             mock_reconnect.assert_called_once_with()
                             mock_publish.assert_called_once_with(topic, data, qos=qos, retain=retain)
 
-    def test_reconnect_connection(self):
+    def test_wait_for_publish(self):
         mock_logger = mock.Mock()
-        mock_plugin_manager = mock.Mock()
         mock_publisher = mock.Mock()
 
-        mock_plugin_manager.callbacks = {
-            'on_mqtt_connect': {
-                'immediate': {},
-                'delay': {}
-            },
+        config_dict = {
+            'protocol': getattr(paho.mqtt.client, self.protocol_string, 0),
+            'clientid': helpers.random_string(),
+            'log_mqtt': random.choice([True, False]),
+            'username': None,
+            'password': None,
+        }
+        config = configobj.ConfigObj(config_dict)
+
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            with mock.patch.object(user.mqttpublish.AbstractPublisher, '_connect'):
+                SUT = self.class_under_test(mock_logger, None, mock_publisher, config)
+
+                message_infos = [mock.Mock(), mock.Mock()]
+                message_infos[0].is_published.return_value = True
+                message_infos[1].is_published.return_value = random.choice([True, False])
+
+                published = SUT.wait_for_publish(message_infos, random.randint(1, 10))
+
+                self.assertEqual(published, message_infos[1].is_published.return_value)
+                for message_info in message_infos:
+                    message_info.wait_for_publish.assert_called_once()
+
+    def test_wait_for_publish_exception(self):
+        mock_logger = mock.Mock()
+        mock_publisher = mock.Mock()
+
+        config_dict = {
+            'protocol': getattr(paho.mqtt.client, self.protocol_string, 0),
+            'clientid': helpers.random_string(),
+            'log_mqtt': random.choice([True, False]),
+            'username': None,
+            'password': None,
         }
+        config = configobj.ConfigObj(config_dict)
+
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            with mock.patch.object(user.mqttpublish.AbstractPublisher, '_connect'):
+                SUT = self.class_under_test(mock_logger, None, mock_publisher, config)
+
+                message_info = mock.Mock()
+                message_info.wait_for_publish.side_effect = RuntimeError
+
+                published = SUT.wait_for_publish([message_info], random.randint(1, 10))
+
+                self.assertFalse(published)
+                mock_logger.logerr.assert_called_once()
+
+    def test_reconnect_connection(self):
+        mock_logger = mock.Mock()
+        mock_plugin_manager = mock.Mock()
+        mock_publisher = mock.Mock()
 
         config_dict = {
             'protocol': getattr(paho.mqtt.client, self.protocol_string, 0),
@@ -453,35 +636,25 @@ class PublisherBase(unittest.TestCase):
             'port': random.randint(1, 65535),
             'keepalive': random.randint(1, 30),
             'max_retries': random.randint(0, 10),
-            'wait_for_connection': random.randint(0, 10),
+            'wait_between_retries': random.randint(0, 10),
         }
         config = configobj.ConfigObj(config_dict)
 
-        with mock.patch('user.mqttpublish.time'):
-            with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
-                with mock.patch.object(user.mqttpublish.AbstractPublisher, '_connect'):
-                    with mock.patch.object(user.mqttpublish.mqtt.Client,
-                                           'reconnect',
-                                           side_effect=mqttstubs.ClientStub.reconnect_with_connection,
-                                           autospec=True) as mock_reconnect:
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            with mock.patch.object(user.mqttpublish.AbstractPublisher, '_connect'):
 
-                        SUT = self.class_under_test(mock_logger, mock_plugin_manager, mock_publisher, config)
-                        SUT._reconnect()
+                SUT = self.class_under_test(mock_logger, mock_plugin_manager, mock_publisher, config)
+                with mock.patch.object(SUT, 'wait_for_connection', return_value=True) as mock_wait_for_connection:
+
+                    SUT._reconnect()
 
-                        mock_reconnect.assert_called_once()
+                    mock_wait_for_connection.assert_called_once_with(config_dict['wait_between_retries'])
 
     def test_reconnect_no_connection(self):
         mock_logger = mock.Mock()
         mock_plugin_manager = mock.Mock()
         mock_publisher = mock.Mock()
 
-        mock_plugin_manager.callbacks = {
-            'on_mqtt_connect': {
-                'immediate': {},
-                'delay': {}
-            },
-        }
-
         config_dict = {
             'protocol': getattr(paho.mqtt.client, self.protocol_string, 0),
             'clientid': helpers.random_string(),
@@ -493,23 +666,21 @@ class PublisherBase(unittest.TestCase):
             'keepalive': random.randint(1, 30),
             'max_retries': random.randint(0, 10),
             'wait_between_retries': random.randint(0, 10),
-            'wait_for_connection': random.randint(0, 10),
         }
         config = configobj.ConfigObj(config_dict)
 
-        with mock.patch('user.mqttpublish.time'):
-            with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
-                with mock.patch.object(user.mqttpublish.AbstractPublisher, '_connect'):
-                    with mock.patch.object(user.mqttpublish.mqtt.Client,
-                                           'reconnect',
-                                           side_effect=mqttstubs.ClientStub.reconnect_without_connection,
-                                           autospec=True) as mock_reconnect:
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            with mock.patch.object(user.mqttpublish.AbstractPublisher, '_connect'):
 
-                        with self.assertRaises(user.mqttpublish.CannotConnectError):
-                            SUT = self.class_under_test(mock_logger, mock_plugin_manager, mock_publisher, config)
-                            SUT._reconnect()
+                SUT = self.class_under_test(mock_logger, mock_plugin_manager, mock_publisher, config)
+                with mock.patch.object(SUT, 'wait_for_connection',
+                                       side_effect=[False] * config_dict['max_retries'] + [user.mqttpublish.CannotConnectError]) \
+                        as mock_wait_for_connection:
+
+                    with self.assertRaises(user.mqttpublish.CannotConnectError):
+                        SUT._reconnect()
 
-                            self.assertEqual(mock_reconnect.call_count, config_dict['max_retries'] + 1)
+                    self.assertEqual(mock_wait_for_connection.call_count, config_dict['max_retries'] + 1)
 
 
 class TLSBase(unittest.TestCase):
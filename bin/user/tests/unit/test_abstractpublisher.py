@@ -67,5 +67,56 @@ class TestAbstractPublisher(unittest.TestCase):
 
                 mock_client.assert_called_once_with(mock_logger, None, mock_publisher, config)
 
+    def test_get_publisher_asyncio_for_paho_mqtt_v1(self):
+        mock_logger = mock.Mock()
+        mock_publisher = mock.Mock()
+
+        config_dict = {
+            'network_loop': 'asyncio',
+        }
+        config = configobj.ConfigObj(config_dict)
+
+        with mock.patch('user.mqttpublish.AsyncioPublisherV1') as mock_client:
+            with mqttstubs.patch_delattr(user.mqttpublish.mqtt, 'CallbackAPIVersion'):
+                user.mqttpublish.AbstractPublisher.get_publisher(mock_logger, None, mock_publisher, config)
+
+                mock_client.assert_called_once_with(mock_logger, None, mock_publisher, config)
+
+    def test_get_publisher_asyncio_for_paho_mqtt_v2(self):
+        mock_logger = mock.Mock()
+        mock_publisher = mock.Mock()
+
+        protocol_string = 'MQTTv5'
+
+        config_dict = {
+            'protocol': getattr(paho.mqtt.client, protocol_string, 0),
+            'network_loop': 'asyncio',
+        }
+        config = configobj.ConfigObj(config_dict)
+
+        with mock.patch('user.mqttpublish.AsyncioPublisherV2') as mock_client:
+            with mqttstubs.patch_addattr(user.mqttpublish.mqtt, 'CallbackAPIVersion'):
+                user.mqttpublish.AbstractPublisher.get_publisher(mock_logger, None, mock_publisher, config)
+
+                mock_client.assert_called_once_with(mock_logger, None, mock_publisher, config)
+
+    def test_get_publisher_asyncio_for_paho_mqtt_v2_mqtt_v3(self):
+        mock_logger = mock.Mock()
+        mock_publisher = mock.Mock()
+
+        protocol_string = random.choice(['MQTTv31', 'MQTTv311'])
+
+        config_dict = {
+            'protocol': getattr(paho.mqtt.client, protocol_string, 0),
+            'network_loop': 'asyncio',
+        }
+        config = configobj.ConfigObj(config_dict)
+
+        with mock.patch('user.mqttpublish.AsyncioPublisherV2MQTT3') as mock_client:
+            with mqttstubs.patch_addattr(user.mqttpublish.mqtt, 'CallbackAPIVersion'):
+                user.mqttpublish.AbstractPublisher.get_publisher(mock_logger, None, mock_publisher, config)
+
+                mock_client.assert_called_once_with(mock_logger, None, mock_publisher, config)
+
 if __name__ == '__main__':
     helpers.run_tests()
@@ -0,0 +1,104 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+import mock
+
+import helpers
+
+import configobj
+import random
+
+import paho.mqtt
+
+import user.mqttpublish
+import mqttstubs
+
+def create_config():
+    config_dict = {
+        'protocol': paho.mqtt.client.MQTTv311,
+        'clientid': helpers.random_string(),
+        'log_mqtt': False,
+        'username': None,
+        'password': None,
+        'host': helpers.random_string(),
+        'port': random.randint(1, 65535),
+        'keepalive': random.randint(1, 30),
+        'max_retries': 0,
+        'wait_between_retries': 1,
+        'network_loop': 'asyncio',
+    }
+    return configobj.ConfigObj(config_dict)
+
+@unittest.skipIf(not hasattr(paho.mqtt.client, 'CallbackAPIVersion'), "paho-mqtt is v1, skipping tests.")
+class TestAsyncioNetworkLoop(unittest.TestCase):
+    def test_connect_and_stop(self):
+        mock_logger = mock.Mock()
+
+        with mqttstubs.patch(user.mqttpublish.mqtt, "Client", mqttstubs.ClientStub):
+            SUT = user.mqttpublish.AsyncioPublisherV2MQTT3(mock_logger, mock.MagicMock(), mock.Mock(), create_config())
+
+            SUT.start_network_loop()
+            self.assertTrue(SUT.wait_for_connection(5))
+
+            self.assertEqual(SUT.client.connect_call_count, 1)
+            self.assertEqual(SUT.client.on_socket_open, SUT.on_socket_open)
+            self.assertEqual(SUT.client.on_socket_close, SUT.on_socket_close)
+
+            SUT.stop_network_loop()
+
+            self.assertEqual(SUT.connection_state, 'stopped')
+            self.assertTrue(SUT.connection_future.done())
+
+    def test_loop_write_removes_writer_once_written(self):
+        mock_logger = mock.Mock()
+        sock = mock.Mock()
+
+        with mock.patch('user.mqttpublish.mqtt.Client'):
+            SUT = user.mqttpublish.AsyncioPublisherV2MQTT3(mock_logger, None, mock.Mock(), create_config())
+            SUT.event_loop = mock.Mock()
+            SUT.client.socket.return_value = sock
+            SUT.client.want_write.return_value = False
+
+            SUT._loop_write(sock)
+
+            SUT.client.loop_write.assert_called_once()
+            SUT.event_loop.remove_writer.assert_called_once_with(sock)
+
+    def test_loop_write_keeps_writer(self):
+        mock_logger = mock.Mock()
+        sock = mock.Mock()
+
+        with mock.patch('user.mqttpublish.mqtt.Client'):
+            SUT = user.mqttpublish.AsyncioPublisherV2MQTT3(mock_logger, None, mock.Mock(), create_config())
+            SUT.event_loop = mock.Mock()
+            SUT.client.socket.return_value = sock
+            SUT.client.want_write.return_value = True
+
+            SUT._loop_write(sock)
+
+            SUT.client.loop_write.assert_called_once()
+            SUT.event_loop.remove_writer.assert_not_called()
+
+    def test_loop_write_closed_socket(self):
+        mock_logger = mock.Mock()
+        sock = mock.Mock()
+
+        with mock.patch('user.mqttpublish.mqtt.Client'):
+            SUT = user.mqttpublish.AsyncioPublisherV2MQTT3(mock_logger, None, mock.Mock(), create_config())
+            SUT.event_loop = mock.Mock()
+            SUT.client.socket.return_value = None
+            SUT.client.want_write.return_value = False
+
+            SUT._loop_write(sock)
+
+            SUT.client.loop_write.assert_called_once()
+            SUT.event_loop.remove_writer.assert_not_called()
+
+if __name__ == '__main__':
+    helpers.run_tests()
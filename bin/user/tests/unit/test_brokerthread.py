@@ -0,0 +1,105 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+import mock
+
+import helpers
+
+import random
+
+import user.mqttpublish
+
+def create_mqtt_config():
+    return {
+        'max_queue_size': 0,
+        'queue_overflow_policy': 'drop_oldest',
+        'queue_block_timeout': 1,
+        'wait_for_queue_element': 0,
+    }
+
+class TestBrokerThread(unittest.TestCase):
+    def test_put_when_not_running(self):
+        mock_logger = mock.Mock()
+
+        with mock.patch.object(user.mqttpublish.AbstractPublisher, 'get_publisher'):
+            SUT = user.mqttpublish.BrokerThread(mock_logger, helpers.random_string(), create_mqtt_config())
+
+        SUT.put(random.randint(1, 100), 'loop', [(helpers.random_string(), helpers.random_string(), 0, False, None)])
+
+        self.assertTrue(SUT.data_queue.empty())
+
+    def test_publishes_queued_messages(self):
+        mock_logger = mock.Mock()
+        time_stamp = random.randint(1, 100)
+        messages = [(helpers.random_string(), helpers.random_string(), random.randint(0, 2), False, None)
+                    for _ in range(random.randint(1, 5))]
+
+        with mock.patch.object(user.mqttpublish.AbstractPublisher, 'get_publisher'):
+            SUT = user.mqttpublish.BrokerThread(mock_logger, helpers.random_string(), create_mqtt_config())
+        SUT.publisher.connected = True
+
+        SUT.data_queue.put({'time_stamp': time_stamp, 'type': 'loop', 'data': {helpers.random_string(): messages}})
+
+        def stop(*_args):
+            if SUT.publisher.publish_message.call_count == len(messages):
+                SUT.process = False
+        SUT.publisher.publish_message.side_effect = stop
+
+        SUT.run()
+
+        self.assertEqual(SUT.messages, len(messages))
+        self.assertEqual([call.args for call in SUT.publisher.publish_message.call_args_list],
+                         [(time_stamp, qos, retain, topic, payload, options) for (topic, payload, qos, retain, options) in messages])
+        SUT.publisher.publish_offline.assert_called_once()
+        SUT.publisher.stop_network_loop.assert_called_once()
+
+    def test_keeps_connecting(self):
+        mock_logger = mock.Mock()
+
+        with mock.patch.object(user.mqttpublish.AbstractPublisher, 'get_publisher'):
+            SUT = user.mqttpublish.BrokerThread(mock_logger, helpers.random_string(), create_mqtt_config())
+        SUT.publisher.connected = False
+
+        def connect(*_args):
+            if SUT.publisher.wait_for_connection.call_count == 3:
+                SUT.process = False
+        SUT.publisher.wait_for_connection.side_effect = connect
+
+        SUT.run()
+
+        self.assertTrue(SUT.publisher.keep_connecting)
+        self.assertEqual(SUT.publisher.wait_for_connection.call_count, 3)
+        SUT.publisher.stop_network_loop.assert_called_once()
+
+    def test_counts_published_messages_only(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        message_topic = helpers.random_string()
+        mqtt_config = create_mqtt_config()
+        mqtt_config['connection_message_rate'] = 1
+
+        with mock.patch.object(user.mqttpublish.AbstractPublisher, 'get_publisher'):
+            SUT = user.mqttpublish.BrokerThread(mock_logger, helpers.random_string(), mqtt_config)
+        SUT.publisher.connected = True
+
+        # The first message is replaced by the second before it is published.
+        messages = [(message_topic, helpers.random_string(), 0, False, None) for _ in range(2)]
+        SUT.data_queue.put({'time_stamp': random.randint(1, 100), 'type': 'loop', 'data': {topic: messages}})
+
+        def stop(*_args):
+            SUT.process = False
+        SUT.publisher.publish_message.side_effect = stop
+
+        SUT.run()
+
+        SUT.publisher.publish_message.assert_called_once()
+        self.assertEqual(SUT.messages, 1)
+
+if __name__ == '__main__':
+    helpers.run_tests()
@@ -0,0 +1,123 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+import mock
+
+import helpers
+
+import random
+
+import user.mqttpublish
+
+def create_element(data_type, time_stamp):
+    return {'time_stamp': time_stamp, 'type': data_type, 'data': {'dateTime': time_stamp}}
+
+class TestDataQueue(unittest.TestCase):
+    def test_invalid_overflow_policy(self):
+        mock_logger = mock.Mock()
+        overflow_policy = helpers.random_string()
+
+        with self.assertRaises(ValueError) as error:
+            user.mqttpublish.DataQueue(mock_logger, 1, overflow_policy)
+
+        self.assertEqual(error.exception.args[0], f"Invalid 'queue_overflow_policy', {overflow_policy}")
+
+    def test_unbounded(self):
+        mock_logger = mock.Mock()
+        count = random.randint(5, 20)
+
+        SUT = user.mqttpublish.DataQueue(mock_logger)
+        for i in range(count):
+            SUT.put(create_element('loop', i))
+
+        self.assertEqual(SUT.qsize(), count)
+        self.assertDictEqual(SUT.shed, {'loop': 0, 'archive': 0})
+
+    def test_drop_oldest(self):
+        mock_logger = mock.Mock()
+
+        SUT = user.mqttpublish.DataQueue(mock_logger, 2, 'drop_oldest')
+        SUT.put(create_element('archive', 1))
+        SUT.put(create_element('loop', 2))
+        SUT.put(create_element('loop', 3))
+
+        self.assertEqual([element['time_stamp'] for element in SUT.queue], [2, 3])
+        self.assertDictEqual(SUT.shed, {'loop': 0, 'archive': 1})
+
+    def test_drop_newest(self):
+        mock_logger = mock.Mock()
+
+        SUT = user.mqttpublish.DataQueue(mock_logger, 2, 'drop_newest')
+        SUT.put(create_element('loop', 1))
+        SUT.put(create_element('loop', 2))
+        SUT.put(create_element('archive', 3))
+
+        self.assertEqual([element['time_stamp'] for element in SUT.queue], [1, 2])
+        self.assertDictEqual(SUT.shed, {'loop': 0, 'archive': 1})
+
+    def test_coalesce(self):
+        mock_logger = mock.Mock()
+
+        SUT = user.mqttpublish.DataQueue(mock_logger, 3, 'coalesce')
+        SUT.put(create_element('loop', 1))
+        SUT.put(create_element('archive', 2))
+        SUT.put(create_element('loop', 3))
+        SUT.put(create_element('loop', 4))
+
+        self.assertEqual([element['time_stamp'] for element in SUT.queue], [2, 4])
+        self.assertDictEqual(SUT.shed, {'loop': 2, 'archive': 0})
+
+    def test_coalesce_keeps_newest_loop_for_archive_record(self):
+        mock_logger = mock.Mock()
+
+        SUT = user.mqttpublish.DataQueue(mock_logger, 3, 'coalesce')
+        SUT.put(create_element('loop', 1))
+        SUT.put(create_element('loop', 2))
+        SUT.put(create_element('loop', 3))
+        SUT.put(create_element('archive', 4))
+
+        self.assertEqual([element['time_stamp'] for element in SUT.queue], [3, 4])
+        self.assertDictEqual(SUT.shed, {'loop': 2, 'archive': 0})
+
+    def test_coalesce_keeps_archive_records(self):
+        mock_logger = mock.Mock()
+
+        SUT = user.mqttpublish.DataQueue(mock_logger, 2, 'coalesce')
+        SUT.put(create_element('archive', 1))
+        SUT.put(create_element('archive', 2))
+        SUT.put(create_element('archive', 3))
+
+        self.assertEqual([element['time_stamp'] for element in SUT.queue], [1, 2, 3])
+        self.assertDictEqual(SUT.shed, {'loop': 0, 'archive': 0})
+
+    def test_block_times_out(self):
+        mock_logger = mock.Mock()
+
+        SUT = user.mqttpublish.DataQueue(mock_logger, 1, 'block', 0)
+        SUT.put(create_element('loop', 1))
+        SUT.put(create_element('loop', 2))
+
+        self.assertEqual([element['time_stamp'] for element in SUT.queue], [1])
+        self.assertDictEqual(SUT.shed, {'loop': 1, 'archive': 0})
+
+    def test_get_all(self):
+        mock_logger = mock.Mock()
+        count = random.randint(1, 10)
+
+        SUT = user.mqttpublish.DataQueue(mock_logger)
+        for i in range(count):
+            SUT.put(create_element('loop', i))
+
+        elements = SUT.get_all()
+
+        self.assertEqual([element['time_stamp'] for element in elements], list(range(count)))
+        self.assertTrue(SUT.empty())
+
+if __name__ == '__main__':
+    helpers.run_tests()
@@ -0,0 +1,62 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+import mock
+
+import helpers
+
+import logging
+
+import user.mqttpublish
+
+class TestLogger(unittest.TestCase):
+    def test_disabled_level_is_not_formatted(self):
+        arg = mock.Mock()
+
+        SUT = user.mqttpublish.Logger()
+        with mock.patch.object(SUT, 'log') as mock_log:
+            mock_log.isEnabledFor.return_value = False
+
+            SUT.logdbg("%s", arg)
+
+            mock_log.isEnabledFor.assert_called_once_with(logging.DEBUG)
+            mock_log.log.assert_not_called()
+
+    def test_args_are_formatted(self):
+        arg = helpers.random_string()
+
+        SUT = user.mqttpublish.Logger()
+        with mock.patch.object(SUT, 'log') as mock_log:
+            mock_log.isEnabledFor.return_value = True
+
+            SUT.loginf("value %s", arg)
+
+            mock_log.log.assert_called_once_with(logging.INFO, "%s value %s", SUT._thread_id(), arg)
+
+    def test_message_without_args(self):
+        msg = f"{helpers.random_string()} 100%"
+
+        SUT = user.mqttpublish.Logger()
+        with mock.patch.object(SUT, 'log') as mock_log:
+            mock_log.isEnabledFor.return_value = True
+
+            SUT.logerr(msg)
+
+            mock_log.log.assert_called_once_with(logging.ERROR, "%s %s", SUT._thread_id(), msg)
+
+    def test_thread_id_is_cached(self):
+        SUT = user.mqttpublish.Logger()
+        with mock.patch('user.mqttpublish.threading.get_native_id', return_value=1) as mock_get_native_id:
+            SUT._thread_id()
+            SUT._thread_id()
+
+            mock_get_native_id.assert_called_once_with()
+
+if __name__ == '__main__':
+    helpers.run_tests()
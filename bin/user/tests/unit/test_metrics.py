@@ -0,0 +1,139 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+import mock
+
+import helpers
+
+import json
+import os
+import random
+import tempfile
+
+import user.mqttpublish
+
+def create_snapshot():
+    return {
+        'uptime': random.randint(1, 100),
+        'queue_depth': random.randint(0, 10),
+        'queue_shed': {'loop': random.randint(0, 10), 'archive': 0},
+        'records': {'loop': random.randint(0, 10)},
+        'records_per_second': random.random(),
+        'messages': random.randint(0, 100),
+        'bytes': random.randint(0, 10000),
+        'topics': {helpers.random_string(): random.randint(0, 100)},
+        'publish_latency': {'count': 1, 'average': random.random(), 'maximum': random.random()},
+        'connects': 1,
+        'connections': [True, False],
+        'inflight': random.randint(0, 10),
+        'inflight_timeouts': random.randint(0, 10),
+        'ack_latency': {'ack qos1': {'count': 1, 'mean': 1.0, 'p50': 1.0, 'p95': 1.0, 'maximum': 1.0}},
+        'brokers': {helpers.random_string(): {'connected': True, 'connects': 1, 'queue_depth': 0, 'queue_shed': {}, 'messages': 1}},
+        'thread_restarts': 0,
+        'suppressed_fields': random.randint(0, 10),
+        'interval_skips': random.randint(0, 10),
+        'spool': None,
+        'rate_limit': {'pending': 0, 'replaced': 0},
+    }
+
+class TestMetrics(unittest.TestCase):
+    def test_not_enabled(self):
+        mock_logger = mock.Mock()
+
+        SUT = user.mqttpublish.Metrics(mock_logger, None)
+
+        self.assertFalse(SUT.enable)
+        with mock.patch('user.mqttpublish.time.time', return_value=SUT.next_publish):
+            self.assertFalse(SUT.due())
+
+    def test_due(self):
+        mock_logger = mock.Mock()
+        interval = random.randint(1, 100)
+
+        with mock.patch('user.mqttpublish.time.time', return_value=0):
+            SUT = user.mqttpublish.Metrics(mock_logger, {'interval': interval})
+            self.assertFalse(SUT.due())
+
+        with mock.patch('user.mqttpublish.time.time', return_value=interval):
+            self.assertTrue(SUT.due())
+            self.assertFalse(SUT.due())
+
+    def test_records_per_second(self):
+        mock_logger = mock.Mock()
+        count = random.randint(1, 100)
+
+        with mock.patch('user.mqttpublish.time.time', return_value=0):
+            SUT = user.mqttpublish.Metrics(mock_logger, {})
+        SUT.records['loop'] += count
+        SUT.records['archive'] += count
+
+        self.assertEqual(SUT.records_per_second(10), 2 * count / 10)
+        self.assertEqual(SUT.records_per_second(20), 0)
+
+    def test_to_prometheus(self):
+        snapshot = create_snapshot()
+        topic = list(snapshot['topics'])[0]
+
+        text = user.mqttpublish.Metrics.to_prometheus(snapshot)
+
+        self.assertIn(f"mqttpublish_queue_depth {snapshot['queue_depth']}\n", text)
+        self.assertIn(f"mqttpublish_queue_shed_total{{type=\"loop\"}} {snapshot['queue_shed']['loop']}\n", text)
+        self.assertIn(f"mqttpublish_topic_messages_total{{topic=\"{topic}\"}} {snapshot['topics'][topic]}\n", text)
+        self.assertEqual(text.count('# TYPE mqttpublish_queue_shed_total counter'), 1)
+        self.assertIn("mqttpublish_ack_latency_p95_ms{qos=\"qos1\"} 1.0\n", text)
+        self.assertIn("mqttpublish_connections_connected 1\n", text)
+        self.assertNotIn('spool', text)
+
+    def test_to_prometheus_escapes_labels(self):
+        snapshot = create_snapshot()
+        snapshot['topics'] = {'weather/"a"\\b\nc': 1}
+
+        text = user.mqttpublish.Metrics.to_prometheus(snapshot)
+
+        self.assertIn('mqttpublish_topic_messages_total{topic="weather/\\"a\\"\\\\b\\nc"} 1\n', text)
+
+    def test_write_prometheus(self):
+        mock_logger = mock.Mock()
+        snapshot = create_snapshot()
+
+        with tempfile.TemporaryDirectory() as directory:
+            prometheus_file = os.path.join(directory, 'mqttpublish.prom')
+            SUT = user.mqttpublish.Metrics(mock_logger, {'prometheus_file': prometheus_file})
+
+            SUT.write_prometheus(snapshot)
+
+            with open(prometheus_file, encoding='utf-8') as file:
+                self.assertEqual(file.read(), SUT.to_prometheus(snapshot))
+            self.assertEqual(os.listdir(directory), ['mqttpublish.prom'])
+
+    def test_publish_metrics(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        data_queue = user.mqttpublish.DataQueue(mock_logger)
+        metrics = user.mqttpublish.Metrics(mock_logger, {'topic': topic})
+        metrics.messages = random.randint(1, 100)
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, data_queue, metrics)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = True
+        SUT.publisher.connects = 1
+        SUT.publisher.inflight = {}
+        SUT.publisher.inflight_timeouts = 0
+        SUT.publisher.ack_latency = user.mqttpublish.Profiler(mock_logger, 0)
+
+        SUT.publish_metrics()
+
+        SUT.publisher.client.publish.assert_called_once()
+        self.assertEqual(SUT.publisher.client.publish.call_args.args[0], topic)
+        snapshot = json.loads(SUT.publisher.client.publish.call_args.args[1])
+        self.assertEqual(snapshot['messages'], metrics.messages)
+        self.assertEqual(snapshot['queue_depth'], 0)
+
+if __name__ == '__main__':
+    helpers.run_tests()
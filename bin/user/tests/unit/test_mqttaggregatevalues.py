@@ -12,14 +12,19 @@ import mock
 
 import configobj
 import copy
+import threading
 import time
 
 import helpers
 
 import user.mqttaggregatevalues
 
+import weedb
 import weewx
 
+from weeutil.weeutil import TimeSpan
+from weewx.units import ValueTuple
+
 class Test_MQTTAggregateValues(unittest.TestCase):
     def test_update_record(self):
         mock_logger = mock.Mock()
@@ -146,9 +151,427 @@ class Test_MQTTAggregateValues(unittest.TestCase):
                                 'timing': 'immediate',
                                 'callback': SUT.update_record
                             },
+                            'on_weewx_data': {
+                                'timing': 'immediate',
+                                'callback': SUT.on_weewx_data
+                            },
+                            'on_shutdown': {
+                                'timing': 'immediate',
+                                'callback': SUT.on_shutdown
+                            },
                         },
                     ]
                     self.assertEqual(callbacks, expected_callbacks)
 
+class Test_incremental(unittest.TestCase):
+    def create_plugin(self, aggregation, period='day'):
+        mock_logger = mock.Mock()
+        self.topic = helpers.random_string()
+        self.aggregate = helpers.random_string()
+        self.observation = helpers.random_string()
+        plugin_dict = {
+            'topics': {
+                self.topic: {
+                    self.aggregate: {
+                        'observation': self.observation,
+                        'aggregation': aggregation,
+                        'period': period
+                    }
+                }
+            }
+        }
+        weewx_dict = {
+            'stn_info': mock.Mock(),
+            'manager_dict': {}
+        }
+        plugin_config = configobj.ConfigObj(plugin_dict)
+
+        name = helpers.random_string()
+        with mock.patch('user.mqttaggregatevalues.weewx.manager'):
+            SUT = user.mqttaggregatevalues.MQTTAggregateValues(mock_logger, name, plugin_config, None, {}, weewx_dict)
+        SUT.db_manager.std_unit_system = 1
+        SUT.db_manager.lastGoodStamp.return_value = 1000
+        SUT.timespan_provider = mock.Mock()
+        SUT.timespan_provider.get_timespan.return_value = TimeSpan(0, 2000)
+        return SUT
+
+    def test_seeded_once(self):
+        SUT = self.create_plugin('max')
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.return_value = (10.0, 'degree_F', 'group_temperature')
+
+            for date_time in (1001, 1002):
+                record = {'dateTime': date_time}
+                SUT.update_record(None, self.topic, record, None, None, None)
+                self.assertEqual(record[self.aggregate], 10.0)
+
+            mock_xtype.get_aggregate.assert_called_once_with(self.observation, TimeSpan(0, 2000), 'max', SUT.db_manager)
+
+    def test_updated_from_archive_record(self):
+        SUT = self.create_plugin('avg')
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.side_effect = [(30.0, 'degree_F', 'group_temperature'),
+                                                    (3, 'count', 'group_count'),
+                                                    (9000.0, 'degree_F', 'group_temperature'),
+                                                    (900, 'second', 'group_deltatime')]
+
+            record = {'dateTime': 1001}
+            SUT.update_record(None, self.topic, record, None, None, None)
+            self.assertEqual(record[self.aggregate], 10.0)
+
+            # Already in the database when seeded.
+            SUT.on_weewx_data({'type': 'archive', 'data': {'dateTime': 1000, 'usUnits': 1, 'interval': 5, self.observation: 100.0}})
+            SUT.on_weewx_data({'type': 'archive', 'data': {'dateTime': 1300, 'usUnits': 1, 'interval': 5, self.observation: 50.0}})
+            SUT.on_weewx_data({'type': 'loop', 'data': {'dateTime': 1400, 'usUnits': 1, self.observation: 1000.0}})
+
+            record = {'dateTime': 1301}
+            SUT.update_record(None, self.topic, record, None, None, None)
+            self.assertEqual(record[self.aggregate], 20.0)
+            self.assertEqual(mock_xtype.get_aggregate.call_count, 4)
+
+    def test_derived_observation_not_queried_again(self):
+        SUT = self.create_plugin('max')
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.return_value = (10.0, 'degree_F', 'group_temperature')
+            mock_xtype.get_scalar.side_effect = [ValueTuple(20.0, 'degree_F', 'group_temperature'),
+                                                 weewx.CannotCalculate(self.observation)]
+
+            record = {'dateTime': 1001}
+            SUT.update_record(None, self.topic, record, None, None, None)
+
+            # The observation is derived, it is not in the archive records.
+            for date_time in (1300, 1600):
+                SUT.on_weewx_data({'type': 'archive', 'data': {'dateTime': date_time, 'usUnits': 1, 'interval': 5}})
+                record = {'dateTime': date_time + 1}
+                SUT.update_record(None, self.topic, record, None, None, None)
+                self.assertEqual(record[self.aggregate], 20.0)
+
+            mock_xtype.get_aggregate.assert_called_once()
+            self.assertEqual(mock_xtype.get_scalar.call_count, 2)
+
+    def test_average_of_whole_days_is_weighted(self):
+        state = user.mqttaggregatevalues.AggregateState(helpers.random_string(), 'avg', TimeSpan(0, 86400))
+        state.sum = 30.0
+        state.count = 3
+        state.wsum = 9000.0
+        state.sumtime = 900
+        state.weighted = True
+
+        state.add(1300, 60.0, 15)
+
+        self.assertEqual(state.value, (9000.0 + 60.0 * 900) / 1800)
+
+        state.weighted = False
+        self.assertEqual(state.value, 90.0 / 4)
+
+    def test_archive_record_outside_timespan(self):
+        SUT = self.create_plugin('sum', 'yesterday')
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.return_value = (1.5, 'inch', 'group_rain')
+
+            record = {'dateTime': 1001}
+            SUT.update_record(None, self.topic, record, None, None, None)
+
+            SUT.timespan_provider.get_timespan.return_value = TimeSpan(0, 1000)
+            SUT.on_weewx_data({'type': 'archive', 'data': {'dateTime': 1300, 'usUnits': 1, 'interval': 5, self.observation: 0.5}})
+
+            self.assertEqual(SUT.aggregate_states[(self.observation, 'sum', 'yesterday')].value, 1.5)
+
+    def test_rolls_over(self):
+        SUT = self.create_plugin('count')
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.side_effect = [(5, 'count', 'group_count'), (0, 'count', 'group_count')]
+
+            record = {'dateTime': 1001}
+            SUT.update_record(None, self.topic, record, None, None, None)
+            self.assertEqual(record[self.aggregate], 5)
+
+            SUT.timespan_provider.get_timespan.return_value = TimeSpan(2000, 4000)
+            record = {'dateTime': 2001}
+            SUT.update_record(None, self.topic, record, None, None, None)
+            self.assertEqual(record[self.aggregate], 0)
+            self.assertEqual(mock_xtype.get_aggregate.call_count, 2)
+
+    def test_not_incremental(self):
+        SUT = self.create_plugin(helpers.random_string())
+
+        self.assertFalse(SUT.is_incremental(SUT.plugin_dict['topics'][self.topic][self.aggregate]))
+
+class Test_AggregateQuery(unittest.TestCase):
+    def create_db_manager(self):
+        db_manager = mock.MagicMock()
+        db_manager.std_unit_system = 1
+        db_manager.table_name = 'archive'
+        db_manager.sqlkeys = ['dateTime', 'outTemp', 'rain']
+        db_manager.daykeys = ['outTemp', 'rain']
+        db_manager.first_timestamp = 0
+        db_manager.last_timestamp = 1000
+        return db_manager
+
+    def test_archive_one_query(self):
+        db_manager = self.create_db_manager()
+        db_manager.getSql.return_value = (40.0, 80.0, 1.5)
+        aggregates = [('outTemp', 'min'), ('outTemp', 'max'), ('rain', 'sum')]
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            (values, failures) = user.mqttaggregatevalues.AggregateQuery.get_aggregates(aggregates, TimeSpan(100, 200), db_manager)
+
+            mock_xtype.get_aggregate.assert_not_called()
+
+        db_manager.getSql.assert_called_once_with(
+            "SELECT MIN(outTemp), MAX(outTemp), SUM(rain) FROM archive WHERE dateTime > ? AND dateTime <= ?", (100, 200))
+        self.assertEqual(values[('outTemp', 'max')], (80.0, 'degree_F', 'group_temperature'))
+        self.assertEqual(values[('rain', 'sum')], (1.5, 'inch', 'group_rain'))
+        self.assertEqual(failures, {})
+
+    def test_daily_summaries_one_query(self):
+        db_manager = self.create_db_manager()
+        db_manager.genSql.return_value = [('outTemp', 40.0, 80.0, 600.0, 10, 6000.0, 100), ('rain', 0.0, 0.5, 1.5, 10, 0, 0)]
+        aggregates = [('outTemp', 'avg'), ('outTemp', 'count'), ('rain', 'sum')]
+
+        (values, _) = user.mqttaggregatevalues.AggregateQuery.get_aggregates(aggregates, TimeSpan(0, 1000), db_manager)
+
+        db_manager.genSql.assert_called_once()
+        self.assertIn('UNION ALL', db_manager.genSql.call_args.args[0])
+        db_manager.getSql.assert_not_called()
+        self.assertEqual(values[('outTemp', 'avg')][0], 60.0)
+        self.assertEqual(values[('outTemp', 'count')][0], 10)
+        self.assertEqual(values[('rain', 'sum')][0], 1.5)
+
+    def test_derived_type_calculated_by_weewx(self):
+        db_manager = self.create_db_manager()
+        db_manager.getSql.return_value = (80.0,)
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.return_value = (30.0, 'degree_F', 'group_temperature')
+            (values, _) = user.mqttaggregatevalues.AggregateQuery.get_aggregates([('outTemp', 'max'), ('dewpoint', 'max')],
+                                                                                 TimeSpan(100, 200),
+                                                                                 db_manager)
+
+            mock_xtype.get_aggregate.assert_called_once_with('dewpoint', TimeSpan(100, 200), 'max', db_manager)
+
+        self.assertEqual(values[('outTemp', 'max')][0], 80.0)
+        self.assertEqual(values[('dewpoint', 'max')][0], 30.0)
+
+    def test_database_error(self):
+        db_manager = self.create_db_manager()
+        db_manager.getSql.side_effect = weedb.NoColumnError
+        aggregates = [('outTemp', 'max'), ('rain', 'sum')]
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.side_effect = [(80.0, 'degree_F', 'group_temperature'), weewx.UnknownType]
+            (values, failures) = user.mqttaggregatevalues.AggregateQuery.get_aggregates(aggregates, TimeSpan(100, 200), db_manager)
+
+        self.assertEqual(values, {('outTemp', 'max'): (80.0, 'degree_F', 'group_temperature')})
+        self.assertEqual(list(failures), [('rain', 'sum')])
+
+class Test_background(unittest.TestCase):
+    def create_plugin(self, aggregation):
+        mock_logger = mock.Mock()
+        self.topic = helpers.random_string()
+        self.aggregate = helpers.random_string()
+        self.observation = helpers.random_string()
+        plugin_dict = {
+            'background': True,
+            'topics': {
+                self.topic: {
+                    self.aggregate: {
+                        'observation': self.observation,
+                        'aggregation': aggregation,
+                        'period': 'day'
+                    }
+                }
+            }
+        }
+        weewx_dict = {
+            'stn_info': mock.Mock(),
+            'manager_dict': {}
+        }
+        plugin_config = configobj.ConfigObj(plugin_dict)
+
+        name = helpers.random_string()
+        with mock.patch('user.mqttaggregatevalues.weewx.manager'):
+            with mock.patch('user.mqttaggregatevalues.AggregateWorker'):
+                SUT = user.mqttaggregatevalues.MQTTAggregateValues(mock_logger, name, plugin_config, None, {}, weewx_dict)
+        SUT.timespan_provider = mock.Mock()
+        SUT.timespan_provider.get_timespan.return_value = TimeSpan(0, 2000)
+        return SUT
+
+    def run_jobs(self, SUT, db_manager):
+        for call in SUT.worker.schedule.call_args_list:
+            call.args[1](db_manager)
+        SUT.worker.schedule.reset_mock()
+
+    def test_query_not_blocked(self):
+        SUT = self.create_plugin('maxtime')
+        db_manager = mock.MagicMock()
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.return_value = (1000, 'unix_epoch', 'group_time')
+
+            record = {'dateTime': 1001}
+            SUT.update_record(None, self.topic, record, None, None, None)
+            self.assertIsNone(record[self.aggregate])
+            mock_xtype.get_aggregate.assert_not_called()
+
+            self.run_jobs(SUT, db_manager)
+            mock_xtype.get_aggregate.assert_called_once_with(self.observation, TimeSpan(0, 2000), 'maxtime', db_manager)
+
+            record = {'dateTime': 1002}
+            SUT.update_record(None, self.topic, record, None, None, None)
+            self.assertEqual(record[self.aggregate], 1000)
+
+    def test_seeded_with_recent_records(self):
+        SUT = self.create_plugin('sum')
+        SUT.db_manager.std_unit_system = 1
+        db_manager = mock.MagicMock()
+        db_manager.std_unit_system = 1
+        db_manager.lastGoodStamp.return_value = 1000
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.return_value = (1.5, 'inch', 'group_rain')
+
+            record = {'dateTime': 1001}
+            SUT.update_record(None, self.topic, record, None, None, None)
+            self.assertIsNone(record[self.aggregate])
+
+            self.run_jobs(SUT, db_manager)
+            # Published after the worker read the database.
+            SUT.on_weewx_data({'type': 'archive', 'data': {'dateTime': 1300, 'usUnits': 1, 'interval': 5, self.observation: 0.5}})
+
+            record = {'dateTime': 1301}
+            SUT.update_record(None, self.topic, record, None, None, None)
+            self.assertEqual(record[self.aggregate], 2.0)
+
+    def test_seed_failed(self):
+        SUT = self.create_plugin('sum')
+        db_manager = mock.MagicMock()
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.side_effect = weewx.UnknownType
+
+            SUT.update_record(None, self.topic, {'dateTime': 1001}, None, None, None)
+            self.run_jobs(SUT, db_manager)
+            SUT.update_record(None, self.topic, {'dateTime': 1002}, None, None, None)
+
+            self.assertIn((self.observation, 'sum', 'day'), SUT.not_incremental)
+
+class Test_AggregateWorker(unittest.TestCase):
+    def test_runs_job(self):
+        done = threading.Event()
+        job = mock.Mock(side_effect=lambda db_manager: done.set())
+
+        with mock.patch('user.mqttaggregatevalues.weewx.manager') as mock_manager:
+            SUT = user.mqttaggregatevalues.AggregateWorker(mock.Mock(), {})
+            SUT.start()
+            SUT.schedule(helpers.random_string(), job)
+            self.assertTrue(done.wait(5))
+            SUT.stop()
+
+        job.assert_called_once_with(mock_manager.open_manager.return_value.__enter__.return_value)
+        self.assertFalse(SUT.is_alive())
+
+    def test_earliest_kept(self):
+        key = helpers.random_string()
+        SUT = user.mqttaggregatevalues.AggregateWorker(mock.Mock(), {})
+        job = mock.Mock()
+
+        SUT.schedule(key, job, 100)
+        SUT.schedule(key, mock.Mock(), 200)
+
+        self.assertEqual(SUT.jobs, {key: (100, job)})
+
+class Test_AggregateCache(unittest.TestCase):
+    def create_plugin(self, topics):
+        mock_logger = mock.Mock()
+        self.aggregate = helpers.random_string()
+        self.observation = helpers.random_string()
+        aggregate = {
+            'observation': self.observation,
+            'aggregation': 'maxtime',
+            'period': 'day',
+        }
+        plugin_dict = {
+            'topics': {topic: {self.aggregate: dict(aggregate)} for topic in topics}
+        }
+        self.weewx_dict = {
+            'stn_info': mock.Mock(),
+            'manager_dict': {'table_name': 'archive', 'database_dict': {'database_name': helpers.random_string()}}
+        }
+        plugin_config = configobj.ConfigObj(plugin_dict)
+
+        name = helpers.random_string()
+        with mock.patch('user.mqttaggregatevalues.weewx.manager'):
+            SUT = user.mqttaggregatevalues.MQTTAggregateValues(mock_logger, name, plugin_config, None, {}, self.weewx_dict)
+        SUT.timespan_provider = mock.Mock()
+        SUT.timespan_provider.get_timespan.return_value = TimeSpan(0, 2000)
+        return SUT
+
+    def test_shared_by_topics(self):
+        topics = [helpers.random_string(), helpers.random_string()]
+        SUT = self.create_plugin(topics)
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.return_value = (1000, 'unix_epoch', 'group_time')
+
+            for topic in topics:
+                record = {'dateTime': 1001}
+                SUT.update_record(None, topic, record, None, None, None)
+                self.assertEqual(record[self.aggregate], 1000)
+
+            mock_xtype.get_aggregate.assert_called_once()
+
+    def test_invalidated_by_archive_record(self):
+        topic = helpers.random_string()
+        SUT = self.create_plugin([topic])
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.side_effect = [(1000, 'unix_epoch', 'group_time'), (1300, 'unix_epoch', 'group_time')]
+
+            record = {'dateTime': 1001}
+            SUT.update_record(None, topic, record, None, None, None)
+
+            SUT.on_weewx_data({'type': 'archive', 'data': {'dateTime': 1300, 'usUnits': 1}})
+
+            record = {'dateTime': 1301}
+            SUT.update_record(None, topic, record, None, None, None)
+            self.assertEqual(record[self.aggregate], 1300)
+            self.assertEqual(mock_xtype.get_aggregate.call_count, 2)
+
+    def test_expires(self):
+        key = (helpers.random_string(), 'max', 0, 2000, None)
+        SUT = user.mqttaggregatevalues.AggregateCache()
+        SUT.put(key, (1, 'degree_F', 'group_temperature'), 100)
+
+        self.assertEqual(SUT.get(key, 99), (1, 'degree_F', 'group_temperature'))
+        self.assertIsNone(SUT.get(key, 100))
+
+    def test_not_shared_by_plugins(self):
+        topic = helpers.random_string()
+        SUT = self.create_plugin([topic])
+
+        with mock.patch('user.mqttpublish.weewx.xtypes') as mock_xtype:
+            mock_xtype.get_aggregate.side_effect = [(1000, 'unix_epoch', 'group_time'), (1300, 'unix_epoch', 'group_time')]
+
+            record = {'dateTime': 1001}
+            SUT.update_record(None, topic, record, None, None, None)
+
+            # As when the publishing thread is restarted.
+            plugin_dict = SUT.plugin_dict
+            with mock.patch('user.mqttaggregatevalues.weewx.manager'):
+                SUT = user.mqttaggregatevalues.MQTTAggregateValues(mock.Mock(), helpers.random_string(), plugin_dict, None, {},
+                                                                   self.weewx_dict)
+            SUT.timespan_provider = mock.Mock()
+            SUT.timespan_provider.get_timespan.return_value = TimeSpan(0, 2000)
+
+            record = {'dateTime': 1001}
+            SUT.update_record(None, topic, record, None, None, None)
+            self.assertEqual(record[self.aggregate], 1300)
+
 if __name__ == '__main__':
     helpers.run_tests()
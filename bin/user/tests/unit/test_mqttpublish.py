@@ -36,6 +36,50 @@ class TestInit(unittest.TestCase):
                     SUT.logger.logerr.assert_called_once_with(
                         "'PublishWeeWX' is deprecated. Move options to top level, '[MQTTPublish]'.")
 
+    def test_invalid_replay_rate(self):
+        mock_engine = mock.Mock()
+        config_dict = {
+            'StdReport': {},
+            'MQTTPublish': {
+                'topics': {
+                    helpers.random_string(): {},
+                },
+                'spool': {
+                    'replay_rate': 0,
+                },
+            },
+        }
+        config = configobj.ConfigObj(config_dict)
+
+        with mock.patch('user.mqttpublish.weewx.manager'):
+            with mock.patch('user.mqttpublish.PublishWeeWXThread'):
+                with mock.patch('user.mqttpublish.Logger'):
+                    with self.assertRaises(ValueError) as error:
+                        user.mqttpublish.MQTTPublish(mock_engine, config)
+
+        self.assertEqual(error.exception.args[0], "Invalid 'replay_rate', 0")
+
+    def test_invalid_backlog_rate(self):
+        mock_engine = mock.Mock()
+        config_dict = {
+            'StdReport': {},
+            'MQTTPublish': {
+                'topics': {
+                    helpers.random_string(): {},
+                },
+                'backlog_rate': 0,
+            },
+        }
+        config = configobj.ConfigObj(config_dict)
+
+        with mock.patch('user.mqttpublish.weewx.manager'):
+            with mock.patch('user.mqttpublish.PublishWeeWXThread'):
+                with mock.patch('user.mqttpublish.Logger'):
+                    with self.assertRaises(ValueError) as error:
+                        user.mqttpublish.MQTTPublish(mock_engine, config)
+
+        self.assertEqual(error.exception.args[0], "Invalid 'backlog_rate', 0.0")
+
 class TestConfigureTopics(unittest.TestCase):
     def test_config_topics(self):
         mock_engine = mock.Mock()
@@ -67,6 +111,10 @@ class TestConfigureTopics(unittest.TestCase):
                         'suppression_threshold': 0.0,
                         'retain': False,
                         'type': 'json',
+                        'publish_options': None,
+                        'brokers': ['default'],
+                        'message_rate': 0.0,
+                        'byte_rate': 0.0,
                         'unit_system': 1,
                         'ignore': False,
                         'append_unit_label': True,
@@ -75,6 +123,7 @@ class TestConfigureTopics(unittest.TestCase):
                         'format_string': None,
                         'fields': {},
                         'data_last_published': {},
+                        'field_plans': {},
                     }
                 }
 
@@ -116,6 +165,10 @@ class TestConfigureTopics(unittest.TestCase):
                         'suppression_threshold': 0.0,
                         'retain': False,
                         'type': 'json',
+                        'publish_options': None,
+                        'brokers': ['default'],
+                        'message_rate': 0.0,
+                        'byte_rate': 0.0,
                         'unit_system': 1,
                         'ignore': False,
                         'append_unit_label': True,
@@ -123,6 +176,7 @@ class TestConfigureTopics(unittest.TestCase):
                         'round': None,
                         'format_string': None,
                         'data_last_published': {},
+                        'field_plans': {},
                         'fields': {
                             field1: {
                                 'name': field1,
@@ -141,5 +195,78 @@ class TestConfigureTopics(unittest.TestCase):
                 self.assertDictEqual(topics_loop, expected_topics)
                 self.assertDictEqual(topics_archive, expected_topics)
 
+class TestConfigureBrokers(unittest.TestCase):
+    def create_mqtt_publish(self):
+        mock_engine = mock.Mock()
+        config = configobj.ConfigObj({'MQTTPublish': {'enable': False}})
+
+        with mock.patch('user.mqttpublish.PublishWeeWXThread'):
+            with mock.patch('user.mqttpublish.Logger'):
+                SUT = user.mqttpublish.MQTTPublish(mock_engine, config)
+
+        SUT.mqtt_config = {
+            'host': helpers.random_string(),
+            'port': 1883,
+            'username': None,
+            'password': None,
+            'clientid': helpers.random_string(),
+            'protocol': user.mqttpublish.mqtt.MQTTv311,
+            'keepalive': 60,
+            'max_retries': 5,
+            'wait_between_retries': 5,
+            'max_inflight': 0,
+            'inflight_timeout': 30,
+            'connection_message_rate': 0,
+            'connection_byte_rate': 0,
+            'tls': None,
+            'lwt': {},
+            'spool': {},
+        }
+        return SUT
+
+    def test_broker_inherits_connection_options(self):
+        broker = helpers.random_string()
+        host = helpers.random_string()
+        service_config = configobj.ConfigObj({
+            'max_queue_size': 10,
+            'brokers': {
+                broker: {
+                    'host': host,
+                    'port': 8883,
+                },
+            },
+        })
+
+        SUT = self.create_mqtt_publish()
+        brokers = SUT.configure_brokers(service_config)
+
+        self.assertEqual(list(brokers), [broker])
+        self.assertEqual(brokers[broker]['host'], host)
+        self.assertEqual(brokers[broker]['port'], 8883)
+        self.assertEqual(brokers[broker]['keepalive'], SUT.mqtt_config['keepalive'])
+        self.assertEqual(brokers[broker]['clientid'], f"{SUT.mqtt_config['clientid']}-{broker}")
+        self.assertEqual(brokers[broker]['max_queue_size'], 10)
+        self.assertEqual(brokers[broker]['queue_overflow_policy'], 'drop_oldest')
+        self.assertIsNone(brokers[broker]['spool'])
+
+    def test_default_is_reserved(self):
+        service_config = configobj.ConfigObj({
+            'brokers': {
+                'default': {},
+            },
+        })
+
+        SUT = self.create_mqtt_publish()
+        with self.assertRaises(ValueError) as error:
+            SUT.configure_brokers(service_config)
+
+        self.assertEqual(error.exception.args[0],
+                         "'default' is the broker configured in [MQTTPublish], it cannot be in [[brokers]].")
+
+    def test_no_brokers(self):
+        SUT = self.create_mqtt_publish()
+
+        self.assertDictEqual(SUT.configure_brokers(configobj.ConfigObj({})), {})
+
 if __name__ == '__main__':
     helpers.run_tests()
@@ -380,5 +380,60 @@ class TestGetTimeSpan(unittest.TestCase):
             day_start_timestamp = 1771304400.0
             mock_TimeSpan.assert_called_once_with(day_start_timestamp, now)
 
+class TestMemoizedTimeSpan(unittest.TestCase):
+    def setUp(self):
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+
+    def test_reused_within_quarter_hour(self):
+        with mock.patch('weeutil.weeutil.archiveDaySpan')as mock_archive_day_span:
+            timespan_provider = user.mqttaggregatevalues.TimeSpanProvider(None, random.randint(0, 6))
+
+            now = 1771939800
+            timespan = timespan_provider.get_timespan('day', now + 1, None)
+            self.assertEqual(timespan_provider.get_timespan('day', now + 899, None), timespan)
+
+            mock_archive_day_span.assert_called_once_with(now + 1)
+
+    def test_calculated_after_quarter_hour(self):
+        with mock.patch('weeutil.weeutil.archiveDaySpan')as mock_archive_day_span:
+            timespan_provider = user.mqttaggregatevalues.TimeSpanProvider(None, random.randint(0, 6))
+
+            now = 1771939800
+            timespan_provider.get_timespan('day', now + 1, None)
+            timespan_provider.get_timespan('day', now + 900, None)
+            timespan_provider.get_timespan('day', now + 901, None)
+
+            self.assertEqual(mock_archive_day_span.call_count, 3)
+
+    def test_rolling_not_memoized(self):
+        timespan_provider = user.mqttaggregatevalues.TimeSpanProvider(None, random.randint(0, 6))
+
+        now = 1771939800
+        timespan_provider.get_timespan('last7days', now + 1, None)
+        timespan = timespan_provider.get_timespan('last7days', now + 2, None)
+
+        self.assertEqual(timespan, weeutil.weeutil.TimeSpan(1771304400.0, now + 2))
+
+    def test_utc_offset_memoized(self):
+        timespan_provider = user.mqttaggregatevalues.TimeSpanProvider(None, random.randint(0, 6))
+
+        with mock.patch('user.mqttaggregatevalues.time.time') as mock_time:
+            mock_time.return_value = 1772900000
+            utc_offset = timespan_provider.utc_offset()
+
+            with mock.patch('user.mqttaggregatevalues.datetime') as mock_datetime:
+                mock_time.return_value = 1772953199
+                self.assertEqual(timespan_provider.utc_offset(), utc_offset)
+                mock_datetime.datetime.now.assert_not_called()
+
+                mock_time.return_value = 1772953200
+                timespan_provider.utc_offset()
+                mock_datetime.datetime.now.assert_called_once()
+
+    def test_next_utc_offset_change(self):
+        # 2026-03-08 02:00 EST
+        self.assertEqual(user.mqttaggregatevalues.TimeSpanProvider._next_utc_offset_change(1772900000), 1772953200)
+
 if __name__ == '__main__':
     helpers.run_tests()
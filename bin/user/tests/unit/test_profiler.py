@@ -0,0 +1,63 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+import mock
+
+import helpers
+
+import random
+
+import user.mqttpublish
+
+class TestProfiler(unittest.TestCase):
+    def test_stop(self):
+        mock_logger = mock.Mock()
+        plugin_name = helpers.random_string()
+
+        SUT = user.mqttpublish.Profiler(mock_logger, 0)
+        with mock.patch('user.mqttpublish.time.perf_counter', side_effect=[0.001, 0.003, 0.007]):
+            SUT.stop(0, 'plugin', plugin_name)
+            SUT.stop(0, 'plugin', plugin_name)
+            SUT.stop(0, 'publish')
+
+        summary = SUT.dump()
+
+        self.assertEqual(summary[f"plugin {plugin_name}"]['count'], 2)
+        self.assertAlmostEqual(summary[f"plugin {plugin_name}"]['mean'], 2.0)
+        self.assertAlmostEqual(summary[f"plugin {plugin_name}"]['maximum'], 3.0)
+        self.assertEqual(summary[f"plugin {plugin_name}"]['p50'], 1.0)
+        self.assertAlmostEqual(summary[f"plugin {plugin_name}"]['p95'], 3.0)
+        self.assertEqual(summary['publish']['count'], 1)
+
+    def test_log_if_due(self):
+        mock_logger = mock.Mock()
+        interval = random.randint(1, 100)
+
+        with mock.patch('user.mqttpublish.time.time', return_value=0):
+            SUT = user.mqttpublish.Profiler(mock_logger, interval)
+            SUT.stop(SUT.start(), 'publish')
+
+            SUT.log_if_due()
+            mock_logger.loginf.assert_not_called()
+
+        with mock.patch('user.mqttpublish.time.time', return_value=interval):
+            SUT.log_if_due()
+            mock_logger.loginf.assert_called_once()
+            self.assertEqual(SUT.next_summary, 2 * interval)
+
+    def test_null_profiler(self):
+        SUT = user.mqttpublish.NullProfiler()
+
+        SUT.stop(SUT.start(), 'publish')
+        SUT.log_if_due()
+
+        self.assertEqual(SUT.dump(), {})
+
+if __name__ == '__main__':
+    helpers.run_tests()
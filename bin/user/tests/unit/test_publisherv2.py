@@ -52,6 +52,64 @@ class TestPublisherV2(PublisherBase):
                                                         client_id=config_dict['clientid'],
                                                         protocol=config_dict['protocol'])
 
+    def test_topic_alias(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        options = {'topic_alias': True, 'content_type': None, 'message_expiry_interval': 0}
+
+        SUT = self.create_publisher(mock_logger)
+        SUT.topic_alias_maximum = 1
+
+        (publish_topic, properties) = SUT.publish_properties(topic, 0, options)
+        self.assertEqual(publish_topic, topic)
+        self.assertEqual(properties.TopicAlias, 1)
+
+        (publish_topic, properties) = SUT.publish_properties(topic, 0, options)
+        self.assertEqual(publish_topic, '')
+        self.assertEqual(properties.TopicAlias, 1)
+
+        (publish_topic, properties) = SUT.publish_properties(topic, 1, options)
+        self.assertEqual(publish_topic, topic)
+        self.assertEqual(properties.TopicAlias, 1)
+
+        # The broker's maximum has been reached.
+        other_topic = helpers.random_string()
+        (publish_topic, properties) = SUT.publish_properties(other_topic, 0, options)
+        self.assertEqual(publish_topic, other_topic)
+        self.assertFalse(hasattr(properties, 'TopicAlias'))
+
+    def test_publish_properties(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        options = {'topic_alias': False, 'content_type': helpers.random_string(), 'message_expiry_interval': random.randint(1, 600)}
+
+        SUT = self.create_publisher(mock_logger)
+        SUT.client.publish.return_value = mock.Mock(mid=1, rc=paho.mqtt.client.MQTT_ERR_SUCCESS)
+
+        SUT.publish_message(random.randint(1, 100), 0, False, topic, helpers.random_string(), options)
+
+        self.assertEqual(SUT.client.publish.call_args.args[0], topic)
+        properties = SUT.client.publish.call_args.kwargs['properties']
+        self.assertEqual(properties.ContentType, options['content_type'])
+        self.assertEqual(properties.MessageExpiryInterval, options['message_expiry_interval'])
+
+    def test_on_connect_resets_topic_aliases(self):
+        mock_logger = mock.Mock()
+        topic_alias_maximum = random.randint(1, 10)
+        properties = paho.mqtt.client.Properties(paho.mqtt.client.PacketTypes.CONNACK)
+        properties.TopicAliasMaximum = topic_alias_maximum
+
+        SUT = self.create_publisher(mock_logger)
+        SUT.plugin_manager = mock.Mock()
+        SUT.plugin_manager.callbacks = {'on_mqtt_connect': {'immediate': {}, 'delay': {}}}
+        SUT.lwt_dict = None
+        SUT.topic_aliases = {helpers.random_string(): 1}
+
+        SUT.on_connect(None, None, None, paho.mqtt.client.ReasonCode(paho.mqtt.client.PacketTypes.CONNACK, 'Success'), properties)
+
+        self.assertDictEqual(SUT.topic_aliases, {})
+        self.assertEqual(SUT.topic_alias_maximum, topic_alias_maximum)
+
 @unittest.skipIf(not hasattr(paho.mqtt.client, 'CallbackAPIVersion'), "paho-mqtt is v1, skipping tests.")
 class TestTLS(TLSBase):
     class_under_test = user.mqttpublish.PublisherV2
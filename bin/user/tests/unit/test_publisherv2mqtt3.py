@@ -55,6 +55,29 @@ class TestPublisherV2MQTT3(TestPublisherV2):
                                                         userdata=None,
                                                         clean_session=True)
 
+    def test_topic_alias(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        options = {'topic_alias': True, 'content_type': None, 'message_expiry_interval': 0}
+
+        SUT = self.create_publisher(mock_logger)
+        SUT.topic_alias_maximum = 1
+
+        self.assertEqual(SUT.publish_properties(topic, 0, options), (topic, None))
+
+    def test_publish_properties(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        payload = helpers.random_string()
+        options = {'topic_alias': False, 'content_type': helpers.random_string(), 'message_expiry_interval': random.randint(1, 600)}
+
+        SUT = self.create_publisher(mock_logger)
+        SUT.client.publish.return_value = mock.Mock(mid=1, rc=paho.mqtt.client.MQTT_ERR_SUCCESS)
+
+        SUT.publish_message(random.randint(1, 100), 0, False, topic, payload, options)
+
+        SUT.client.publish.assert_called_once_with(topic, payload, qos=0, retain=False)
+
 @unittest.skipIf(not hasattr(paho.mqtt.client, 'CallbackAPIVersion'), "paho-mqtt is v1, skipping tests.")
 class TestTLS(TLSBase):
     class_under_test = user.mqttpublish.PublisherV2MQTT3
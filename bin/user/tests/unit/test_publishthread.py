@@ -42,6 +42,7 @@ class TestPublishWeeWXThread(unittest.TestCase):
             'fields': {},
             'minimum_interval': None,
             'data_last_published': {},
+            'field_plans': {},
         }
 
         record = {
@@ -121,5 +122,651 @@ class TestPublishWeeWXThread(unittest.TestCase):
                 self.assertEqual(name, f"{field1}_{topic_dict['fields'][field1]['unit']}")
                 self.assertEqual(value, converted_value)
 
+    @staticmethod
+    def create_topic_dict(fields):
+        return {
+            'unit_system': 1,
+            'minimum_interval': None,
+            'suppression_threshold': 0,
+            'ignore': False,
+            'publish_none_value': False,
+            'append_unit_label': True,
+            'conversion_type': 'string',
+            'round': None,
+            'format_string': None,
+            'fields': fields,
+            'data_last_published': {},
+            'field_plans': {},
+        }
+
+    @staticmethod
+    def update_record_uncached(topic_dict, record):
+        final_record = {}
+        for field, value in record.items():
+            fieldinfo = topic_dict['fields'].get(field, {})
+            if fieldinfo.get('ignore', topic_dict['ignore']):
+                continue
+            (name, value) = user.mqttpublish.PublishWeeWXThread.update_field(topic_dict, fieldinfo, field, value, record['usUnits'])
+            final_record[name] = value
+        final_record['interval_end_ts'] = None
+        return final_record
+
+    def test_update_record_cached_plans_match_uncached(self):
+        mock_logger = mock.Mock()
+        name = helpers.random_string()
+        record = {'dateTime': time.time(), 'usUnits': 1, 'outTemp': 68.123, 'outHumidity': 50.0, 'barometer': 30.1}
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, None)
+
+        topic_dict = self.create_topic_dict({
+            'outTemp': {'unit': 'degree_C', 'conversion_type': 'float', 'round': 1},
+            'outHumidity': {'name': name},
+            'barometer': {'ignore': True},
+        })
+        expected_record = self.update_record_uncached(topic_dict, record)
+
+        self.assertEqual(SUT.update_record(topic_dict, time.time(), record), expected_record)
+        with mock.patch.object(SUT, 'compile_field') as mock_compile_field:
+            self.assertEqual(SUT.update_record(topic_dict, time.time(), record), expected_record)
+            mock_compile_field.assert_not_called()
+
+        # A configuration change creates the topic, and its plans, again.
+        topic_dict = self.create_topic_dict({
+            'outTemp': {'unit': 'degree_F', 'conversion_type': 'integer', 'append_unit_label': False},
+            'outHumidity': {'ignore': True},
+            'barometer': {'format_string': '%.3f'},
+        })
+        expected_record = self.update_record_uncached(topic_dict, record)
+
+        self.assertEqual(SUT.update_record(topic_dict, time.time(), record), expected_record)
+        self.assertEqual(SUT.update_record(topic_dict, time.time(), record), expected_record)
+        self.assertEqual(expected_record['outTemp'], 68)
+
+    def test_update_record_unit_group_registered_later(self):
+        mock_logger = mock.Mock()
+        field1 = helpers.random_string()
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, None)
+
+        topic_dict = self.create_topic_dict({})
+        topic_dict['conversion_type'] = 'float'
+
+        with mock.patch.dict(user.mqttpublish.weewx.units.obs_group_dict):
+            # The aggregate value is not available yet, and its unit group is not registered.
+            final_record = SUT.update_record(topic_dict, time.time(), {'dateTime': time.time(), 'usUnits': 1, field1: None})
+            self.assertNotIn(field1, final_record)
+
+            final_record = SUT.update_record(topic_dict, time.time(), {'dateTime': time.time(), 'usUnits': 1, field1: 70.0})
+            self.assertEqual(final_record[field1], 70.0)
+
+            user.mqttpublish.weewx.units.obs_group_dict[field1] = 'group_temperature'
+
+            final_record = SUT.update_record(topic_dict, time.time(), {'dateTime': time.time(), 'usUnits': 1, field1: 70.0})
+            self.assertEqual(final_record[f'{field1}_F'], 70.0)
+            self.assertNotIn(field1, final_record)
+
+    def test_publish_row_plugin_updates_are_per_topic(self):
+        mock_logger = mock.Mock()
+        topic1 = helpers.random_string()
+        topic2 = helpers.random_string()
+        field1 = helpers.random_string()
+        topics = {
+            topic1: {'qos': 0, 'retain': False, 'unit_system': 1},
+            topic2: {'qos': 0, 'retain': False, 'unit_system': 1},
+        }
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, topics, {}, None)
+
+        def update_record(_client, topic, data, _units, _qos, _retain):
+            if topic == topic1:
+                data[field1] = random.random()
+
+        SUT.publisher = mock.Mock()
+        SUT.publisher.plugin_manager.callbacks = {
+            'update_record': {
+                'immediate': {helpers.random_string(): update_record},
+                'delay': {},
+            },
+        }
+
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1})
+
+        with mock.patch.object(SUT, 'update_record', return_value={}) as mock_update_record:
+            SUT.publish_row(time.time(), data, topics, 'loop')
+
+            self.assertIn(field1, mock_update_record.call_args_list[0].args[2])
+            self.assertNotIn(field1, mock_update_record.call_args_list[1].args[2])
+            self.assertNotIn(field1, data)
+
+    def test_publish_row_converts_once_per_unit_system(self):
+        mock_logger = mock.Mock()
+        topics = {
+            helpers.random_string(): {'qos': 0, 'retain': False, 'unit_system': 16},
+            helpers.random_string(): {'qos': 0, 'retain': False, 'unit_system': 16},
+            helpers.random_string(): {'qos': 0, 'retain': False, 'unit_system': 1},
+        }
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, topics, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.plugin_manager.callbacks = {
+            'update_record': {
+                'immediate': {},
+                'delay': {},
+            },
+        }
+
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1, 'outTemp': random.random()})
+
+        with mock.patch.object(user.mqttpublish.weewx.units,
+                               'to_std_system',
+                               wraps=user.mqttpublish.weewx.units.to_std_system) as mock_to_std_system:
+            with mock.patch.object(SUT, 'update_record', return_value={}) as mock_update_record:
+                SUT.publish_row(time.time(), data, topics, 'loop')
+
+                self.assertEqual(mock_to_std_system.call_count, 2)
+                records = [call.args[2] for call in mock_update_record.call_args_list]
+                self.assertIs(records[0], records[1])
+                self.assertEqual(records[0]['usUnits'], 16)
+                self.assertEqual(records[2]['usUnits'], 1)
+
+    def test_publish_row_spools_when_disconnected(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        topics = {
+            topic: {
+                'qos': random.randint(0, 2),
+                'retain': random.choice([True, False]),
+                'unit_system': 1,
+                'type': 'json',
+                'publish_options': None,
+                'brokers': ['default'],
+            },
+        }
+        updated_record = {helpers.random_string(): random.random()}
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, topics, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = False
+        SUT.publisher.plugin_manager.callbacks = {
+            'update_record': {
+                'immediate': {},
+                'delay': {},
+            },
+        }
+        SUT.spool = mock.Mock()
+        SUT.spool.count = 0
+
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1})
+        time_stamp = time.time()
+
+        with mock.patch.object(SUT, 'update_record', return_value=updated_record):
+            SUT.publish_row(time_stamp, data, topics, 'archive')
+
+            SUT.publisher.publish_message.assert_not_called()
+            SUT.spool.append.assert_called_once_with(time_stamp,
+                                                     'archive',
+                                                     [(topic,
+                                                       user.mqttpublish.dumps_json(updated_record),
+                                                       topics[topic]['qos'],
+                                                       topics[topic]['retain'],
+                                                       None)])
+
+    def test_publish_row_fans_out_to_brokers(self):
+        mock_logger = mock.Mock()
+        broker = helpers.random_string()
+        default_topic = helpers.random_string()
+        broker_topic = helpers.random_string()
+        topics = {
+            default_topic: {'qos': 0, 'retain': False, 'unit_system': 1, 'type': 'json', 'publish_options': None,
+                            'brokers': ['default']},
+            broker_topic: {'qos': 1, 'retain': True, 'unit_system': 1, 'type': 'json', 'publish_options': None,
+                           'brokers': ['default', broker]},
+        }
+        updated_record = {helpers.random_string(): random.random()}
+        payload = user.mqttpublish.dumps_json(updated_record)
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, topics, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = True
+        SUT.publisher.plugin_manager.callbacks = {
+            'update_record': {
+                'immediate': {},
+                'delay': {},
+            },
+        }
+        SUT.brokers = {broker: mock.Mock()}
+
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1})
+        time_stamp = time.time()
+
+        with mock.patch.object(SUT, 'update_record', return_value=updated_record):
+            SUT.publish_row(time_stamp, data, topics, 'loop')
+
+        self.assertEqual(SUT.publisher.publish_message.call_count, 2)
+        SUT.brokers[broker].put.assert_called_once_with(time_stamp, 'loop', {broker_topic: [(broker_topic, payload, 1, True, None)]})
+        self.assertEqual(SUT.metrics.messages, 2)
+
+    def test_publish_row_does_not_wait_for_default_broker(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        topics = {
+            topic: {'qos': 0, 'retain': False, 'unit_system': 1, 'type': 'json', 'publish_options': None, 'brokers': ['default']},
+        }
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, topics, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = False
+        SUT.publisher.plugin_manager.callbacks = {
+            'update_record': {
+                'immediate': {},
+                'delay': {},
+            },
+        }
+        SUT.brokers = {helpers.random_string(): mock.Mock()}
+
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1})
+
+        with mock.patch.object(SUT, 'update_record', return_value={helpers.random_string(): random.random()}):
+            SUT.publish_row(time.time(), data, topics, 'loop')
+
+        SUT.publisher.publish_message.assert_not_called()
+        self.assertEqual(SUT.held_messages.qsize(), 1)
+
+        SUT.publisher.connected = True
+        SUT.publish_held_messages()
+
+        SUT.publisher.publish_message.assert_called_once()
+        self.assertEqual(SUT.held_messages.qsize(), 0)
+
+    def test_publish_row_shards_topics_across_connections(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        topics = {
+            topic: {'qos': 0, 'retain': False, 'unit_system': 1, 'type': 'individual', 'publish_options': None,
+                    'brokers': ['default']},
+        }
+        updated_record = {helpers.random_string(): random.random() for _ in range(10)}
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, topics, {}, None)
+        SUT.connections = [mock.Mock(), mock.Mock(), mock.Mock()]
+        SUT.publisher = SUT.connections[0]
+        SUT.publisher.connected = True
+        SUT.publisher.plugin_manager.callbacks = {
+            'update_record': {
+                'immediate': {},
+                'delay': {},
+            },
+        }
+        SUT.topic_ring = user.mqttpublish.TopicRing(len(SUT.connections))
+
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1})
+
+        with mock.patch.object(SUT, 'update_record', return_value=updated_record):
+            SUT.publish_row(time.time(), data, topics, 'loop')
+
+        for field in updated_record:
+            message_topic = f'{topic}/{field}'
+            connection = SUT.connections[SUT.topic_ring.get(message_topic)]
+            self.assertIn(message_topic, [call.args[3] for call in connection.publish_message.call_args_list])
+        self.assertEqual(sum(connection.publish_message.call_count for connection in SUT.connections), len(updated_record))
+
+    def test_publish_row_rate_limits_topic(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        message_rate = random.randint(1, 5)
+        topics = {
+            topic: {'qos': 0, 'retain': False, 'unit_system': 1, 'type': 'individual', 'publish_options': None,
+                    'brokers': ['default'], 'message_rate': message_rate, 'byte_rate': 0},
+        }
+        updated_record = {helpers.random_string(): random.random() for _ in range(10)}
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, topics, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = True
+        SUT.publisher.plugin_manager.callbacks = {
+            'update_record': {
+                'immediate': {},
+                'delay': {},
+            },
+        }
+        SUT.connections = [SUT.publisher]
+        topic_buckets = user.mqttpublish.RateLimiter.create_topic_buckets(SUT.topic_rates)
+        SUT.rate_limiters[SUT.publisher] = user.mqttpublish.RateLimiter.create(SUT.publisher, {}, topic_buckets)
+
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1})
+
+        with mock.patch.object(SUT, 'update_record', return_value=updated_record):
+            SUT.publish_row(time.time(), data, topics, 'loop')
+
+        self.assertEqual(SUT.publisher.publish_message.call_count, message_rate)
+        self.assertEqual(len(SUT.rate_limiters[SUT.publisher].pending), len(updated_record) - message_rate)
+
+    def test_publish_messages_spools_rest_when_connection_lost(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        messages = [(helpers.random_string(), helpers.random_string(), 1, False, None) for _ in range(3)]
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = True
+        SUT.spool = user.mqttpublish.Spool(mock_logger, ':memory:', 1000)
+
+        def publish_message(*_args):
+            SUT.publisher.connected = False
+            return mock.Mock(rc=user.mqttpublish.mqtt.MQTT_ERR_SUCCESS)
+
+        SUT.publisher.publish_message.side_effect = publish_message
+
+        message_infos = SUT.publish_messages(1, 'archive', [(topic, message) for message in messages])
+
+        self.assertEqual(len(message_infos), 1)
+        SUT.publisher.publish_message.assert_called_once()
+        self.assertEqual([row[2] for row in SUT.spool.peek(10)], [message[0] for message in messages[1:]])
+
+    def test_publish_messages_spools_qos0_message_not_sent(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        messages = [(helpers.random_string(), helpers.random_string(), 0, False, None) for _ in range(3)]
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = True
+        SUT.publisher.publish_message.side_effect = [mock.Mock(rc=user.mqttpublish.mqtt.MQTT_ERR_SUCCESS),
+                                                     mock.Mock(rc=user.mqttpublish.mqtt.MQTT_ERR_NO_CONN)]
+        SUT.spool = user.mqttpublish.Spool(mock_logger, ':memory:', 1000)
+
+        SUT.publish_messages(1, 'loop', [(topic, message) for message in messages])
+
+        self.assertEqual(SUT.publisher.publish_message.call_count, 2)
+        self.assertEqual([row[2] for row in SUT.spool.peek(10)], [message[0] for message in messages[1:]])
+
+    def test_replay_spool(self):
+        mock_logger = mock.Mock()
+        replay_rate = random.randint(10, 100)
+        messages = [(helpers.random_string(), helpers.random_string(), 0, False, None) for _ in range(replay_rate // 10 + 1)]
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = True
+        SUT.publisher.publish_message.return_value.rc = user.mqttpublish.mqtt.MQTT_ERR_SUCCESS
+        SUT.replay_rate = replay_rate
+        SUT.spool = user.mqttpublish.Spool(mock_logger, ':memory:', 1000)
+        SUT.spool.append(1, 'archive', messages)
+
+        wait = SUT.replay_spool()
+
+        self.assertEqual(SUT.publisher.publish_message.call_count, replay_rate // 10)
+        self.assertEqual(SUT.spool.count, 1)
+        self.assertAlmostEqual(wait, (replay_rate // 10) / replay_rate)
+
+    def test_replay_spool_below_ten_a_second(self):
+        mock_logger = mock.Mock()
+        replay_rate = random.randint(1, 9)
+        messages = [(helpers.random_string(), helpers.random_string(), 0, False, None) for _ in range(2)]
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = True
+        SUT.publisher.publish_message.return_value.rc = user.mqttpublish.mqtt.MQTT_ERR_SUCCESS
+        SUT.replay_rate = replay_rate
+        SUT.spool = user.mqttpublish.Spool(mock_logger, ':memory:', 1000)
+        SUT.spool.append(1, 'archive', messages)
+
+        wait = SUT.replay_spool()
+
+        self.assertEqual(SUT.publisher.publish_message.call_count, 1)
+        self.assertAlmostEqual(wait, 1 / replay_rate)
+
+    def test_replay_spool_removes_acknowledged_messages(self):
+        mock_logger = mock.Mock()
+        message_infos = [mock.Mock(rc=user.mqttpublish.mqtt.MQTT_ERR_SUCCESS) for _ in range(3)]
+        for message_info in message_infos:
+            message_info.is_published.return_value = False
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, None)
+        SUT.publisher = mock.Mock(connects=1)
+        SUT.publisher.connected = True
+        SUT.publisher.publish_message.side_effect = message_infos
+        SUT.connections = [SUT.publisher]
+        SUT.replay_rate = 100
+        SUT.spool = user.mqttpublish.Spool(mock_logger, ':memory:', 1000)
+        SUT.spool.append(1, 'archive', [(helpers.random_string(), helpers.random_string(), 1, False, None) for _ in range(3)])
+
+        SUT.replay_spool()
+
+        self.assertEqual(SUT.publisher.publish_message.call_count, 3)
+        self.assertEqual(SUT.spool.count, 3)
+
+        message_infos[0].is_published.return_value = True
+        message_infos[2].is_published.return_value = True
+        SUT.replay_spool()
+
+        self.assertEqual(SUT.publisher.publish_message.call_count, 3)
+        self.assertEqual(SUT.spool.count, 2)
+
+    def test_replay_spool_again_after_reconnect(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        message_info = mock.Mock(rc=user.mqttpublish.mqtt.MQTT_ERR_SUCCESS)
+        message_info.is_published.return_value = False
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, None)
+        SUT.publisher = mock.Mock(connects=1)
+        SUT.publisher.connected = True
+        SUT.publisher.publish_message.return_value = message_info
+        SUT.connections = [SUT.publisher]
+        SUT.replay_rate = 100
+        SUT.spool = user.mqttpublish.Spool(mock_logger, ':memory:', 1000)
+        SUT.spool.append(1, 'archive', [(topic, helpers.random_string(), 1, False, None)])
+
+        SUT.replay_spool()
+        SUT.publisher.connects = 2
+        SUT.replay_spool()
+
+        self.assertEqual([call.args[3] for call in SUT.publisher.publish_message.call_args_list], [topic, topic])
+        self.assertEqual(SUT.spool.count, 1)
+
+    def test_replay_spool_message_expiry(self):
+        mock_logger = mock.Mock()
+        now = time.time()
+        expired_topic = helpers.random_string()
+        topic = helpers.random_string()
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, {}, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = True
+        SUT.publisher.publish_message.return_value.rc = user.mqttpublish.mqtt.MQTT_ERR_SUCCESS
+        SUT.replay_rate = 100
+        SUT.spool = user.mqttpublish.Spool(mock_logger, ':memory:', 1000)
+        SUT.spool.append(now - 120, 'loop', [(expired_topic, helpers.random_string(), 0, False, {'message_expiry_interval': 60})])
+        SUT.spool.append(now - 30, 'loop', [(topic, helpers.random_string(), 0, False, {'message_expiry_interval': 60})])
+
+        with mock.patch('user.mqttpublish.time.time', return_value=now):
+            SUT.replay_spool()
+
+        SUT.publisher.publish_message.assert_called_once()
+        self.assertEqual(SUT.publisher.publish_message.call_args.args[3], topic)
+        self.assertEqual(SUT.publisher.publish_message.call_args.args[5], {'message_expiry_interval': 30})
+        self.assertEqual(SUT.spool.count, 0)
+
+    def test_coalesce(self):
+        elements = [
+            {'time_stamp': 1, 'type': 'loop', 'data': {}},
+            {'time_stamp': 2, 'type': 'archive', 'data': {}},
+            {'time_stamp': 3, 'type': 'loop', 'data': {}},
+            None,
+            {'time_stamp': 4, 'type': 'loop', 'data': {}},
+            {'time_stamp': 5, 'type': 'archive', 'data': {}},
+        ]
+
+        coalesced = user.mqttpublish.PublishWeeWXThread.coalesce(elements)
+
+        self.assertEqual([element['time_stamp'] for element in coalesced], [2, 4, 5])
+
+    def test_coalesce_merge(self):
+        field1 = helpers.random_string()
+        field2 = helpers.random_string()
+        elements = [
+            {'time_stamp': 1, 'type': 'loop', 'data': {'dateTime': 1, 'usUnits': 1, field1: 1, field2: 1}},
+            {'time_stamp': 2, 'type': 'archive', 'data': {'dateTime': 2, 'usUnits': 1}},
+            {'time_stamp': 3, 'type': 'loop', 'data': {'dateTime': 3, 'usUnits': 1, field2: 3}},
+            {'time_stamp': 4, 'type': 'archive', 'data': {'dateTime': 4, 'usUnits': 1}},
+        ]
+
+        coalesced = user.mqttpublish.PublishWeeWXThread.coalesce(elements, merge=True)
+
+        self.assertEqual([element['time_stamp'] for element in coalesced], [2, 3, 4])
+        self.assertEqual(dict(coalesced[1]['data']), {'dateTime': 3, 'usUnits': 1, field1: 1, field2: 3})
+        self.assertNotIn(field1, elements[2]['data'])
+
+    def test_coalesce_merge_unit_system_change(self):
+        field1 = helpers.random_string()
+        elements = [
+            {'time_stamp': 1, 'type': 'loop', 'data': {'dateTime': 1, 'usUnits': 1, field1: 1}},
+            {'time_stamp': 2, 'type': 'loop', 'data': {'dateTime': 2, 'usUnits': 16}},
+        ]
+
+        coalesced = user.mqttpublish.PublishWeeWXThread.coalesce(elements, merge=True)
+
+        self.assertEqual(dict(coalesced[0]['data']), {'dateTime': 2, 'usUnits': 16})
+
+    def test_next_element_replays_backlog_first(self):
+        mock_logger = mock.Mock()
+        mock_data_queue = mock.Mock()
+        backlog_rate = random.randint(1, 10)
+        element = {'time_stamp': 1, 'type': 'archive', 'data': {}}
+
+        mqtt_config = {'backlog_rate': backlog_rate}
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, mqtt_config, {}, {}, mock_data_queue)
+        SUT.backlog.append(element)
+
+        with mock.patch('user.mqttpublish.time') as mock_time:
+            mock_time.time.return_value = 0
+            SUT.next_element(5)
+
+            self.assertEqual(SUT.next_backlog, 1 / backlog_rate)
+            mock_data_queue.get.assert_not_called()
+
+            SUT.next_element(5)
+
+            mock_time.sleep.assert_not_called()
+            mock_data_queue.get.assert_called_once_with(timeout=5)
+
+    def test_next_element_backlog_wait_does_not_block_shutdown(self):
+        mock_logger = mock.Mock()
+        mqtt_config = {'backlog_rate': 0.01}
+        element = {'time_stamp': 1, 'type': 'archive', 'data': {}}
+
+        data_queue = user.mqttpublish.DataQueue(mock_logger)
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, mqtt_config, {}, {}, data_queue)
+        SUT.backlog.append(element)
+        SUT.next_backlog = time.time() + 2
+        data_queue.wakeup()
+
+        start = time.time()
+        self.assertIsNone(SUT.next_element(5))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(list(SUT.backlog), [element])
+
+    def test_next_element_data_queued_during_backlog_wait(self):
+        mock_logger = mock.Mock()
+        mqtt_config = {'backlog_rate': 10}
+        backlog_element = {'time_stamp': 1, 'type': 'archive', 'data': {}}
+        queued_element = {'time_stamp': 2, 'type': 'archive', 'data': {}}
+
+        data_queue = user.mqttpublish.DataQueue(mock_logger)
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, mqtt_config, {}, {}, data_queue)
+        SUT.backlog.append(backlog_element)
+        SUT.next_backlog = time.time() + 0.1
+        data_queue.put(queued_element)
+
+        self.assertIs(SUT.next_element(5), backlog_element)
+        self.assertEqual(list(SUT.backlog), [queued_element])
+        self.assertEqual(data_queue.qsize(), 0)
+
+    def test_next_elements_does_not_catch_up_during_backlog(self):
+        mock_logger = mock.Mock()
+        mqtt_config = {'backlog_rate': 1000, 'catch_up_threshold': 1}
+
+        data_queue = user.mqttpublish.DataQueue(mock_logger)
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, mqtt_config, {}, {}, data_queue)
+        backlog = [{'time_stamp': time_stamp, 'type': 'archive', 'data': {'dateTime': time_stamp}} for time_stamp in (1, 2)]
+        SUT.backlog.extend(backlog)
+        queued = [{'time_stamp': time_stamp, 'type': 'archive', 'data': {'dateTime': time_stamp}} for time_stamp in (3, 4)]
+        for element in queued:
+            data_queue.put(element)
+
+        elements = []
+        while len(elements) < len(backlog + queued):
+            elements.extend(SUT.next_elements(0))
+
+        self.assertEqual([element['time_stamp'] for element in elements], [1, 2, 3, 4])
+
+    def test_convert_record_with_plugin_updates(self):
+        field1 = helpers.random_string()
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1, 'outTemp': 32.0})
+        record = {**data, field1: 212.0}
+        converted_records = {}
+
+        with mock.patch.dict(user.mqttpublish.weewx.units.obs_group_dict, {field1: 'group_temperature'}):
+            converted_record = user.mqttpublish.PublishWeeWXThread.convert_record(record, data, 16, converted_records)
+
+        self.assertEqual(converted_record['usUnits'], 16)
+        self.assertAlmostEqual(converted_record['outTemp'], 0.0)
+        self.assertAlmostEqual(converted_record[field1], 100.0)
+        self.assertNotIn(field1, converted_records[16])
+
+    def test_convert_record_with_plugin_deletes(self):
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1, 'outTemp': 32.0})
+        record = dict(data)
+        del record['outTemp']
+        converted_records = {}
+
+        converted_record = user.mqttpublish.PublishWeeWXThread.convert_record(record, data, 16, converted_records)
+
+        self.assertNotIn('outTemp', converted_record)
+        self.assertAlmostEqual(converted_records[16]['outTemp'], 0.0)
+
+    def test_publish_row_plugin_deletes_field(self):
+        mock_logger = mock.Mock()
+        topic1 = helpers.random_string()
+        topic2 = helpers.random_string()
+        topics = {
+            topic: {'qos': 0, 'retain': False, 'unit_system': 1, 'type': 'json', 'publish_options': None, 'brokers': ['default']}
+            for topic in (topic1, topic2)
+        }
+
+        SUT = user.mqttpublish.PublishWeeWXThread(mock_logger, {}, None, None, {}, topics, {}, None)
+        SUT.publisher = mock.Mock()
+        SUT.publisher.connected = True
+
+        def delete_field(_client, topic, record, *_args):
+            self.assertIsInstance(record, dict)
+            if topic == topic1:
+                del record['outTemp']
+        SUT.publisher.plugin_manager.callbacks = {
+            'update_record': {
+                'immediate': {helpers.random_string(): delete_field},
+                'delay': {},
+            },
+        }
+
+        data = user.mqttpublish.MQTTPublish.snapshot({'dateTime': time.time(), 'usUnits': 1, 'outTemp': random.random()})
+        records = {}
+
+        def update_record(topic_dict, _time_stamp, record):
+            records[[topic for topic in topics if topics[topic] is topic_dict][0]] = record
+            return {}
+        with mock.patch.object(SUT, 'update_record', side_effect=update_record):
+            SUT.publish_row(time.time(), data, topics, 'loop')
+
+        self.assertNotIn('outTemp', records[topic1])
+        self.assertIn('outTemp', records[topic2])
+        self.assertIn('outTemp', data)
+
 if __name__ == '__main__':
     helpers.run_tests()
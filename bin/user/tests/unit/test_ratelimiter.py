@@ -0,0 +1,168 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+import mock
+
+import helpers
+
+import random
+
+import user.mqttpublish
+
+class TestTokenBucket(unittest.TestCase):
+    def test_waits_when_empty(self):
+        rate = random.randint(2, 10)
+
+        with mock.patch('user.mqttpublish.time.monotonic', return_value=0):
+            SUT = user.mqttpublish.TokenBucket(rate)
+
+        for _ in range(rate):
+            self.assertEqual(SUT.wait(1, 0), 0)
+            SUT.take(1)
+
+        self.assertAlmostEqual(SUT.wait(1, 0), 1 / rate)
+        self.assertEqual(SUT.wait(1, 1 / rate), 0)
+
+    def test_larger_than_bucket(self):
+        rate = random.randint(10, 100)
+
+        with mock.patch('user.mqttpublish.time.monotonic', return_value=0):
+            SUT = user.mqttpublish.TokenBucket(rate)
+
+        self.assertEqual(SUT.wait(rate * 3, 0), 0)
+        SUT.take(rate * 3)
+
+        # The debt is repaid before anything else can be taken.
+        self.assertAlmostEqual(SUT.wait(1, 0), (rate * 2 + 1) / rate)
+
+class TestRateLimiter(unittest.TestCase):
+    def test_no_limits(self):
+        mock_publisher = mock.Mock()
+
+        self.assertIsNone(user.mqttpublish.RateLimiter.create(mock_publisher, {}, {}))
+
+    def test_connection_message_rate(self):
+        mock_publisher = mock.Mock()
+        topic = helpers.random_string()
+        rate = random.randint(2, 5)
+        message_topics = [helpers.random_string() for _ in range(rate + 1)]
+
+        with mock.patch('user.mqttpublish.time.monotonic', return_value=0):
+            SUT = user.mqttpublish.RateLimiter.create(mock_publisher, {'connection_message_rate': rate}, {})
+            for message_topic in message_topics:
+                SUT.submit(topic, 'loop', 0, 0, False, message_topic, helpers.random_string(), None)
+
+            (message_infos, wait) = SUT.flush()
+
+        self.assertEqual(len(message_infos), rate)
+        self.assertEqual([call.args[3] for call in mock_publisher.publish_message.call_args_list], message_topics[:rate])
+        self.assertAlmostEqual(wait, 1 / rate)
+        self.assertEqual(list(SUT.pending), [(message_topic, None) for message_topic in message_topics[rate:]])
+
+    def test_newer_message_replaces_queued(self):
+        mock_publisher = mock.Mock()
+        topic = helpers.random_string()
+        message_topic = helpers.random_string()
+        payload = helpers.random_string()
+
+        with mock.patch('user.mqttpublish.time.monotonic', return_value=0):
+            SUT = user.mqttpublish.RateLimiter.create(mock_publisher, {'connection_message_rate': 1}, {})
+            SUT.submit(topic, 'loop', 0, 0, False, helpers.random_string(), helpers.random_string(), None)
+            SUT.flush()
+
+            SUT.submit(topic, 'loop', 1, 0, False, message_topic, helpers.random_string(), None)
+            SUT.submit(topic, 'loop', 2, 0, False, message_topic, payload, None)
+            SUT.flush()
+
+        with mock.patch('user.mqttpublish.time.monotonic', return_value=1):
+            SUT.flush()
+
+        self.assertEqual(SUT.replaced, 1)
+        self.assertEqual(SUT.pending, {})
+        mock_publisher.publish_message.assert_called_with(2, 0, False, message_topic, payload, None)
+        self.assertEqual(mock_publisher.publish_message.call_count, 2)
+
+    def test_waits_for_connection(self):
+        mock_publisher = mock.Mock()
+        mock_publisher.connected = False
+        topic = helpers.random_string()
+
+        with mock.patch('user.mqttpublish.time.monotonic', return_value=0):
+            SUT = user.mqttpublish.RateLimiter.create(mock_publisher, {'connection_message_rate': 1}, {})
+            SUT.submit(topic, 'archive', 0, 0, False, topic, helpers.random_string(), None)
+
+            (message_infos, _) = SUT.flush()
+
+        self.assertEqual(message_infos, [])
+        mock_publisher.publish_message.assert_not_called()
+        self.assertEqual(len(SUT.pending), 1)
+
+    def test_archive_message_not_replaced(self):
+        mock_publisher = mock.Mock()
+        topic = helpers.random_string()
+        message_topic = helpers.random_string()
+        archive_payloads = [helpers.random_string(), helpers.random_string()]
+        loop_payload = helpers.random_string()
+
+        with mock.patch('user.mqttpublish.time.monotonic', return_value=0):
+            SUT = user.mqttpublish.RateLimiter.create(mock_publisher, {'connection_message_rate': 1}, {})
+            SUT.submit(topic, 'loop', 0, 0, False, helpers.random_string(), helpers.random_string(), None)
+            SUT.flush()
+
+            SUT.submit(topic, 'archive', 1, 0, False, message_topic, archive_payloads[0], None)
+            SUT.submit(topic, 'archive', 2, 0, False, message_topic, archive_payloads[1], None)
+            SUT.submit(topic, 'loop', 3, 0, False, message_topic, loop_payload, None)
+
+        for now in (1, 2, 3):
+            with mock.patch('user.mqttpublish.time.monotonic', return_value=now):
+                SUT.flush()
+
+        self.assertEqual(SUT.replaced, 0)
+        self.assertEqual(SUT.pending, {})
+        self.assertEqual([call.args for call in mock_publisher.publish_message.call_args_list[1:]],
+                         [(1, 0, False, message_topic, archive_payloads[0], None),
+                          (2, 0, False, message_topic, archive_payloads[1], None),
+                          (3, 0, False, message_topic, loop_payload, None)])
+
+    def test_topic_rate_does_not_hold_up_other_topics(self):
+        mock_publisher = mock.Mock()
+        limited_topic = helpers.random_string()
+        topic = helpers.random_string()
+
+        with mock.patch('user.mqttpublish.time.monotonic', return_value=0):
+            topic_buckets = user.mqttpublish.RateLimiter.create_topic_buckets({limited_topic: (1, 0)})
+            SUT = user.mqttpublish.RateLimiter.create(mock_publisher, {}, topic_buckets)
+            SUT.submit(limited_topic, 'loop', 0, 0, False, f'{limited_topic}/a', helpers.random_string(), None)
+            SUT.submit(limited_topic, 'loop', 0, 0, False, f'{limited_topic}/b', helpers.random_string(), None)
+            SUT.submit(topic, 'loop', 0, 0, False, topic, helpers.random_string(), None)
+
+            (message_infos, wait) = SUT.flush()
+
+        self.assertEqual(len(message_infos), 2)
+        self.assertEqual([call.args[3] for call in mock_publisher.publish_message.call_args_list], [f'{limited_topic}/a', topic])
+        self.assertEqual(wait, 1)
+        self.assertEqual(list(SUT.pending), [(f'{limited_topic}/b', None)])
+
+    def test_byte_rate(self):
+        mock_publisher = mock.Mock()
+        topic = helpers.random_string()
+        payload = 'x' * 60
+
+        with mock.patch('user.mqttpublish.time.monotonic', return_value=0):
+            SUT = user.mqttpublish.RateLimiter.create(mock_publisher, {'connection_byte_rate': 100}, {})
+            SUT.submit(topic, 'loop', 0, 0, False, f'{topic}/a', payload, None)
+            SUT.submit(topic, 'loop', 0, 0, False, f'{topic}/b', payload, None)
+
+            (message_infos, wait) = SUT.flush()
+
+        self.assertEqual(len(message_infos), 1)
+        self.assertAlmostEqual(wait, 0.2)
+
+if __name__ == '__main__':
+    helpers.run_tests()
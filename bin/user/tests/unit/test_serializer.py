@@ -0,0 +1,151 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+import mock
+
+import helpers
+
+import configobj
+import json
+import random
+
+import user.mqttpublish
+
+def create_record():
+    return {
+        helpers.random_string(): random.random(),
+        helpers.random_string(): helpers.random_string(),
+        helpers.random_string(): None,
+    }
+
+class TestSerializer(unittest.TestCase):
+    def test_json(self):
+        topic = helpers.random_string()
+        record = create_record()
+
+        messages = user.mqttpublish.SERIALIZERS['json'].serialize(topic, record)
+
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0][0], topic)
+        self.assertIsInstance(messages[0][1], bytes)
+        self.assertDictEqual(json.loads(messages[0][1]), record)
+
+    def test_json_standard_library(self):
+        record = create_record()
+
+        with mock.patch.object(user.mqttpublish, 'orjson', None):
+            with mock.patch.object(user.mqttpublish, 'ujson', None):
+                payload = user.mqttpublish.dumps_json(record)
+
+                self.assertEqual(payload, json.dumps(record).encode('utf-8'))
+
+    def test_keyword(self):
+        topic = helpers.random_string()
+        record = create_record()
+
+        messages = user.mqttpublish.SERIALIZERS['keyword'].serialize(topic, record)
+
+        expected_payload = ', '.join([f"{key}={value}" for (key, value) in record.items()]).encode('utf-8')
+        self.assertEqual(messages, [(topic, expected_payload)])
+
+    def test_individual(self):
+        topic = helpers.random_string()
+        record = create_record()
+        field = helpers.random_string()
+        record[field] = [random.random(), random.random()]
+
+        messages = user.mqttpublish.SERIALIZERS['individual'].serialize(topic, record)
+
+        expected_messages = [(f"{topic}/{key}", None if value is None else str(value).encode('utf-8'))
+                             for (key, value) in record.items()]
+        expected_messages[-1] = (f"{topic}/{field}", user.mqttpublish.dumps_json(record[field]))
+        self.assertEqual(messages, expected_messages)
+        for (_, payload) in messages:
+            self.assertIsInstance(payload, (bytes, type(None)))
+
+    @unittest.skipIf(user.mqttpublish.orjson is None, "orjson is not installed, skipping test.")
+    def test_json_orjson(self):
+        record = create_record()
+
+        payload = user.mqttpublish.dumps_json(record)
+
+        self.assertEqual(payload, user.mqttpublish.orjson.dumps(record))
+        self.assertDictEqual(json.loads(payload), record)
+
+    @unittest.skipIf(user.mqttpublish.orjson is None, "orjson is not installed, skipping test.")
+    def test_json_orjson_falls_back(self):
+        # orjson only serializes 64 bit integers.
+        record = {helpers.random_string(): 2 ** 64}
+
+        payload = user.mqttpublish.dumps_json(record)
+
+        self.assertEqual(payload, json.dumps(record).encode('utf-8'))
+
+    @unittest.skipIf(user.mqttpublish.ujson is None, "ujson is not installed, skipping test.")
+    def test_json_ujson(self):
+        record = create_record()
+        record[helpers.random_string()] = f"{helpers.random_string()}/{helpers.random_string()}"
+
+        with mock.patch.object(user.mqttpublish, 'orjson', None):
+            payload = user.mqttpublish.dumps_json(record)
+
+            self.assertEqual(payload, json.dumps(record, separators=(',', ':')).encode('utf-8'))
+
+    @unittest.skipIf(user.mqttpublish.msgpack is None, "msgpack is not installed, skipping test.")
+    def test_msgpack(self):
+        topic = helpers.random_string()
+        record = create_record()
+
+        messages = user.mqttpublish.SERIALIZERS['msgpack'].serialize(topic, record)
+
+        self.assertDictEqual(user.mqttpublish.msgpack.unpackb(messages[0][1]), record)
+
+    @unittest.skipIf(user.mqttpublish.cbor2 is None, "cbor2 is not installed, skipping test.")
+    def test_cbor(self):
+        topic = helpers.random_string()
+        record = create_record()
+
+        messages = user.mqttpublish.SERIALIZERS['cbor'].serialize(topic, record)
+
+        self.assertDictEqual(user.mqttpublish.cbor2.loads(messages[0][1]), record)
+
+class TestConfigureTopicType(unittest.TestCase):
+    def configure_topics(self, data_type):
+        mock_engine = mock.Mock()
+        config = configobj.ConfigObj({'MQTTPublish': {'enable': False}})
+        service_config = configobj.ConfigObj({
+            'topics': {
+                helpers.random_string(): {
+                    'type': data_type,
+                },
+            },
+        })
+
+        with mock.patch('user.mqttpublish.PublishWeeWXThread'):
+            with mock.patch('user.mqttpublish.Logger'):
+                SUT = user.mqttpublish.MQTTPublish(mock_engine, config)
+                return SUT.configure_topics(service_config)
+
+    def test_invalid_type(self):
+        data_type = helpers.random_string()
+
+        with self.assertRaises(ValueError) as error:
+            self.configure_topics(data_type)
+
+        self.assertEqual(error.exception.args[0], f"Invalid 'type', {data_type}")
+
+    def test_type_module_not_installed(self):
+        with mock.patch.object(user.mqttpublish, 'msgpack', None):
+            with self.assertRaises(ValueError) as error:
+                self.configure_topics('msgpack')
+
+            self.assertEqual(error.exception.args[0], "'type' msgpack requires the msgpack module.")
+
+if __name__ == '__main__':
+    helpers.run_tests()
@@ -0,0 +1,120 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+import mock
+
+import helpers
+
+import os
+import random
+import tempfile
+
+import user.mqttpublish
+
+class TestSpool(unittest.TestCase):
+    def test_append_peek_remove(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+        payload = helpers.random_string()
+        options = {'content_type': helpers.random_string()}
+        messages = [(topic, payload, 1, True, options), (helpers.random_string(), b'\x01\x02', 0, False, None)]
+
+        SUT = user.mqttpublish.Spool(mock_logger, ':memory:', 100)
+        SUT.append(1, 'archive', messages)
+
+        self.assertEqual(SUT.count, 2)
+        rows = SUT.peek(1)
+        self.assertEqual(rows, [(rows[0][0], 1, topic, payload, 1, 1, options)])
+
+        SUT.remove(rows[0][0])
+
+        self.assertEqual(SUT.count, 1)
+        self.assertEqual(SUT.peek(10)[0][3], b'\x01\x02')
+
+    def test_compact_superseded_retained(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+
+        SUT = user.mqttpublish.Spool(mock_logger, ':memory:', 2)
+        SUT.append(1, 'loop', [(topic, '1', 0, True, None)])
+        SUT.append(2, 'loop', [(topic, '2', 0, True, None)])
+        SUT.append(3, 'loop', [(topic, '3', 0, True, None)])
+
+        self.assertEqual(SUT.count, 1)
+        self.assertEqual(SUT.dropped, 0)
+        self.assertEqual(SUT.peek(10)[0][3], '3')
+
+    def test_compact_keeps_retained_archive(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+
+        SUT = user.mqttpublish.Spool(mock_logger, ':memory:', 3)
+        SUT.append(1, 'archive', [(topic, '1', 0, True, None)])
+        SUT.append(2, 'archive', [(topic, '2', 0, True, None)])
+        SUT.append(3, 'loop', [(topic, '3', 0, True, None)])
+        SUT.append(4, 'loop', [(topic, '4', 0, True, None)])
+
+        self.assertEqual(SUT.count, 3)
+        self.assertEqual(SUT.dropped, 0)
+        self.assertEqual([row[3] for row in SUT.peek(10)], ['1', '2', '4'])
+
+    def test_peek_after(self):
+        mock_logger = mock.Mock()
+
+        SUT = user.mqttpublish.Spool(mock_logger, ':memory:', 100)
+        SUT.append(1, 'archive', [(helpers.random_string(), helpers.random_string(), 0, False, None) for _ in range(3)])
+        rows = SUT.peek(10)
+
+        self.assertEqual(SUT.peek(10, rows[0][0]), rows[1:])
+
+    def test_compact_drops_oldest_loop(self):
+        mock_logger = mock.Mock()
+        max_messages = random.randint(2, 5)
+
+        SUT = user.mqttpublish.Spool(mock_logger, ':memory:', max_messages)
+        SUT.append(0, 'archive', [(helpers.random_string(), helpers.random_string(), 0, False, None)])
+        for i in range(1, max_messages + 1):
+            SUT.append(i, 'loop', [(helpers.random_string(), helpers.random_string(), 0, False, None)])
+
+        self.assertEqual(SUT.count, max_messages)
+        self.assertEqual(SUT.dropped, 1)
+        self.assertEqual([row[1] for row in SUT.peek(10)], [0] + list(range(2, max_messages + 1)))
+
+    def test_compact_to_low_water(self):
+        mock_logger = mock.Mock()
+
+        SUT = user.mqttpublish.Spool(mock_logger, ':memory:', 20)
+        with mock.patch.object(SUT, 'compact', wraps=SUT.compact) as mock_compact:
+            for i in range(23):
+                SUT.append(i, 'loop', [(helpers.random_string(), helpers.random_string(), 0, False, None)])
+
+            mock_compact.assert_called_once()
+
+        self.assertEqual(SUT.count, 20)
+        self.assertEqual(SUT.dropped, 3)
+        self.assertEqual([row[1] for row in SUT.peek(100)], list(range(3, 23)))
+
+    def test_reopen(self):
+        mock_logger = mock.Mock()
+        topic = helpers.random_string()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spool.sdb')
+            SUT = user.mqttpublish.Spool(mock_logger, path, 100)
+            SUT.append(1, 'archive', [(topic, helpers.random_string(), 0, False, None)])
+            SUT.close()
+
+            SUT = user.mqttpublish.Spool(mock_logger, path, 100)
+
+            self.assertEqual(SUT.count, 1)
+            self.assertEqual(SUT.peek(1)[0][2], topic)
+            SUT.close()
+
+if __name__ == '__main__':
+    helpers.run_tests()
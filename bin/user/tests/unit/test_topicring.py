@@ -0,0 +1,50 @@
+#    Copyright (c) 2026 Rich Bell <bellrichm@gmail.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+
+# pylint: disable=wrong-import-order
+# pylint: disable=missing-module-docstring, missing-class-docstring, missing-function-docstring
+# pylint: disable=invalid-name
+import unittest
+
+import helpers
+
+import random
+
+import user.mqttpublish
+
+class TestTopicRing(unittest.TestCase):
+    def test_topic_stays_on_its_connection(self):
+        connections = random.randint(2, 8)
+        topic = helpers.random_string()
+
+        SUT = user.mqttpublish.TopicRing(connections)
+        connection = SUT.get(topic)
+
+        self.assertIn(connection, range(connections))
+        self.assertEqual(user.mqttpublish.TopicRing(connections).get(topic), connection)
+        self.assertEqual(SUT.get(topic), connection)
+
+    def test_topics_are_spread(self):
+        connections = random.randint(2, 4)
+        topics = [f'weather/{helpers.random_string()}' for _ in range(200)]
+
+        SUT = user.mqttpublish.TopicRing(connections)
+
+        self.assertEqual({SUT.get(topic) for topic in topics}, set(range(connections)))
+
+    def test_adding_a_connection_moves_few_topics(self):
+        connections = random.randint(2, 6)
+        topics = [f'weather/{helpers.random_string()}' for _ in range(500)]
+
+        before = user.mqttpublish.TopicRing(connections)
+        after = user.mqttpublish.TopicRing(connections + 1)
+        moved = [topic for topic in topics if before.get(topic) != after.get(topic)]
+
+        # Only the topics assigned to the new connection move.
+        self.assertTrue(all(after.get(topic) == connections for topic in moved))
+        self.assertLess(len(moved), len(topics) / 2)
+
+if __name__ == '__main__':
+    helpers.run_tests()
@@ -118,6 +118,50 @@ MQTTPUBLISH_CONFIG = """
         # Default is 'offline'.
         offline_payload = offline
 
+    # Store the messages in a SQLite database while the MQTT broker is unreachable.
+    # They are published, in order, once reconnected.
+    [[spool]]
+        # Turn the spool on and off.
+        # Default is true.
+        enable = false
+
+        # The spool database, a relative path is relative to the WeeWX SQLite databases directory.
+        # Default is mqttpublish-spool.sdb
+        path = mqttpublish-spool.sdb
+
+        # The maximum number of messages in the spool.
+        # Default is 100000.
+        max_messages = 100000
+
+        # The maximum number of stored messages published per second once reconnected.
+        # Default is 100.
+        replay_rate = 100
+
+    # Publish statistics about MQTTPublish's health and throughput.
+    [[metrics]]
+        # Turn the metrics on and off.
+        # Default is true.
+        enable = false
+
+        # The topic that the metrics are published to, as a JSON message.
+        # Default is mqttpublish/metrics.
+        topic = mqttpublish/metrics
+
+        # The number of seconds between publishing the metrics.
+        # Default is 60.
+        interval = 60
+
+        # Also write the metrics, in the Prometheus text format, to this file.
+        # Default is None.
+        # prometheus_file =
+
+    # Additional MQTT brokers, each topic lists the brokers it is published to in its 'brokers' option.
+    # The options not set default to those of [MQTTPublish].
+    # [[brokers]]
+    #     [[[REPLACE_ME]]]
+    #         host = REPLACE_ME
+    #         port = 1883
+
     [[topics]]
         [[[REPLACE_ME]]]
             # Controls if the topic is published.
@@ -128,6 +172,11 @@ MQTTPUBLISH_CONFIG = """
             # Default is 'archive, loop'.
             binding = archive, loop
 
+            # A comma separated list of the brokers this topic is published to.
+            # 'default' is the broker configured in [MQTTPublish].
+            # Default is default.
+            # brokers = default
+
             # A comma separated list of fields that are not published.
             # This is a short hand notation for having to configure each field and setting ignore = True in its section.
             # ignore_fields =
@@ -154,7 +203,8 @@ MQTTPUBLISH_CONFIG = """
             retain = False
 
             # The format of the MQTT payload.
-            # Currently support: individual, json, keyword
+            # Currently support: individual, json, keyword, msgpack, cbor
+            # msgpack requires the msgpack module and cbor requires the cbor2 module.
             # The default is 'json'
             type = json
 